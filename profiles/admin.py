@@ -1,5 +1,59 @@
+from django import forms
 from django.contrib import admin
-from profiles.models import Profile
+from profiles.models import BalanceSnapshot, CashEntry, Profile
 
 # Register your models here.
-admin.site.register(Profile)
+admin.site.register(BalanceSnapshot)
+
+
+class ProfileAdminForm(forms.ModelForm):
+    adjustment = forms.FloatField(
+        required=False,
+        help_text='Credit (or debit if negative) the balance by this amount')
+    adjustment_remarks = forms.CharField(required=False)
+
+    class Meta:
+        model = Profile
+        fields = ('user',)
+
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    """
+    The balance is read only. It changes through an adjustment, recorded
+    in the ledger by Profile.adjust_balance.
+    """
+    form = ProfileAdminForm
+    list_display = ('user', 'balance', 'updated_at')
+    readonly_fields = ('balance',)
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            # Never write back the balance read with the form
+            obj.save(update_fields=['user', 'updated_at'])
+        else:
+            obj.save()
+        amount = form.cleaned_data.get('adjustment')
+        if amount:
+            obj.adjust_balance(
+                amount, remarks=form.cleaned_data.get('adjustment_remarks')
+                or None)
+
+
+@admin.register(CashEntry)
+class CashEntryAdmin(admin.ModelAdmin):
+    """
+    Read only. Balance changes must go through Profile.adjust_balance (or an
+    order) so the cached balance and the ledger stay in sync.
+    """
+    list_display = ('created_at', 'profile', 'kind', 'amount', 'reference')
+    list_filter = ('kind',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
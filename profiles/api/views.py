@@ -3,12 +3,13 @@ from rest_framework.permissions import IsAuthenticated
 
 from profiles.models import Profile
 from profiles.api.serializers import ProfileSerializer
+from trading.replicas import ReplicaReadsMixin
 
 
-class ProfileAPIView(generics.RetrieveAPIView):
+class ProfileAPIView(ReplicaReadsMixin, generics.RetrieveAPIView):
 
     permission_classes = [IsAuthenticated]
-    queryset = Profile.objects.all()
+    queryset = Profile.objects.select_related('user')
     serializer_class = ProfileSerializer
 
     def get_queryset(self):
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from profiles.models import CashEntry, Profile
+
+
+class Command(BaseCommand):
+    help = ('Snapshot the ledger balance of every profile with new cash '
+            'entries. Meant to run periodically, e.g. from cron')
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.filter(
+            id__in=CashEntry.objects.values('profile'))
+        taken = sum(profile.take_snapshot() is not None
+                    for profile in profiles.iterator())
+        self.stdout.write(
+            self.style.SUCCESS('Successfully took %d snapshots' % taken))
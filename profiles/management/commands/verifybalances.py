@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from profiles.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Check the cached balance of every profile against its ledger'
+
+    def handle(self, *args, **options):
+        mismatches = 0
+        for profile in Profile.objects.select_related('user').iterator():
+            ledger = profile.ledger_balance()
+            if abs(ledger - profile.balance) > 1e-6:
+                mismatches += 1
+                self.stderr.write(
+                    f'{profile}: balance {profile.balance}, '
+                    f'ledger {ledger}')
+        if mismatches:
+            raise CommandError(f'{mismatches} balances disagree with the '
+                               f'ledger')
+        self.stdout.write(self.style.SUCCESS('All balances match the ledger'))
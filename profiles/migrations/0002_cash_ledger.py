@@ -0,0 +1,63 @@
+# Generated by Django 2.2 on 2026-10-18 15:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def open_ledgers(apps, schema_editor):
+    """
+    Start the ledger of every existing profile with its current balance
+    """
+    Profile = apps.get_model('profiles', 'Profile')
+    CashEntry = apps.get_model('profiles', 'CashEntry')
+    CashEntry.objects.bulk_create([
+        CashEntry(profile_id=profile_id, kind='opening', amount=balance)
+        for profile_id, balance in Profile.objects.exclude(
+            balance=0).values_list('id', 'balance')])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('bonus', 'Signup bonus'), ('order', 'Order fill'), ('adjustment', 'Manual adjustment')], max_length=10)),
+                ('amount', models.FloatField()),
+                ('reference', models.CharField(blank=True, max_length=50)),
+                ('remarks', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cash_entries', to='profiles.Profile')),
+            ],
+            options={
+                'verbose_name_plural': 'cash entries',
+                'ordering': ('created_at', 'id'),
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.FloatField()),
+                ('last_entry_id', models.IntegerField()),
+                ('taken_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to='profiles.Profile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cashentry',
+            index=models.Index(fields=['profile', 'created_at'], name='cashentry_profile_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='balancesnapshot',
+            index=models.Index(fields=['profile', 'taken_at'], name='snapshot_profile_taken_idx'),
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.db.models import F, Sum
+from django.utils import timezone
 
 
 class Profile(models.Model):
@@ -8,6 +10,10 @@ class Profile(models.Model):
     will be used for authentication purposes. The Profile model will be used
     to hold trading records. A new Profile object will be created and binded
     during user registration.
+
+    `balance` is a cached value. Every change to it is also recorded as a
+    CashEntry, which is the source of truth for the balance at any point
+    in time.
     """
     balance = models.FloatField(default=0)
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -16,3 +22,116 @@ class Profile(models.Model):
 
     def __str__(self):
         return self.user.username
+
+    def adjust_balance(self, amount, remarks=None):
+        """ Manually credit (or debit if negative) the balance """
+        with transaction.atomic():
+            Profile.objects.filter(pk=self.pk).update(
+                balance=F('balance') + amount, updated_at=timezone.now())
+            entry = CashEntry.objects.create(
+                profile=self, kind='adjustment', amount=amount,
+                remarks=remarks)
+        self.refresh_from_db(fields=['balance', 'updated_at'])
+        return entry
+
+    def balance_as_of(self, when):
+        """
+        Balance right after every cash movement up to `when`. Reads the
+        latest snapshot taken at or before `when` and adds the entries
+        recorded after it.
+        """
+        snapshot = self.balance_snapshots.filter(
+            taken_at__lte=when).order_by('-last_entry_id').first()
+        entries = self.cash_entries.filter(created_at__lte=when)
+        balance = 0
+        if snapshot is not None:
+            entries = entries.filter(id__gt=snapshot.last_entry_id)
+            balance = snapshot.balance
+        delta = entries.aggregate(Sum('amount')).get('amount__sum')
+        return balance + (delta or 0)
+
+    def ledger_balance(self):
+        """ Current balance according to the ledger """
+        return self.balance_as_of(timezone.now())
+
+    def verify_balance(self, tolerance=1e-6):
+        """ True if the cached balance agrees with the ledger """
+        return abs(self.ledger_balance() - self.balance) <= tolerance
+
+    def take_snapshot(self):
+        """
+        Record the ledger balance up to the latest entry so balance_as_of
+        only has to add the entries that come after it. Returns None if
+        nothing happened since the last snapshot.
+        """
+        last = self.balance_snapshots.order_by('-last_entry_id').first()
+        entries = self.cash_entries.all()
+        balance = 0
+        if last is not None:
+            entries = entries.filter(id__gt=last.last_entry_id)
+            balance = last.balance
+        totals = entries.aggregate(
+            amount=Sum('amount'), last_entry_id=models.Max('id'),
+            taken_at=models.Max('created_at'))
+        if totals.get('last_entry_id') is None:
+            return None
+        if last is not None:
+            totals['taken_at'] = max(totals['taken_at'], last.taken_at)
+        return self.balance_snapshots.create(
+            balance=balance + totals['amount'],
+            last_entry_id=totals['last_entry_id'],
+            taken_at=totals['taken_at'])
+
+
+class CashEntry(models.Model):
+    """
+    Append-only record of a change to a profile's balance. Positive amounts
+    are credits, negative amounts debits.
+    """
+    KIND_CHOICES = [
+        ('opening', 'Opening balance'),
+        ('bonus', 'Signup bonus'),
+        ('order', 'Order fill'),
+        ('adjustment', 'Manual adjustment'),
+    ]
+    profile = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='cash_entries')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    amount = models.FloatField()
+    # What caused the movement, e.g. "order:42"
+    reference = models.CharField(max_length=50, blank=True)
+    remarks = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('created_at', 'id')
+        indexes = [
+            models.Index(fields=['profile', 'created_at'],
+                         name='cashentry_profile_created_idx'),
+        ]
+        verbose_name_plural = 'cash entries'
+
+    def __str__(self):
+        return f'{self.profile_id}: {self.kind} {self.amount:+}'
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Ledger balance of a profile after every cash entry up to and including
+    `last_entry_id`. `taken_at` is the latest created_at of those entries.
+    """
+    profile = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='balance_snapshots')
+    balance = models.FloatField()
+    last_entry_id = models.IntegerField()
+    taken_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', 'taken_at'],
+                         name='snapshot_profile_taken_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.profile_id}: {self.balance} at {self.taken_at}'
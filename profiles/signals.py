@@ -2,7 +2,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 
-from profiles.models import Profile
+from profiles.models import CashEntry, Profile
 
 
 @receiver(post_save, sender=User)
@@ -15,4 +15,5 @@ def create_profile(sender, instance, created, **kwargs):
 
     if created:
         # Create a new profile for new users with 100 trading bonus :)
-        Profile.objects.create(user=instance, balance=100)
+        profile = Profile.objects.create(user=instance, balance=100)
+        CashEntry.objects.create(profile=profile, kind='bonus', amount=100)
@@ -1,9 +1,17 @@
+from datetime import timedelta
+from io import StringIO
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
 
 from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
 
+from profiles.models import CashEntry
+
 
 # Test users
 TEST_USERS = [
@@ -37,3 +45,81 @@ class ProfileEndpointTestCase(APITestCase):
             self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
             user = User.objects.get(username=user.get('username'))
             self.assertIsNotNone(user.profile)
+
+
+class CashLedgerTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.profile = User.objects.create(username='ledger_user').profile
+
+    def add_entry(self, amount, when):
+        return CashEntry.objects.create(
+            profile=self.profile, kind='adjustment', amount=amount,
+            created_at=when)
+
+    def test_signup_bonus_recorded(self):
+        """ The signup bonus is the first entry of a new ledger """
+        entry = self.profile.cash_entries.get()
+        self.assertEqual((entry.kind, entry.amount), ('bonus', 100))
+        self.assertTrue(self.profile.verify_balance())
+
+    def test_adjust_balance(self):
+        self.profile.adjust_balance(-30, remarks='fee')
+        self.assertEqual(self.profile.balance, 70)
+        self.assertEqual(self.profile.ledger_balance(), 70)
+        self.profile.balance = 500
+        self.assertFalse(self.profile.verify_balance())
+
+    def test_admin_adjustment(self):
+        """ The admin changes the balance through the ledger only """
+        admin = User.objects.create_superuser(
+            'ledger_admin', 'admin@test.com', 'djangotest1234')
+        self.client.force_login(admin)
+        resp = self.client.post(
+            reverse('admin:profiles_profile_change',
+                    args=(self.profile.pk,)),
+            {'user': self.profile.user.pk, 'balance': 9999,
+             'adjustment': 25, 'adjustment_remarks': 'refund'})
+        self.assertEqual(resp.status_code, status.HTTP_302_FOUND)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.balance, 125)
+        self.assertTrue(self.profile.verify_balance())
+        self.assertEqual(self.profile.cash_entries.last().remarks, 'refund')
+
+    def test_balance_as_of(self):
+        """
+        Ensure point in time balances are right with and without snapshots
+        and only need the latest snapshot plus the entries after it
+        """
+        start = timezone.now()
+        self.profile.cash_entries.update(created_at=start)
+        for day in range(1, 6):
+            self.add_entry(10, start + timedelta(days=day))
+        expected = {day: 100 + 10 * day for day in range(6)}
+
+        for day, balance in expected.items():
+            self.assertEqual(self.profile.balance_as_of(
+                start + timedelta(days=day, hours=1)), balance)
+
+        snapshot = self.profile.take_snapshot()
+        self.assertEqual(snapshot.balance, 150)
+        self.assertIsNone(self.profile.take_snapshot())
+        self.add_entry(-25, start + timedelta(days=6))
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self.profile.balance_as_of(
+                start + timedelta(days=7)), 125)
+        # Older points in time don't use the newer snapshot
+        for day, balance in expected.items():
+            self.assertEqual(self.profile.balance_as_of(
+                start + timedelta(days=day, hours=1)), balance)
+        self.assertEqual(self.profile.balance_as_of(
+            start - timedelta(days=1)), 0)
+
+    def test_snapshot_command(self):
+        self.add_entry(5, timezone.now())
+        out = StringIO()
+        call_command('snapshotbalances', stdout=out)
+        self.assertIn('1 snapshots', out.getvalue())
+        self.assertEqual(
+            self.profile.balance_snapshots.get().balance, 105)
@@ -0,0 +1,145 @@
+"""
+Read replica routing with read-your-writes stickiness.
+
+Aliases listed in READ_REPLICAS (set up from the DATABASE_REPLICAS
+environment variable in settings) serve the reads of the safe requests of
+views that opt in with ReplicaReadsMixin. Everything else, and every write,
+goes to `default`. Once a request of a user writes, that user's requests
+read from `default` for REPLICA_STICKY_SECONDS so they see their own
+writes despite replication lag. The sticky marks are kept in the `default`
+cache: configure a cache shared by all processes (e.g. memcached) when
+several serve requests.
+
+Locally, SQLite files can stand in for replicas: `manage.py syncreplicas`
+copies the primary database into each of them, which is when they "catch
+up" with it.
+"""
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+_state = threading.local()
+
+
+def read_from_replica():
+    """ Send the reads of the current request to a replica """
+    _state.replica = True
+
+
+def reset():
+    _state.replica = False
+    _state.wrote = False
+
+
+def wrote():
+    """ Whether the current request wrote to the primary """
+    return getattr(_state, 'wrote', False)
+
+
+@contextmanager
+def primary():
+    """ Read from the primary within the block """
+    replica = getattr(_state, 'replica', False)
+    _state.replica = False
+    try:
+        yield
+    finally:
+        _state.replica = replica
+
+
+def _sticky_key(user_id):
+    return f'replicas:sticky:{user_id}'
+
+
+def stick_to_primary(user):
+    cache.set(_sticky_key(user.pk), True, settings.REPLICA_STICKY_SECONDS)
+
+
+def is_sticky(user):
+    """ Whether `user` wrote recently and must read from the primary """
+    return user.pk is not None and cache.get(_sticky_key(user.pk), False)
+
+
+class ReplicaRouter:
+    """
+    Reads go to a random replica when the current request was sent there
+    and hasn't written yet, to `default` otherwise. Replicas get their
+    schema from the primary, they are never migrated.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Related objects come from where the instance was read
+            return instance._state.db
+        if settings.READ_REPLICAS and getattr(_state, 'replica', False) \
+                and not wrote():
+            return random.choice(settings.READ_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.READ_REPLICAS
+
+
+class ReplicaReadsMixin:
+    """
+    Serve the safe requests of a DRF view from a read replica, unless the
+    user wrote recently. `replica_actions` limits it to some viewset
+    actions, None means all of them.
+    """
+    replica_actions = None
+
+    def initial(self, request, *args, **kwargs):
+        if request.method in SAFE_METHODS and (
+                self.replica_actions is None
+                or getattr(self, 'action', None) in self.replica_actions) \
+                and not is_sticky(request.user):
+            read_from_replica()
+        super().initial(request, *args, **kwargs)
+
+
+class ReplicaMiddleware:
+    """
+    Scope the routing state to the request, and make the user stick to the
+    primary after a request that wrote
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset()
+        try:
+            response = self.get_response(request)
+            # DRF sets the token authenticated user on the Django request
+            user = getattr(request, 'user', None)
+            if wrote() and user is not None and user.is_authenticated:
+                stick_to_primary(user)
+        finally:
+            reset()
+        return response
+
+
+def sync_replica(alias):
+    """ Copy the SQLite primary database into the SQLite replica `alias` """
+    source = connections['default']
+    source.ensure_connection()
+    target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+    try:
+        source.connection.backup(target)
+    finally:
+        target.close()
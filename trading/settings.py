@@ -70,6 +70,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'tradingapp.middleware.ProfilingMiddleware',
+    'trading.replicas.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'trading.urls'
@@ -100,9 +102,45 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Wait for the write lock instead of failing right away when
+        # several workers place orders at the same time
+        'OPTIONS': {'timeout': 20},
+        # File based test database so that tests can use several
+        # connections (threads) at once
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
 
+# Production SQLite mode (tradingapp.sqlite): WAL journaling and tuned
+# pragmas on every connection, connections kept open between requests and
+# order writes queued on a single writer lane.
+SQLITE_PRODUCTION = os.environ.get(
+    'SQLITE_PRODUCTION', '').lower() in ('1', 'true')
+SQLITE_PRODUCTION_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 20000,
+    'cache_size': -64000,  # KiB
+    'mmap_size': 256 * 2 ** 20,
+    'temp_store': 'memory',
+}
+SQLITE_PRAGMAS = SQLITE_PRODUCTION_PRAGMAS if SQLITE_PRODUCTION else {}
+SQLITE_WRITER_LANE = SQLITE_PRODUCTION
+if SQLITE_PRODUCTION:
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+
+# Read replicas (trading.replicas): DATABASE_REPLICAS is a comma separated
+# list of SQLite files standing in for them, aliased replica1, replica2...
+# Safe requests of the stock, order and profile endpoints read from them,
+# except for users who wrote in the last REPLICA_STICKY_SECONDS.
+for i, name in enumerate(filter(None, os.environ.get(
+        'DATABASE_REPLICAS', '').split(',')), 1):
+    DATABASES[f'replica{i}'] = dict(
+        DATABASES['default'], NAME=name, TEST={'MIRROR': 'default'})
+READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+DATABASE_ROUTERS = ['trading.replicas.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -148,10 +186,16 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         # 'rest_framework.authentication.BasicAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'tradingapp.authentication.CachedTokenAuthentication',
     ]
 }
 
+# Process local token cache (tradingapp.authentication). Logging out or
+# deleting a token takes effect at once in the process that did it, and
+# within TOKEN_CACHE_TTL seconds in the others.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+
 AUTHENTICATION_API_ONLY = True
 
 # Setting for rest_auth.registration
@@ -159,3 +203,43 @@ SITE_ID = 1
 ACCOUNT_AUTHENTICATED_LOGIN_REDIRECTS = True
 ACCOUNT_AUTHENTICATION_METHOD = 'username'
 ACCOUNT_EMAIL_VERIFICATION = 'none'
+
+# Process local Stock lookup cache (tradingapp.cache.stock_cache). Entries
+# expire after STOCK_CACHE_TTL seconds so changes made by other processes
+# are eventually seen.
+STOCK_CACHE_SIZE = 2048
+STOCK_CACHE_TTL = 60
+
+# Process local stock list cache (tradingapp.cache.stock_list_cache): the
+# shared market data and up to STOCK_LIST_CACHE_SIZE traders' `invested`
+# overlays. Quantities move with every order, so this expires sooner.
+STOCK_LIST_CACHE_SIZE = 10000
+STOCK_LIST_CACHE_TTL = 5
+
+# Request profiling (tradingapp.middleware.ProfilingMiddleware). Profile this
+# fraction of requests, plus any request sent with an `X-Profile` header
+# equal to PROFILING_TOKEN. Reports are listed in the admin.
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')
+
+# Asynchronous order intake. When true, market orders posted to the order
+# endpoint are only validated and queued as 'pending' (202 Accepted); the
+# `processorders` workers fill them in batches.
+ORDER_QUEUE = os.environ.get('ORDER_QUEUE', '').lower() in ('1', 'true')
+
+# Times a limit order is matched again on a reloaded book when the book it
+# matched on turned out stale (tradingapp.services.place_limit_order)
+LIMIT_ORDER_ATTEMPTS = 3
+
+# Rows fetched per query by the streaming order export
+# (tradingapp.export), which bounds its memory use
+ORDER_EXPORT_CHUNK_SIZE = 2000
+
+# Final orders older than this are moved to the order archive by
+# `manage.py archiveorders` (tradingapp.archive)
+ORDER_ARCHIVE_AFTER_DAYS = 90
+
+# How sells consume the cost of the shares held (tradingapp.costbasis):
+# 'fifo' (oldest lots first) or 'average' (average cost of the position).
+# Run `manage.py rebuildlots` after changing it.
+COST_BASIS_METHOD = os.environ.get('COST_BASIS_METHOD', 'fifo')
@@ -1,6 +1,55 @@
 from django.contrib import admin
-from tradingapp.models import Order, Stock
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+
+from tradingapp.models import (
+    ArchivedOrder, Lot, Order, Position, PositionCarry, RequestProfile,
+    Stock, StockBar)
 
 # Register your models here.
+admin.site.register(ArchivedOrder)
+admin.site.register(Lot)
 admin.site.register(Order)
+admin.site.register(Position)
+admin.site.register(PositionCarry)
 admin.site.register(Stock)
+admin.site.register(StockBar)
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'status_code',
+                    'duration_ms', 'sql_count', 'sql_ms', 'serializer_ms',
+                    'download')
+    list_filter = ('method', 'status_code')
+    search_fields = ('path',)
+    exclude = ('stats',)
+    readonly_fields = ('method', 'path', 'status_code', 'duration_ms',
+                       'sql_count', 'sql_ms', 'serializer_ms', 'hotspots',
+                       'queries', 'summary', 'created_at', 'download')
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/download/',
+                 self.admin_site.admin_view(self.download_view),
+                 name='tradingapp_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download(self, obj):
+        url = reverse('admin:tradingapp_requestprofile_download',
+                      args=(obj.pk,))
+        return format_html('<a href="{}">.prof</a>', url)
+
+    def download_view(self, request, pk):
+        """ Raw cProfile stats, readable with pstats or snakeviz """
+        report = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(
+            bytes(report.stats), content_type='application/octet-stream')
+        response['Content-Disposition'] = \
+            f'attachment; filename="request-{report.pk}.prof"'
+        return response
@@ -0,0 +1,64 @@
+import hashlib
+
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin:
+    """
+    ETag support for the list and retrieve actions of a viewset.
+
+    The validator is computed from cheap version columns by
+    `list_version()` / `retrieve_version()` (usually one aggregate query),
+    together with the requesting user and the full request path. A GET
+    whose If-None-Match matches it is answered with 304 before the action
+    runs, so nothing is queried for or serialized. A version of None
+    disables the check for that request.
+    """
+
+    def list_version(self):
+        return None
+
+    def retrieve_version(self):
+        return None
+
+    def version_pk(self):
+        """
+        The pk of the URL as an int, or None when it is not one. The action
+        then answers the bad lookup with its usual 404.
+        """
+        try:
+            return int(self.kwargs.get(self.lookup_field))
+        except (TypeError, ValueError):
+            return None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if request.method != 'GET' or self.action not in (
+                'list', 'retrieve'):
+            return
+        version = getattr(self, f'{self.action}_version')()
+        if version is None:
+            return
+        key = '|'.join(str(part) for part in (
+            request.user.pk, request.get_full_path(), *version))
+        self.etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        if self.etag in parse_etags(
+                request.META.get('HTTP_IF_NONE_MATCH', '')):
+            # dispatch() looks the handler up after initial()
+            self.get = self.not_modified
+
+    def not_modified(self, request, *args, **kwargs):
+        return Response(status=status.HTTP_304_NOT_MODIFIED)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in (
+                status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = self.etag
+            patch_vary_headers(response, ('Authorization',))
+        return response
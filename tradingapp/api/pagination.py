@@ -0,0 +1,90 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on (created_at, id), newest first. Every page is a
+    range scan that starts right after the last row of the previous page, so
+    deep pages cost the same as the first one.
+
+    Opt-in per request: the response is only paginated when the `cursor` or
+    `page_size` query parameter is given, otherwise the whole list is
+    returned like before.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and \
+                self.page_size_query_param not in params:
+            return None
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by('-created_at', '-id')
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            created_at, pk = self.decode_cursor(cursor)
+            # The plain created_at__lte term lets the database seek straight
+            # to the cursor in the (trader, created_at, id) index
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(id__lt=pk),
+                created_at__lte=created_at)
+
+        page = list(queryset[:page_size + 1])
+        self.has_next = len(page) > page_size
+        page = page[:page_size]
+        self.last = page[-1] if page else None
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data
+        })
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(
+                self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def encode_cursor(self, obj):
+        if isinstance(obj, dict):
+            # Row of a values() queryset
+            position = f'{obj["created_at"].isoformat()}|{obj["id"]}'
+        else:
+            position = f'{obj.created_at.isoformat()}|{obj.id}'
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = urlsafe_b64decode(
+                cursor.encode()).decode().split('|')
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
@@ -1,8 +1,8 @@
-from django.db.models import Sum
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
-from tradingapp.models import Order, Stock
+from tradingapp.cache import stock_cache
+from tradingapp.models import Order, Position, Stock, StockBar
 
 
 class StockSerializer(serializers.ModelSerializer):
@@ -10,35 +10,35 @@ class StockSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Stock
-        fields = '__all__'
+        exclude = ('book_version',)
 
     def get_invested(self, instance):
-        trader = self.context['request'].user.profile
-        buy = trader.orders.filter(order_type='buy', stock=instance)
-        if buy.count() == 0:
-            return None
-        sell = trader.orders.filter(order_type='sell', stock=instance)
-
-        buy_amount = buy.aggregate(Sum('amount')).get('amount__sum')
-        bought_shares = buy.aggregate(Sum('quantity')).get('quantity__sum')
-        if sell.count() == 0:
-            sell_amount = 0
-            sold_shares = 0
+        if hasattr(instance, 'position_bought_shares'):
+            # Position totals were joined in by Stock.objects.with_position
+            bought_shares = instance.position_bought_shares
+            bought_amount = instance.position_bought_amount
+            sold_shares = instance.position_sold_shares
+            sold_amount = instance.position_sold_amount
+            held_shares = instance.position_held_shares
+            cost_basis = instance.position_cost_basis
+            realized_pnl = instance.position_realized_pnl
         else:
-            sell_amount = sell.aggregate(Sum('amount')).get('amount__sum')
-            sold_shares = sell.aggregate(Sum('quantity')).get('quantity__sum')
-        return {
-            'buy': {
-                'amount': buy_amount,
-                'shares': bought_shares
-            },
-            'sell': {
-                'amount': sell_amount,
-                'shares': sold_shares
-            },
-            'net_invested': buy_amount - sell_amount,
-            'net_shares': bought_shares - sold_shares
-        }
+            trader = self.context['request'].user.profile
+            try:
+                position = trader.positions.get(stock=instance)
+            except Position.DoesNotExist:
+                return None
+            bought_shares = position.bought_shares
+            bought_amount = position.bought_amount
+            sold_shares = position.sold_shares
+            sold_amount = position.sold_amount
+            held_shares = position.held_shares
+            cost_basis = position.cost_basis
+            realized_pnl = position.realized_pnl
+
+        return represent_invested(
+            bought_shares, bought_amount, sold_shares, sold_amount,
+            held_shares, cost_basis, realized_pnl)
 
 
 class OrderSerializer(serializers.ModelSerializer):
@@ -60,27 +60,18 @@ class OrderSerializer(serializers.ModelSerializer):
         stock = attrs.get('stock')
 
         if attrs.get('order_type') == 'sell':
-            # Get total shares owned by the trader
-            bought_shares = trader.orders.filter(
-                order_type='buy',
-                stock__name=stock.name).aggregate(
-                    Sum('quantity')).get('quantity__sum')
-            if bought_shares is None:
+            try:
+                position = trader.positions.get(stock=stock)
+            except Position.DoesNotExist:
+                position = None
+            if position is None or position.bought_shares == 0:
                 raise ValidationError("You don't have any shares to sell.")
 
-            sold_shares = trader.orders.filter(
-                order_type='sell',
-                stock__name=stock.name).aggregate(
-                    Sum('quantity')).get('quantity__sum')
-            bought_shares = bought_shares if bought_shares is not None else 0
-            sold_shares = sold_shares if sold_shares is not None else 0
-
             # Ensure only available shares can be sold
-            availble_shares = bought_shares - sold_shares
-            if attrs.get('quantity') > availble_shares:
+            if attrs.get('quantity') > position.net_shares:
                 raise ValidationError(
                     (f'Not enough stocks to sell. Available {stock.name} '
-                     f'shares: {bought_shares}'))
+                     f'shares: {position.net_shares}'))
         else:
             if attrs.get('amount') > trader.balance:
                 raise ValidationError('Not enough balance')
@@ -92,5 +83,192 @@ class OrderSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         ret = super().to_representation(instance)
         ret['trader'] = str(instance.trader)
-        ret['stock'] = str(instance.stock.name)
+        ret['stock'] = str(stock_cache.get(pk=instance.stock_id).name)
         return ret
+
+
+class LimitOrderSerializer(serializers.Serializer):
+    """ Input of a limit order, placed in the stock's order book """
+    order_type = serializers.ChoiceField(choices=Order.ORDER_TYPE_CHOICES)
+    quantity = serializers.IntegerField(min_value=1)
+    limit_price = serializers.FloatField(min_value=0.01)
+
+
+class StockRefField(serializers.Field):
+    """
+    A stock as the order endpoint takes it: an id when given as a number,
+    a name otherwise. The value keeps its type so both stay apart.
+    """
+    default_error_messages = {
+        'invalid': 'Must be a stock id or name.'
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool) or not isinstance(data, (int, str)) \
+                or not str(data).strip():
+            self.fail('invalid')
+        return data.strip() if isinstance(data, str) else data
+
+    def to_representation(self, value):
+        return value
+
+
+class BatchOrderItemSerializer(serializers.Serializer):
+    stock = StockRefField()
+    order_type = serializers.ChoiceField(choices=Order.ORDER_TYPE_CHOICES)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BatchOrderSerializer(serializers.Serializer):
+    """
+    Input of the batch order endpoint. With `atomic` (the default) one bad
+    order rejects the whole batch, otherwise every order is placed or
+    rejected on its own.
+    """
+    max_orders = 500
+
+    orders = BatchOrderItemSerializer(many=True, allow_empty=False)
+    atomic = serializers.BooleanField(default=True)
+
+    def validate_orders(self, value):
+        if len(value) > self.max_orders:
+            raise ValidationError(
+                f'Too many orders. Maximum per batch: {self.max_orders}')
+        return value
+
+
+# Columns read by the fast order read path, see represent_order
+ORDER_COLUMNS = ('id', 'quantity', 'order_type', 'amount', 'status',
+                 'remarks', 'limit_price', 'filled_quantity', 'created_at',
+                 'updated_at', 'trader__user__username', 'stock__name')
+
+_datetime_field = serializers.DateTimeField()
+
+
+def order_rows(queryset):
+    """
+    Narrow an Order queryset to the columns needed by represent_order. The
+    trader's username and the stock name are joined in, so rendering a list
+    of orders is a single query.
+    """
+    return queryset.values(*ORDER_COLUMNS)
+
+
+def represent_order(row):
+    """
+    Build the OrderSerializer representation of an order_rows() row
+    directly, without going through ModelSerializer's per field machinery.
+    The output is identical to OrderSerializer(order).data.
+    """
+    to_datetime = _datetime_field.to_representation
+    if row['limit_price'] is None:
+        price_per_share = row['amount'] / row['quantity']
+    elif row['filled_quantity']:
+        price_per_share = row['amount'] / row['filled_quantity']
+    else:
+        price_per_share = row['limit_price']
+    return {
+        'id': row['id'],
+        'quantity': float(row['quantity']),
+        'price_per_share': price_per_share,
+        'order_type': row['order_type'],
+        'amount': row['amount'],
+        'status': row['status'],
+        'remarks': row['remarks'],
+        'limit_price': row['limit_price'],
+        'filled_quantity': row['filled_quantity'],
+        'created_at': to_datetime(row['created_at']),
+        'updated_at': to_datetime(row['updated_at']),
+        'trader': row['trader__user__username'],
+        'stock': row['stock__name']
+    }
+
+
+class StockHistoryQuerySerializer(serializers.Serializer):
+    """ Query parameters of the stock history endpoint """
+    interval = serializers.ChoiceField(
+        choices=StockBar.INTERVAL_CHOICES, default='1h')
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    limit = serializers.IntegerField(
+        min_value=1, max_value=5000, default=500)
+
+    def validate(self, data):
+        if data.get('start') and data.get('end') and \
+                data.get('start') >= data.get('end'):
+            raise ValidationError('start must be before end')
+        return data
+
+
+class OrderExportQuerySerializer(serializers.Serializer):
+    """ Query parameters of the order export endpoint """
+    # Not `format`, DRF picks the renderer with it
+    output = serializers.ChoiceField(
+        choices=('csv', 'ndjson'), default='csv')
+    stock = serializers.ListField(
+        child=serializers.CharField(), required=False)
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        if data.get('start') and data.get('end') and \
+                data.get('start') >= data.get('end'):
+            raise ValidationError('start must be before end')
+        return data
+
+
+# Columns of a stock as served by the stock endpoints, `invested` aside
+STOCK_COLUMNS = ('id', 'name', 'price', 'quantity', 'created_at',
+                 'updated_at')
+
+
+def represent_stock(row):
+    """
+    StockSerializer representation of a values_list(*STOCK_COLUMNS) row,
+    with `invested` left as None for the trader's overlay
+    """
+    pk, name, price, quantity, created_at, updated_at = row
+    to_datetime = _datetime_field.to_representation
+    return {
+        'id': pk,
+        'invested': None,
+        'name': name,
+        'price': price,
+        'quantity': quantity,
+        'created_at': to_datetime(created_at),
+        'updated_at': to_datetime(updated_at)
+    }
+
+
+def represent_invested(bought_shares, bought_amount, sold_shares,
+                       sold_amount, held_shares, cost_basis, realized_pnl):
+    """ The `invested` field of a stock from the trader's position totals """
+    if not bought_shares:
+        return None
+    return {
+        'buy': {
+            'amount': bought_amount,
+            'shares': bought_shares
+        },
+        'sell': {
+            'amount': sold_amount,
+            'shares': sold_shares
+        },
+        'net_invested': bought_amount - sold_amount,
+        'net_shares': bought_shares - sold_shares,
+        'held_shares': held_shares,
+        'cost_basis': cost_basis,
+        'realized_pnl': realized_pnl
+    }
+
+
+# Columns of a stock bar as served by the history endpoint
+BAR_COLUMNS = ('start', 'open', 'high', 'low', 'close', 'volume',
+               'notional', 'trades')
+
+
+def represent_bar(row):
+    """ Representation of a StockBar values_list(*BAR_COLUMNS) row """
+    bar = dict(zip(BAR_COLUMNS, row))
+    bar['start'] = _datetime_field.to_representation(bar['start'])
+    return bar
@@ -1,11 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from tradingapp.api.views import OrderAPIViewSet, StockAPIViewSet
+from tradingapp.api.views import (
+    OrderAPIViewSet, PortfolioAPIView, StockAPIViewSet)
 
 router = DefaultRouter()
 router.register('orders', OrderAPIViewSet, basename='order')
 router.register('stocks', StockAPIViewSet, basename='stock')
 
 urlpatterns = [
-    path('', include(router.urls))
+    path('', include(router.urls)),
+    path('portfolio/', PortfolioAPIView.as_view(), name='portfolio')
 ]
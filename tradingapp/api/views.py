@@ -1,18 +1,41 @@
-from django.http import QueryDict
-from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Max, Q
+from django.http import Http404, QueryDict, StreamingHttpResponse
 
 from rest_framework import status
+from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 from rest_framework import mixins
 
-from tradingapp.models import Order, Stock
-from tradingapp.api.serializers import OrderSerializer, StockSerializer
+from profiles.models import Profile
+from trading.replicas import ReplicaReadsMixin, primary
+from tradingapp.cache import stock_cache, stock_list_cache
+from tradingapp.models import ArchivedOrder, Order, Stock, StockBar
+from tradingapp.api.conditional import ConditionalGetMixin
+from tradingapp.api.pagination import KeysetPagination
+from tradingapp.api.serializers import (
+    BAR_COLUMNS, STOCK_COLUMNS, BatchOrderItemSerializer,
+    BatchOrderSerializer, LimitOrderSerializer, OrderExportQuerySerializer,
+    OrderSerializer, StockHistoryQuerySerializer, StockSerializer,
+    order_rows, represent_bar, represent_invested, represent_order,
+    represent_stock)
+from tradingapp.export import FORMATS, export_lines, filter_orders
+from tradingapp.matching import engine
+from tradingapp.services import (
+    cancel_limit_order, place_limit_order, place_order, place_orders)
+from tradingapp.sqlite import writer_lane
 
 
-class OrderAPIViewSet(GenericViewSet,
+class OrderAPIViewSet(ReplicaReadsMixin,
+                      ConditionalGetMixin,
+                      GenericViewSet,
                       mixins.ListModelMixin,
                       mixins.CreateModelMixin,
                       mixins.RetrieveModelMixin):
@@ -20,12 +43,44 @@ class OrderAPIViewSet(GenericViewSet,
     permission_classes = [IsAuthenticated]
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
+    replica_actions = ('list', 'retrieve')
 
     def get_queryset(self):
         return self.queryset.filter(trader=self.request.user.profile)
 
+    def get_archived_queryset(self):
+        return ArchivedOrder.objects.filter(trader=self.request.user.profile)
+
+    def list_version(self):
+        return self.get_queryset().aggregate(
+            updated_at=Max('updated_at'), count=Count('id')).values()
+
+    def retrieve_version(self):
+        pk = self.version_pk()
+        if pk is None:
+            return None
+        return self.get_queryset().filter(pk=pk).values_list(
+            'updated_at').first() or self.get_archived_queryset().filter(
+                pk=pk).values_list('updated_at').first()
+
     def list(self, request, *args, **kwargs):
-        return super().list(request, *args, **kwargs)
+        queryset = order_rows(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(
+                [represent_order(row) for row in page])
+        return Response([represent_order(row) for row in queryset])
+
+    def retrieve(self, request, *args, **kwargs):
+        """ Falls back to the order archive for old orders """
+        pk = kwargs.get(self.lookup_field)
+        try:
+            row = get_object_or_404(order_rows(self.get_queryset()), pk=pk)
+        except Http404:
+            row = get_object_or_404(
+                order_rows(self.get_archived_queryset()), pk=pk)
+        return Response(represent_order(row))
 
     def create(self, request, *args, **kwargs):
         data = request.data
@@ -34,12 +89,19 @@ class OrderAPIViewSet(GenericViewSet,
         quantity = int(data.get('quantity'))
         stock_id = data.get('stock')
 
-        if isinstance(stock_id, int):
-            stock_obj = get_object_or_404(Stock, id=data.get('stock'))
-        else:
-            stock_obj = get_object_or_404(Stock, name=data.get('stock'))
+        try:
+            if isinstance(stock_id, int):
+                stock_obj = stock_cache.get(pk=stock_id)
+            else:
+                stock_obj = stock_cache.get(name=stock_id)
+        except Stock.DoesNotExist:
+            raise Http404
 
         profile_obj = request.user.profile
+        if data.get('limit_price') not in (None, ''):
+            return self.create_limit_order(profile_obj, stock_obj, data)
+        if settings.ORDER_QUEUE:
+            return self.enqueue_order(profile_obj, stock_obj, data)
         data.update({
             'trader': profile_obj.id,
             'amount': quantity * stock_obj.price,
@@ -50,31 +112,284 @@ class OrderAPIViewSet(GenericViewSet,
         if not s.is_valid():
             raise ValidationError(detail=s.errors)
 
-        if data.get('order_type') == 'buy':
-            # Reduce trader's balance by order amount.
-            profile_obj.balance -= data.get('amount')
-            profile_obj.save()
-            # Reduce stock quantity by order quantity
-            stock_obj.quantity -= quantity
-            stock_obj.save()
-        else:
-            # Add the sell order amount to the trader's balance
-            profile_obj.balance += data.get('amount')
-            profile_obj.save()
-            # Return the stocks quantity
-            stock_obj.quantity += quantity
-            stock_obj.save()
-
-        order = s.create(s.validated_data)
+        try:
+            order = place_order(
+                profile_obj, stock_obj, data.get('order_type'), quantity)
+        except DjangoValidationError as e:
+            raise ValidationError(
+                detail={api_settings.NON_FIELD_ERRORS_KEY: e.messages})
         s = OrderSerializer(order)
 
         return Response(s.data, status=status.HTTP_201_CREATED)
 
+    def create_limit_order(self, profile_obj, stock_obj, data):
+        s = LimitOrderSerializer(data=data)
+        if not s.is_valid():
+            raise ValidationError(detail=s.errors)
+        try:
+            order = place_limit_order(
+                profile_obj, stock_obj, **s.validated_data)
+        except DjangoValidationError as e:
+            raise ValidationError(
+                detail={api_settings.NON_FIELD_ERRORS_KEY: e.messages})
+        return Response(
+            OrderSerializer(order).data, status=status.HTTP_201_CREATED)
+
+    def enqueue_order(self, profile_obj, stock_obj, data):
+        """
+        Only check the input and queue the order as 'pending'. Balance,
+        inventory and shares are checked when processorders fills it, and
+        the amount is 0 until then: the cached price may be stale and the
+        order fills at the price of that moment.
+        """
+        s = BatchOrderItemSerializer(data=data)
+        if not s.is_valid():
+            raise ValidationError(detail=s.errors)
+        quantity = s.validated_data.get('quantity')
+        with writer_lane():
+            order = Order.objects.create(
+                trader=profile_obj, stock=stock_obj,
+                order_type=s.validated_data.get('order_type'),
+                quantity=quantity, amount=0,
+                status='pending')
+        return Response(
+            OrderSerializer(order).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, *args, **kwargs):
+        """ Cancel the unfilled rest of one of the trader's limit orders """
+        order = self.get_object()
+        try:
+            cancel_limit_order(order)
+        except DjangoValidationError as e:
+            raise ValidationError(
+                detail={api_settings.NON_FIELD_ERRORS_KEY: e.messages})
+        return Response(OrderSerializer(order).data)
 
-class StockAPIViewSet(GenericViewSet,
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        """
+        Place several orders in one request and one transaction. Accepts
+        {"orders": [...], "atomic": true} or just the list of orders.
+        """
+        data = request.data
+        if isinstance(data, list):
+            data = {'orders': data}
+        s = BatchOrderSerializer(data=data)
+        if not s.is_valid():
+            raise ValidationError(detail=s.errors)
+        items = s.validated_data.get('orders')
+        atomic = s.validated_data.get('atomic')
+
+        try:
+            results = place_orders(request.user.profile, items, atomic)
+        except DjangoValidationError as e:
+            errors = e.message_dict
+            raise ValidationError(detail={'orders': [
+                {api_settings.NON_FIELD_ERRORS_KEY: errors[str(i)]}
+                if str(i) in errors else {} for i in range(len(items))]})
+
+        if atomic:
+            s = OrderSerializer(results, many=True)
+            return Response(s.data, status=status.HTTP_201_CREATED)
+        return Response(
+            [{'order': OrderSerializer(r).data} if isinstance(r, Order)
+             else {'errors': r} for r in results],
+            status=status.HTTP_207_MULTI_STATUS)
+
+    @action(detail=False)
+    def export(self, request, *args, **kwargs):
+        """
+        Stream the trader's whole order history, oldest first, as CSV or
+        NDJSON (`output`), optionally only orders of some `stock` (names,
+        repeatable) created in [`start`, `end`)
+        """
+        s = OrderExportQuerySerializer(data=request.query_params)
+        if not s.is_valid():
+            raise ValidationError(detail=s.errors)
+        params = s.validated_data
+        orders = [filter_orders(
+            queryset, params.get('stock'), params.get('start'),
+            params.get('end')) for queryset in (
+                self.get_queryset(), self.get_archived_queryset())]
+        output = params.get('output')
+        response = StreamingHttpResponse(
+            export_lines(orders, output, settings.ORDER_EXPORT_CHUNK_SIZE),
+            content_type=FORMATS[output][0])
+        response['Content-Disposition'] = (
+            f'attachment; filename="orders-{request.user.username}.{output}"')
+        return response
+
+
+class StockAPIViewSet(ReplicaReadsMixin,
+                      ConditionalGetMixin,
+                      GenericViewSet,
                       mixins.ListModelMixin,
                       mixins.RetrieveModelMixin):
 
     serializer_class = StockSerializer
     permission_classes = [IsAuthenticated]
     queryset = Stock.objects.all()
+
+    def get_queryset(self):
+        return self.queryset.with_position(self.request.user.profile)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Assembled from stock_list_cache: the shared rows of every stock,
+        each with the trader's `invested` from the trader's overlay
+        """
+        (_, rows), (_, invested) = self.cached_list()
+        return Response([dict(row, invested=invested.get(row['id']))
+                         for row in rows])
+
+    def list_version(self):
+        """ Tags of the cached market rows and trader overlay """
+        (market, _), (overlay, _) = self.cached_list()
+        return market, overlay
+
+    def cached_list(self):
+        if not hasattr(self, '_cached_list'):
+            profile = self.request.user.profile
+            # Shared entries are loaded from the primary, a lagging replica
+            # could otherwise be cached past a write
+            with primary():
+                self._cached_list = (
+                    stock_list_cache.market(load_market_rows),
+                    stock_list_cache.overlay(
+                        profile.pk, lambda: load_invested(profile)))
+        return self._cached_list
+
+    def retrieve_version(self):
+        """ The stock's updated_at and the trader's position on it """
+        pk = self.version_pk()
+        if pk is None:
+            return None
+        mine = Q(positions__trader__user=self.request.user)
+        return Stock.objects.filter(pk=pk).annotate(
+                position_updated_at=Max(
+                    'positions__updated_at', filter=mine)).values_list(
+                        'updated_at', 'position_updated_at').first()
+
+    @action(detail=True)
+    def history(self, request, *args, **kwargs):
+        """
+        OHLCV bars of the stock, read from the pre-aggregated buckets. Takes
+        `interval` (1m, 1h or 1d), an optional `start` / `end` range and
+        `limit`. Without `start` the latest `limit` bars are returned.
+        """
+        try:
+            stock = stock_cache.get(pk=int(kwargs.get(self.lookup_field)))
+        except (Stock.DoesNotExist, ValueError):
+            raise Http404
+        s = StockHistoryQuerySerializer(data=request.query_params)
+        if not s.is_valid():
+            raise ValidationError(detail=s.errors)
+        params = s.validated_data
+
+        bars = StockBar.objects.filter(
+            stock=stock, interval=params.get('interval')).values_list(
+                *BAR_COLUMNS)
+        if params.get('end'):
+            bars = bars.filter(start__lt=params.get('end'))
+        if params.get('start'):
+            bars = bars.filter(start__gte=params.get('start')).order_by(
+                'start')[:params.get('limit')]
+        else:
+            bars = list(bars.order_by('-start')[:params.get('limit')])[::-1]
+        return Response({
+            'stock': stock.name,
+            'interval': params.get('interval'),
+            'bars': [represent_bar(row) for row in bars]
+        })
+
+    @action(detail=True)
+    def book(self, request, *args, **kwargs):
+        """
+        Best `levels` (default 10) price levels of both sides of the stock's
+        order book, as [price, shares, orders]
+        """
+        try:
+            stock = stock_cache.get(pk=int(kwargs.get(self.lookup_field)))
+        except (Stock.DoesNotExist, ValueError):
+            raise Http404
+        try:
+            levels = int(request.query_params.get('levels', 10))
+        except ValueError:
+            raise ValidationError(detail={'levels': 'Must be an integer'})
+        version = Stock.objects.values_list(
+            'book_version', flat=True).get(pk=stock.pk)
+        with engine.lock:
+            book = engine.book(stock.pk, version)
+            depth = book.depth(max(1, min(levels, 100)))
+            depth.update(best_bid=book.best_bid(), best_ask=book.best_ask())
+        return Response(dict(stock=stock.name, **depth))
+
+    @action(detail=False, url_path='cache-stats',
+            permission_classes=[IsAdminUser])
+    def cache_stats(self, request, *args, **kwargs):
+        """ Hit / miss counters of this process's stock lookup cache """
+        return Response(stock_cache.stats())
+
+
+def load_market_rows():
+    """ Rows of every stock, `invested` aside, for stock_list_cache """
+    return [represent_stock(row) for row in
+            Stock.objects.values_list(*STOCK_COLUMNS)]
+
+
+def load_invested(trader):
+    """ The trader's `invested` by stock id, for stock_list_cache """
+    positions = trader.positions.values_list(
+        'stock_id', 'bought_shares', 'bought_amount', 'sold_shares',
+        'sold_amount', 'held_shares', 'cost_basis', 'realized_pnl')
+    invested = {}
+    for stock_id, *totals in positions:
+        if totals[0]:
+            invested[stock_id] = represent_invested(*totals)
+    return invested
+
+
+class PortfolioAPIView(APIView):
+    """
+    Holdings of the authenticated trader valued at the current stock
+    prices, with their cost basis and realized P&L. Computed from one query
+    over the trader's positions joined with their stocks, so its cost
+    depends on the number of stocks held and not on the number of orders
+    placed.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        profile = request.user.profile
+        # Shares reserved by resting limit sells are still held
+        market_value = ExpressionWrapper(
+            F('held_shares') * F('stock__price'), output_field=FloatField())
+        positions = profile.positions.annotate(
+            shares=F('held_shares'),
+            market_value=market_value,
+            unrealized_gain=market_value - F('cost_basis'),
+        ).order_by('stock__name').values_list(
+            'stock__name', 'stock__price', 'shares', 'cost_basis',
+            'market_value', 'unrealized_gain', 'realized_pnl')
+
+        fields = ('stock', 'price', 'shares', 'cost_basis', 'market_value',
+                  'unrealized_gain', 'realized_pnl')
+        positions = [dict(zip(fields, row)) for row in positions]
+        # Positions sold out still count for the realized P&L
+        holdings = [p for p in positions if p['shares'] > 0]
+        totals = {
+            'cost_basis': sum(h['cost_basis'] for h in holdings),
+            'market_value': sum(h['market_value'] for h in holdings),
+            'unrealized_gain': sum(h['unrealized_gain'] for h in holdings),
+            'realized_pnl': sum(p['realized_pnl'] for p in positions),
+        }
+        # request.user.profile may be a cached copy, read the live balance
+        balance = Profile.objects.values_list('balance', flat=True).get(
+            pk=profile.pk)
+        return Response({
+            'holdings': holdings,
+            'totals': totals,
+            'balance': balance,
+            'net_worth': balance + totals['market_value']
+        })
@@ -6,4 +6,5 @@ class TradingappConfig(AppConfig):
 
     def ready(self) -> None:
         import profiles.signals  # noqa: E261 F401
+        import tradingapp.signals  # noqa: E261 F401
         super().ready()
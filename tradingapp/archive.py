@@ -0,0 +1,101 @@
+"""
+Hot / cold storage of orders. Orders that are final (filled, rejected or
+cancelled) and older than the archive horizon are moved from the Order
+table to ArchivedOrder, so the Order table only holds recent and live
+orders and everything that scans it stays proportional to recent activity.
+
+Before they are moved, the fills of the archived orders are folded into a
+PositionCarry per (trader, stock): positions rebuilt from the Order table
+plus the carries come out as before. Positions and the cash ledger
+themselves are running totals and are not touched.
+
+Limit orders with trades stay in the Order table, their trades reference
+them.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from tradingapp.bulk import update_many
+from tradingapp.models import ArchivedOrder, Order, PositionCarry
+from tradingapp.sqlite import writer_lane
+
+# Statuses an order never leaves
+FINAL_STATUSES = ('success', 'rejected', 'cancelled')
+
+# Columns copied from Order to ArchivedOrder
+ARCHIVED_FIELDS = ('id', 'order_type', 'trader_id', 'stock_id', 'quantity',
+                   'amount', 'status', 'remarks', 'limit_price',
+                   'filled_quantity', 'created_at', 'updated_at')
+
+
+def horizon(days=None):
+    """ Orders created before this are archived """
+    if days is None:
+        days = settings.ORDER_ARCHIVE_AFTER_DAYS
+    return timezone.now() - timedelta(days=days)
+
+
+def archivable(before):
+    """ Orders that can be archived when created before `before` """
+    return Order.objects.filter(
+        created_at__lt=before, status__in=FINAL_STATUSES).exclude(
+            # Traded limit orders, referenced by their trades
+            limit_price__isnull=False, filled_quantity__gt=0)
+
+
+def archive_orders(before, batch_size=5000):
+    """
+    Archive up to `batch_size` of the oldest archivable orders created
+    before `before`, in one transaction. Returns the number archived.
+    """
+    # Final orders never change again, they can be read before the
+    # transaction, which then starts with a write
+    rows = list(archivable(before).order_by('id').values_list(
+        *ARCHIVED_FIELDS)[:batch_size])
+    if not rows:
+        return 0
+    orders = [ArchivedOrder(**dict(zip(ARCHIVED_FIELDS, row)))
+              for row in rows]
+
+    with writer_lane(), transaction.atomic():
+        ArchivedOrder.objects.bulk_create(orders)
+        _carry_forward(orders)
+        Order.objects.filter(pk__in=[o.pk for o in orders]).delete()
+    return len(orders)
+
+
+def _carry_forward(orders):
+    """ Fold the archived `orders` into their traders' PositionCarry """
+    keys = {(o.trader_id, o.stock_id) for o in orders}
+    carries = PositionCarry.objects.select_for_update().filter(
+        trader__in={trader for trader, _ in keys},
+        stock__in={stock for _, stock in keys})
+    carries = {(c.trader_id, c.stock_id): c for c in carries}
+    now = timezone.now()
+    for order in orders:
+        key = (order.trader_id, order.stock_id)
+        carry = carries.get(key)
+        if carry is None:
+            carry = carries[key] = PositionCarry(
+                trader_id=order.trader_id, stock_id=order.stock_id)
+        if order.order_type == 'buy':
+            carry.bought_shares += order.filled_quantity
+            carry.bought_amount += order.amount
+        else:
+            carry.sold_shares += order.filled_quantity
+            carry.sold_amount += order.amount
+        carry.orders += 1
+        if carry.archived_until is None or \
+                order.created_at > carry.archived_until:
+            carry.archived_until = order.created_at
+        carry.updated_at = now
+    PositionCarry.objects.bulk_create(
+        [c for c in carries.values() if c.pk is None])
+    update_many(
+        [c for key, c in carries.items()
+         if key in keys and c.pk is not None],
+        ['bought_shares', 'bought_amount', 'sold_shares', 'sold_amount',
+         'orders', 'archived_until', 'updated_at'])
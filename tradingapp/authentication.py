@@ -0,0 +1,39 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from tradingapp.cache import token_cache
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication backed by a process local cache of token key ->
+    (user, token), with the user's profile joined in by the same query. An
+    authenticated request whose token is cached spends no query on identity,
+    and `request.user.profile` costs none either.
+
+    The cached objects are shared by every request of the token: treat them
+    as read only and read changing fields (e.g. the profile's balance) from
+    the database. Entries are dropped by the receivers in tradingapp.signals
+    when the token is deleted (as /rest-auth/logout/ does) and when the user
+    is saved or deleted, and expire after TOKEN_CACHE_TTL seconds so changes
+    made by other processes are eventually seen.
+    """
+
+    def authenticate_credentials(self, key):
+        entry = token_cache.get(key)
+        if entry is not None:
+            return entry
+
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user__profile').get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+
+        entry = (token.user, token)
+        token_cache.set(key, entry)
+        return entry
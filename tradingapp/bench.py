@@ -0,0 +1,103 @@
+"""
+Helpers shared by the benchmark management commands: a throwaway database,
+fast seeding of traders, stocks and orders, and latency statistics.
+"""
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from rest_framework.authtoken.models import Token
+
+from profiles.models import Profile
+from tradingapp.models import Order, Stock
+
+
+@contextmanager
+def bench_database(keep=False):
+    """
+    Run the block against a freshly migrated database file next to the
+    configured one, never against real data. The file is removed afterwards
+    unless `keep` is true.
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    test_settings['NAME'] = os.path.join(settings.BASE_DIR, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(
+            old_name, verbosity=0, keepdb=keep)
+
+
+def seed(traders, stocks, orders, seed=0, balance=1e9):
+    """
+    Bulk create `traders` users with profiles and tokens, `stocks` stocks
+    and `orders` successful orders spread randomly over them. Positions are
+    rebuilt from the orders afterwards. Returns the list of tokens.
+    """
+    rng = random.Random(seed)
+    User.objects.bulk_create(
+        [User(username=f'bench_{i}') for i in range(traders)])
+    users = list(User.objects.filter(username__startswith='bench_'))
+    Profile.objects.bulk_create(
+        [Profile(user=user, balance=balance) for user in users])
+    Token.objects.bulk_create(
+        [Token(user=user, key=Token().generate_key()) for user in users])
+    Stock.objects.bulk_create(
+        [Stock(name=f'B{i}', price=round(rng.uniform(1, 500), 2),
+               quantity=10 ** 6) for i in range(stocks)])
+
+    profile_ids = list(Profile.objects.values_list('id', flat=True))
+    stock_prices = list(Stock.objects.values_list('id', 'price'))
+    batch = []
+    for _ in range(orders):
+        stock_id, price = rng.choice(stock_prices)
+        quantity = rng.randint(1, 50)
+        batch.append(Order(
+            trader_id=rng.choice(profile_ids), stock_id=stock_id,
+            order_type='buy' if rng.random() < 0.7 else 'sell',
+            quantity=quantity, filled_quantity=quantity,
+            amount=quantity * price))
+        if len(batch) == 5000:
+            Order.objects.bulk_create(batch)
+            batch = []
+    Order.objects.bulk_create(batch)
+    call_command('rebuildpositions', stdout=open(os.devnull, 'w'))
+    return list(Token.objects.values_list('key', flat=True))
+
+
+def percentile(samples, pct):
+    """ Nearest rank percentile of a list of numbers """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1,
+                      int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """ p50 / p95 / p99 / mean of latency samples given in seconds, in ms """
+    return {
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0
+    }
+
+
+class Timer:
+    """ Context manager measuring the wall time of its block """
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
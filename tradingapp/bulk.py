@@ -0,0 +1,25 @@
+from django.db import connection
+
+
+def update_many(objs, fields):
+    """
+    Save `fields` of many saved model instances of the same model with one
+    prepared `UPDATE ... WHERE pk = %s` run through executemany.
+
+    QuerySet.bulk_update builds a CASE expression per field and row, which
+    costs milliseconds per row to compile. This costs microseconds.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    meta = objs[0]._meta
+    fields = [meta.get_field(name) for name in fields]
+    qn = connection.ops.quote_name
+    sql = (f'UPDATE {qn(meta.db_table)} SET '
+           + ', '.join(f'{qn(f.column)} = %s' for f in fields)
+           + f' WHERE {qn(meta.pk.column)} = %s')
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [f.get_db_prep_save(getattr(obj, f.attname), connection)
+             for f in fields] + [obj.pk]
+            for obj in objs])
@@ -0,0 +1,193 @@
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from tradingapp.models import Stock
+
+
+class LRUCache:
+    """
+    Thread safe, bounded least recently used cache. Entries older than `ttl`
+    seconds (if given) are treated as missing. Keeps hit and miss counters.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None \
+                    and entry[0] + self.ttl < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        """ Snapshot of the keys, expired ones included """
+        with self._lock:
+            return list(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize
+            }
+
+
+class StockCache:
+    """
+    Process local cache of Stock objects addressable by primary key and by
+    name. Entries are dropped by the Stock post_save / post_delete receivers
+    in tradingapp.signals once the change is committed. Updates made by
+    other processes are only picked up once the entry expires, so use the
+    cached objects to resolve a stock, not as the source of its current
+    price or quantity.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self._cache = LRUCache(maxsize, ttl)
+        # Bumped by every invalidation, see StockListCache
+        self._generation = 0
+
+    def get(self, pk=None, name=None):
+        """
+        Return the stock with the given pk or name. Raises
+        Stock.DoesNotExist like Stock.objects.get would.
+        """
+        key = ('pk', int(pk)) if pk is not None else ('name', name)
+        stock = self._cache.get(key)
+        if stock is None:
+            generation = self._generation
+            stock = Stock.objects.get(**{key[0]: key[1]})
+            if generation == self._generation:
+                self._cache.set(('pk', stock.pk), stock)
+                self._cache.set(('name', stock.name), stock)
+        return stock
+
+    def invalidate(self, pk, name):
+        self._generation += 1
+        cached = self._cache.delete(('pk', pk))
+        if cached is not None:
+            # The name may have changed since the stock was cached
+            self._cache.delete(('name', cached.name))
+        self._cache.delete(('name', name))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class StockListCache:
+    """
+    Two tier, process local cache of the stock list. The market tier holds
+    the rows of every stock, shared by all traders; the overlay tier holds
+    each trader's `invested` values by stock id. A list is assembled from
+    one entry of each without a query.
+
+    Every entry is stored with a tag that is new whenever it is reloaded,
+    so a (market tag, overlay tag) pair identifies the assembled response.
+    Entries are dropped by the receivers in tradingapp.signals once the
+    change is committed and, like stock_cache's, expire after `ttl`
+    seconds so changes made by other processes are eventually seen.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self._market = LRUCache(1, ttl)
+        self._overlays = LRUCache(maxsize, ttl)
+        self._prefix = uuid.uuid4().hex[:8]
+        self._counter = itertools.count()
+        # Bumped by every invalidation: a load that raced with one isn't
+        # stored, it may have read the rows from before the change
+        self._market_generation = 0
+        self._overlay_generation = 0
+
+    def market(self, load):
+        """ (tag, rows) of the market tier, from `load()` when missing """
+        entry = self._market.get('market')
+        if entry is None:
+            generation = self._market_generation
+            entry = (self._tag(), load())
+            if generation == self._market_generation:
+                self._market.set('market', entry)
+        return entry
+
+    def overlay(self, trader_id, load):
+        """ (tag, overlay) of the trader, from `load()` when missing """
+        entry = self._overlays.get(trader_id)
+        if entry is None:
+            generation = self._overlay_generation
+            entry = (self._tag(), load())
+            if generation == self._overlay_generation:
+                self._overlays.set(trader_id, entry)
+        return entry
+
+    def invalidate_market(self):
+        self._market_generation += 1
+        self._market.clear()
+
+    def invalidate_traders(self, trader_ids):
+        self._overlay_generation += 1
+        for trader_id in trader_ids:
+            self._overlays.delete(trader_id)
+
+    def clear(self):
+        self.invalidate_market()
+        self._overlay_generation += 1
+        self._overlays.clear()
+
+    def stats(self):
+        return {'market': self._market.stats(),
+                'overlays': self._overlays.stats()}
+
+    def _tag(self):
+        return f'{self._prefix}-{next(self._counter)}'
+
+
+stock_cache = StockCache(
+    maxsize=getattr(settings, 'STOCK_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'STOCK_CACHE_TTL', 60))
+
+stock_list_cache = StockListCache(
+    maxsize=getattr(settings, 'STOCK_LIST_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'STOCK_LIST_CACHE_TTL', 5))
+
+# Token key -> (user, token), see tradingapp.authentication
+token_cache = LRUCache(
+    maxsize=getattr(settings, 'TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_CACHE_TTL', 300))
@@ -0,0 +1,183 @@
+"""
+Cost basis of the traders' positions, kept in Lot rows and in the
+`held_shares` / `cost_basis` / `realized_pnl` columns of Position.
+
+Every buy fill opens a lot. Every sell fill consumes the oldest open lots
+and realizes its proceeds minus the cost of the shares sold, which is
+either the cost of the lots it consumed ('fifo') or the position's average
+cost per share ('average'), by the COST_BASIS_METHOD setting. Each fill
+only touches the open lots of its own position, so reading the realized and
+unrealized P&L of a position never aggregates its history.
+"""
+import heapq
+from collections import deque
+from itertools import groupby
+
+from django.conf import settings
+
+from tradingapp.bulk import update_many
+from tradingapp.models import ArchivedOrder, Lot, Order, Position, Trade
+
+METHODS = ('fifo', 'average')
+
+
+class LotBook:
+    """ Open lots and cost totals of one trader's position in one stock """
+
+    def __init__(self, method, lots=(), cost_basis=0.0, realized_pnl=0.0,
+                 shares=None):
+        if method not in METHODS:
+            raise ValueError(f'Unknown cost basis method {method!r}')
+        self.method = method
+        self.lots = deque(lots)  # oldest first
+        # Given when only some of the open lots are loaded
+        self.shares = sum(lot.remaining for lot in self.lots) \
+            if shares is None else shares
+        self.cost_basis = cost_basis
+        self.realized_pnl = realized_pnl
+
+    def buy(self, lot):
+        self.lots.append(lot)
+        self.shares += lot.remaining
+        self.cost_basis += lot.remaining * lot.price
+
+    def sell(self, quantity, proceeds):
+        """ Consume `quantity` shares. Returns the lots that changed """
+        consumed, fifo_cost = [], 0.0
+        left = quantity
+        while left and self.lots:
+            lot = self.lots[0]
+            taken = min(left, lot.remaining)
+            lot.remaining -= taken
+            fifo_cost += taken * lot.price
+            left -= taken
+            consumed.append(lot)
+            if not lot.remaining:
+                self.lots.popleft()
+
+        sold = quantity - left
+        if not self.lots:
+            # Whatever is left of the cost is rounding
+            cost = self.cost_basis
+        elif self.method == 'fifo':
+            cost = fifo_cost
+        else:
+            cost = self.cost_basis * sold / self.shares
+        self.shares -= sold
+        self.cost_basis -= cost
+        self.realized_pnl += proceeds - cost
+        return consumed
+
+    def apply(self, fill):
+        """ Fold a (..., order id, order type, quantity, amount) fill """
+        *_, acquired_at, order_id, order_type, quantity, amount = fill
+        if order_type == 'buy':
+            self.buy(Lot(
+                trader_id=fill[0], stock_id=fill[1], order_id=order_id,
+                quantity=quantity, remaining=quantity,
+                price=amount / quantity, acquired_at=acquired_at))
+            return []
+        return self.sell(quantity, amount)
+
+
+def record_fills(fills):
+    """
+    Fold fills into the lots and positions of their traders. `fills` are
+    (trader id, stock id, filled at, order id, order type, quantity,
+    amount) tuples, in the order they happened. Run it in the transaction
+    that filled them, after their positions were saved.
+    """
+    fills = list(fills)
+    if not fills:
+        return
+    keys = {fill[:2] for fill in fills}
+    traders = {trader_id for trader_id, _ in keys}
+    stocks = {stock_id for _, stock_id in keys}
+    positions = {
+        (p.trader_id, p.stock_id): p for p in Position.objects.filter(
+            trader__in=traders, stock__in=stocks)
+        if (p.trader_id, p.stock_id) in keys}
+
+    open_lots = {key: [] for key in keys}
+    selling = {fill[:2] for fill in fills if fill[4] == 'sell'}
+    if selling:
+        lots = Lot.objects.filter(
+            trader__in={t for t, _ in selling},
+            stock__in={s for _, s in selling}, remaining__gt=0)
+        for lot in lots:
+            if (lot.trader_id, lot.stock_id) in selling:
+                open_lots[lot.trader_id, lot.stock_id].append(lot)
+
+    books = {
+        key: LotBook(settings.COST_BASIS_METHOD, open_lots[key],
+                     position.cost_basis, position.realized_pnl,
+                     position.held_shares)
+        for key, position in positions.items()}
+    created, changed = [], {}
+    for fill in fills:
+        for lot in books[fill[:2]].apply(fill):
+            if lot.pk is None:
+                continue  # bought in this batch, saved as it stands
+            changed[lot.pk] = lot
+        if fill[4] == 'buy':
+            created.append(books[fill[:2]].lots[-1])
+
+    Lot.objects.bulk_create(created)
+    update_many(changed.values(), ['remaining'])
+    for key, book in books.items():
+        positions[key].held_shares = book.shares
+        positions[key].cost_basis = book.cost_basis
+        positions[key].realized_pnl = book.realized_pnl
+    update_many(positions.values(),
+                ['held_shares', 'cost_basis', 'realized_pnl'])
+
+
+def order_fills(orders):
+    """ Fills of filled market orders, for record_fills """
+    return [(o.trader_id, o.stock_id, o.updated_at, o.pk, o.order_type,
+             o.quantity, o.amount) for o in orders]
+
+
+def history(chunk_size=5000):
+    """
+    Every fill ever made, from the market orders (archived or not) and the
+    trades of limit orders, sorted by trader, stock and time
+    """
+    columns = ('trader_id', 'stock_id', 'updated_at', 'id', 'order_type',
+               'quantity', 'amount')
+    market = dict(status='success', limit_price__isnull=True)
+    sources = [
+        q.filter(**market).order_by(
+            'trader_id', 'stock_id', 'updated_at', 'id').values_list(
+                *columns).iterator(chunk_size=chunk_size)
+        for q in (Order.objects.all(), ArchivedOrder.objects.all())]
+    for side in ('buy', 'sell'):
+        sources.append(_trade_fills(side, chunk_size))
+    return heapq.merge(*sources, key=lambda fill: fill[:4])
+
+
+def _trade_fills(side, chunk_size):
+    """ The `side` fills of the limit order trades """
+    trades = Trade.objects.order_by(
+        f'{side}_order__trader_id', 'stock_id', 'created_at',
+        'id').values_list(
+            f'{side}_order__trader_id', 'stock_id', 'created_at',
+            f'{side}_order_id', 'quantity', 'amount').iterator(
+                chunk_size=chunk_size)
+    for trader_id, stock_id, created_at, order_id, quantity, amount in trades:
+        yield (trader_id, stock_id, created_at, order_id, side, quantity,
+               amount)
+
+
+def replay(fills, method):
+    """
+    Rebuild the lot books of `fills`, sorted by trader, stock and time.
+    Yields ((trader id, stock id), LotBook, every lot opened) per position.
+    """
+    for key, position_fills in groupby(fills, key=lambda fill: fill[:2]):
+        book, lots = LotBook(method), []
+        for fill in position_fills:
+            book.apply(fill)
+            if fill[4] == 'buy':
+                lots.append(book.lots[-1])
+        yield key, book, lots
@@ -0,0 +1,77 @@
+"""
+Streaming export of order histories as CSV or NDJSON, shared by the
+/tradingapp/api/orders/export/ endpoint and `manage.py exportorders`.
+
+Orders are read from the Order table and from the order archive with
+QuerySet.iterator(chunk_size), which fetches `chunk_size` rows at a time
+and keeps no result cache. Both are merged by creation time and every row
+is encoded and handed out as soon as it is read. Memory use is the same
+for a hundred orders as for ten million.
+"""
+import csv
+import heapq
+import json
+
+from tradingapp.api.serializers import order_rows, represent_order
+
+# Fields of an exported order, as served by the order endpoints
+EXPORT_FIELDS = ('id', 'trader', 'stock', 'order_type', 'quantity',
+                 'price_per_share', 'amount', 'status', 'remarks',
+                 'limit_price', 'filled_quantity', 'created_at',
+                 'updated_at')
+
+
+def filter_orders(queryset, stocks=(), start=None, end=None):
+    """ Orders of `stocks` (names) created in [start, end) """
+    if stocks:
+        queryset = queryset.filter(stock__name__in=stocks)
+    if start is not None:
+        queryset = queryset.filter(created_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created_at__lt=end)
+    return queryset
+
+
+def export_rows(querysets, chunk_size=2000):
+    """
+    Represented orders of `querysets` (of Order or ArchivedOrder), merged
+    oldest first
+    """
+    streams = [order_rows(q).order_by('created_at', 'id').iterator(
+        chunk_size=chunk_size) for q in querysets]
+    for row in heapq.merge(
+            *streams, key=lambda row: (row['created_at'], row['id'])):
+        yield represent_order(row)
+
+
+class _Line:
+    """ File-like target that hands back what csv.writer writes to it """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(orders):
+    writer = csv.writer(_Line())
+    yield writer.writerow(EXPORT_FIELDS)
+    for order in orders:
+        yield writer.writerow([order[field] for field in EXPORT_FIELDS])
+
+
+def ndjson_lines(orders):
+    for order in orders:
+        yield json.dumps({field: order[field] for field in EXPORT_FIELDS}) \
+            + '\n'
+
+
+# Output name -> (content type, line encoder)
+FORMATS = {
+    'csv': ('text/csv', csv_lines),
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+}
+
+
+def export_lines(querysets, output='csv', chunk_size=2000):
+    """ Lines of text of the orders of `querysets` in `output` format """
+    _, encode = FORMATS[output]
+    return encode(export_rows(querysets, chunk_size))
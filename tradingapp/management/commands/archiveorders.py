@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tradingapp.archive import archive_orders, horizon
+
+
+class Command(BaseCommand):
+    help = ('Move final orders older than the archive horizon to the order '
+            'archive, carrying their totals forward per trader and stock')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '--days', type=int, default=settings.ORDER_ARCHIVE_AFTER_DAYS,
+            help='Archive orders created more than this many days ago')
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Orders archived per transaction')
+
+    def handle(self, *args, **options):
+        before = horizon(options.get('days'))
+        archived = 0
+        while True:
+            count = archive_orders(before, options.get('batch_size'))
+            if not count:
+                break
+            archived += count
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {archived} orders created before {before:%Y-%m-%d}'))
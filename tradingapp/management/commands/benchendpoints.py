@@ -0,0 +1,131 @@
+import json
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from tradingapp.bench import Timer, bench_database, seed, summarize
+from tradingapp.models import Stock
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway database and measure latency, queries and '
+            'allocations per request of the API endpoints')
+
+    metrics = ('p50_ms', 'p95_ms', 'p99_ms', 'queries', 'alloc_kb')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--traders', type=int, default=20)
+        parser.add_argument('--stocks', type=int, default=200)
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument(
+            '--requests', type=int, default=50,
+            help='Timed requests per endpoint')
+        parser.add_argument(
+            '--alloc-requests', type=int, default=5,
+            help='Requests per endpoint traced for allocations')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--budget',
+            help='JSON file of {endpoint: {metric: max}} thresholds')
+        parser.add_argument('--json', help='Also write the results here')
+
+    def handle(self, *args, **options):
+        budget = {}
+        if options.get('budget'):
+            try:
+                with open(options.get('budget')) as f:
+                    budget = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Invalid budget file: {e}')
+
+        setup_test_environment()
+        with bench_database():
+            self.stdout.write('Seeding...')
+            seed(options.get('traders'), options.get('stocks'),
+                 options.get('orders'), seed=options.get('seed'))
+            results = self.run(options)
+
+        self.print_results(results)
+        if options.get('json'):
+            with open(options.get('json'), 'w') as f:
+                json.dump(results, f, indent=2)
+
+        failures = [
+            f'{endpoint} {metric}: {results[endpoint][metric]:.1f} > {limit}'
+            for endpoint, limits in budget.items() if endpoint in results
+            for metric, limit in limits.items()
+            if results[endpoint].get(metric, 0) > limit]
+        if failures:
+            raise CommandError(
+                'Budget exceeded:\n  ' + '\n  '.join(failures))
+        if budget:
+            self.stdout.write(self.style.SUCCESS('All budgets met'))
+
+    def endpoints(self):
+        """ {name: function(profile id) -> url} of the measured requests """
+        stock_id = Stock.objects.values_list('id', flat=True).first()
+        return {
+            'orders-list': lambda pk: reverse('order-list'),
+            'orders-page': lambda pk: reverse('order-list') + '?page_size=50',
+            'stocks-list': lambda pk: reverse('stock-list'),
+            'stock-detail': lambda pk: reverse(
+                'stock-detail', kwargs={'pk': stock_id}),
+            'profile-detail': lambda pk: reverse(
+                'profile', kwargs={'pk': pk}),
+        }
+
+    def run(self, options):
+        client = Client()
+        traders = list(Token.objects.values_list('key', 'user__profile'))
+        results = {}
+
+        for name, url in self.endpoints().items():
+            self.stdout.write(f'Measuring {name}...')
+
+            def get(i):
+                key, profile_id = traders[i % len(traders)]
+                resp = client.get(
+                    url(profile_id), HTTP_AUTHORIZATION=f'Token {key}')
+                if resp.status_code != 200:
+                    raise CommandError(
+                        f'{name} responded {resp.status_code}')
+
+            # Count queries on the warm up request so that query logging
+            # doesn't slow down the timed ones
+            with CaptureQueriesContext(connection) as captured:
+                get(0)
+            queries = len(captured)
+            connection.queries_log.clear()
+
+            samples = []
+            for i in range(options.get('requests')):
+                with Timer() as timer:
+                    get(i)
+                samples.append(timer.elapsed)
+
+            peaks = []
+            tracemalloc.start()
+            for i in range(options.get('alloc_requests')):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                get(i)
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            tracemalloc.stop()
+
+            results[name] = dict(
+                summarize(samples), queries=queries,
+                alloc_kb=max(peaks, default=0) / 1024)
+        return results
+
+    def print_results(self, results):
+        header = f'{"endpoint":<16}' + ''.join(
+            f'{metric:>12}' for metric in self.metrics)
+        self.stdout.write(header)
+        for endpoint, result in results.items():
+            self.stdout.write(f'{endpoint:<16}' + ''.join(
+                f'{result[metric]:>12.1f}' for metric in self.metrics))
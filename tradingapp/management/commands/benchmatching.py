@@ -0,0 +1,87 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from tradingapp.bench import summarize
+from tradingapp.matching import BookOrder, OrderBook
+
+
+class Command(BaseCommand):
+    help = ('Measure matches/sec and per order latency of the in-memory '
+            'order book at several book depths. No database involved')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '--depth', type=int, nargs='+', default=[1000, 100000, 1000000],
+            help='Resting orders in the book before the run')
+        parser.add_argument(
+            '--levels', type=int, default=1000,
+            help='Price levels per side the resting orders are spread over')
+        parser.add_argument(
+            '--orders', type=int, default=50000,
+            help='Incoming orders matched per depth')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f'{"depth":>10}{"orders/s":>12}{"matches/s":>12}'
+            f'{"p50_us":>10}{"p99_us":>10}{"book":>10}')
+        for depth in options.get('depth'):
+            result = self.run(depth, options)
+            self.stdout.write(
+                f'{depth:>10}{result["orders_per_sec"]:>12.0f}'
+                f'{result["matches_per_sec"]:>12.0f}'
+                f'{result["p50_ms"] * 1000:>10.1f}'
+                f'{result["p99_ms"] * 1000:>10.1f}{result["book"]:>10}')
+
+    def run(self, depth, options):
+        rng = random.Random(options.get('seed'))
+        levels = options.get('levels')
+        tick = 0.01
+        ids = iter(range(1, 10 ** 9))
+
+        def passive(side):
+            """ A random order resting away from the spread """
+            offset = rng.randint(1, levels) * tick
+            price = round(100 - offset if side == 'buy' else 100 + offset, 2)
+            return BookOrder(
+                next(ids), rng.randint(1, 100), side, price,
+                rng.randint(1, 100))
+
+        book = OrderBook(1)
+        for i in range(depth):
+            book.add(passive('buy' if i % 2 else 'sell'))
+
+        # Incoming orders cross a few levels into the other side, the rest
+        # rests. Every one is followed by a passive order to keep the depth.
+        incoming = []
+        for _ in range(options.get('orders')):
+            side = 'buy' if rng.random() < 0.5 else 'sell'
+            incoming.append((side, rng.randint(0, 5) * tick,
+                             rng.randint(1, 300), passive(side)))
+
+        samples = []
+        matches = 0
+        started = time.perf_counter()
+        for side, through, quantity, refill in incoming:
+            t0 = time.perf_counter()
+            best = book.best_ask() if side == 'buy' else book.best_bid()
+            if best is None:
+                best = 100
+            price = round(
+                best + through if side == 'buy' else best - through, 2)
+            fills = book.match(side, price, quantity)
+            rest = quantity - sum(f.quantity for f in fills)
+            if rest:
+                book.add(BookOrder(next(ids), 0, side, price, rest))
+            book.add(refill)
+            samples.append(time.perf_counter() - t0)
+            matches += len(fills)
+        elapsed = time.perf_counter() - started
+
+        return dict(
+            summarize(samples),
+            orders_per_sec=len(incoming) / elapsed,
+            matches_per_sec=matches / elapsed,
+            book=len(book))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from profiles.models import Profile
+from tradingapp.api.serializers import (
+    OrderSerializer, order_rows, represent_order)
+from tradingapp.bench import Timer, bench_database, seed
+from tradingapp.cache import stock_cache
+from tradingapp.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Compare rendering a trader\'s order list with OrderSerializer '
+            'and with the fast values() based read path')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--stocks', type=int, default=50)
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Runs per variant, the fastest one is reported')
+
+    def handle(self, *args, **options):
+        with bench_database():
+            seed(1, options.get('stocks'), options.get('orders'))
+            # Same queryset as OrderAPIViewSet.get_queryset
+            orders = Order.objects.filter(trader=Profile.objects.get())
+            variants = {
+                'OrderSerializer': lambda: OrderSerializer(
+                    orders, many=True).data,
+                'OrderSerializer + select_related': lambda: OrderSerializer(
+                    orders.select_related('trader__user', 'stock'),
+                    many=True).data,
+                'order_rows + represent_order': lambda: [
+                    represent_order(row) for row in order_rows(orders)],
+            }
+            results = {name: self.measure(run, options.get('repeat'))
+                       for name, run in variants.items()}
+
+        baseline = results['OrderSerializer'][0]
+        self.stdout.write(f'{options.get("orders")} orders')
+        self.stdout.write(
+            f'{"variant":<36}{"ms":>10}{"queries":>10}{"speedup":>10}')
+        for name, (elapsed, queries) in results.items():
+            self.stdout.write(
+                f'{name:<36}{elapsed * 1000:>10.1f}{queries:>10}'
+                f'{baseline / elapsed:>9.1f}x')
+
+    def measure(self, run, repeat):
+        """ Fastest of `repeat` cold runs, and the queries of one run """
+        stock_cache.clear()
+        with CaptureQueriesContext(connection) as captured:
+            run()
+        queries = len(captured)
+        connection.queries_log.clear()
+
+        best = None
+        for _ in range(repeat):
+            stock_cache.clear()
+            with Timer() as timer:
+                run()
+            if best is None or timer.elapsed < best:
+                best = timer.elapsed
+        return best, queries
@@ -0,0 +1,135 @@
+import multiprocessing
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.test.utils import override_settings
+
+from profiles.models import Profile
+from tradingapp.bench import bench_database, seed, summarize
+from tradingapp.models import Order, Stock
+from tradingapp.services import place_order
+
+# Settings of every compared mode of the SQLite backend
+MODES = {
+    'default': {'SQLITE_PRAGMAS': {}, 'SQLITE_WRITER_LANE': False},
+    'production': {'SQLITE_PRAGMAS': settings.SQLITE_PRODUCTION_PRAGMAS,
+                   'SQLITE_WRITER_LANE': True},
+}
+
+
+def timed_loop(step, seconds):
+    """
+    Run `step` over and over for `seconds`. Returns the latencies of the
+    steps that went through and the number that failed on a lock.
+    """
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            step()
+        except OperationalError:  # database is locked
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+def run_worker(role, mode, seconds, seed, results):
+    """ Writer or reader process, reports (role, latencies, errors) """
+    connections.close_all()
+    override_settings(**MODES[mode]).enable()
+    rng = random.Random(seed)
+    traders = list(Profile.objects.all())
+    stocks = list(Stock.objects.all())
+
+    def write():
+        try:
+            place_order(rng.choice(traders), rng.choice(stocks),
+                        rng.choice(('buy', 'buy', 'sell')),
+                        rng.randint(1, 10))
+        except ValidationError:
+            pass
+
+    def read():
+        list(Order.objects.filter(trader=rng.choice(traders)).values(
+            'id', 'status', 'quantity', 'amount')[:50])
+        list(Stock.objects.values_list('name', 'price'))
+
+    latencies, errors = [], 0
+    try:
+        latencies, errors = timed_loop(
+            write if role == 'write' else read, seconds)
+    finally:
+        # Always report, the parent waits for every worker
+        connections.close_all()
+        results.put((role, latencies, errors))
+
+
+class Command(BaseCommand):
+    help = ('Compare order write and read throughput of the default SQLite '
+            'settings with the production mode (WAL, tuned pragmas and the '
+            'writer lane) under concurrent writer and reader processes')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--traders', type=int, default=50)
+        parser.add_argument('--stocks', type=int, default=20)
+        parser.add_argument(
+            '--orders', type=int, default=10000,
+            help='Orders seeded before the run, for the readers')
+
+    def handle(self, *args, **options):
+        results = {mode: self.run(mode, options) for mode in MODES}
+
+        seconds = options.get('seconds')
+        self.stdout.write(
+            f'{options.get("writers")} writer and {options.get("readers")} '
+            f'reader processes for {seconds:.0f}s')
+        self.stdout.write(
+            f'{"mode":<12}{"orders/s":>10}{"write p95":>11}{"reads/s":>10}'
+            f'{"read p95":>10}{"locked":>8}')
+        for mode, result in results.items():
+            write, read = result['write'], result['read']
+            self.stdout.write(
+                f'{mode:<12}{write["count"] / seconds:>10.0f}'
+                f'{write["p95_ms"]:>9.1f}ms{read["count"] / seconds:>10.0f}'
+                f'{read["p95_ms"]:>8.1f}ms'
+                f'{write["errors"] + read["errors"]:>8}')
+
+    def run(self, mode, options):
+        """ One timed run of `mode` on a fresh database """
+        with bench_database():
+            seed(options.get('traders'), options.get('stocks'),
+                 options.get('orders'))
+            connections.close_all()
+
+            queue = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(
+                    target=run_worker,
+                    args=(role, mode, options.get('seconds'), i, queue))
+                for role, count in (('write', options.get('writers')),
+                                    ('read', options.get('readers')))
+                for i in range(count)]
+            for process in processes:
+                process.start()
+            collected = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+            connections.close_all()
+
+        result = {}
+        for role in ('write', 'read'):
+            latencies = [t for kind, samples, _ in collected if kind == role
+                         for t in samples]
+            result[role] = dict(
+                summarize(latencies), count=len(latencies),
+                errors=sum(e for kind, _, e in collected if kind == role))
+        return result
@@ -0,0 +1,158 @@
+import asyncio
+import multiprocessing
+import resource
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from tradingapp.bench import bench_database, seed, summarize
+from tradingapp.models import Stock
+from tradingapp.stream import STREAM_PATH, StreamServer
+
+
+def run_server(port_queue, poll):
+    """ Stream server process: report the listening port, then serve """
+    connections.close_all()
+
+    async def serve():
+        server = StreamServer(poll_interval=poll)
+        listener = await server.start('127.0.0.1', 0)
+        port_queue.put(listener.sockets[0].getsockname()[1])
+        await listener.serve_forever()
+
+    asyncio.run(serve())
+
+
+def rss_kb(pid):
+    """ Resident memory of a process, in KB """
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class Command(BaseCommand):
+    help = ('Load test the SSE stream: hold many concurrent subscribers on '
+            'one stream server process and time the fan out of price '
+            'updates to all of them')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--subscribers', type=int, default=5000)
+        parser.add_argument(
+            '--events', type=int, default=10,
+            help='Price updates written to the database and timed')
+        parser.add_argument(
+            '--poll', type=float, default=0.05,
+            help='Poll interval of the server, part of the latency')
+        parser.add_argument('--traders', type=int, default=100)
+
+    def handle(self, *args, **options):
+        subscribers = options.get('subscribers')
+        self.poll_ms = options.get('poll') * 1000
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < subscribers + 100:
+            raise CommandError(
+                f'Open file limit {hard} too low for {subscribers} '
+                f'subscribers')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        with bench_database():
+            seed(options.get('traders'), 1, 0)
+            self.stock = Stock.objects.get()
+            self.tokens = list(Token.objects.values_list('key', flat=True))
+            connections.close_all()
+
+            ports = multiprocessing.Queue()
+            server = multiprocessing.Process(
+                target=run_server, args=(ports, options.get('poll')))
+            server.start()
+            try:
+                port = ports.get(timeout=30)
+                results = asyncio.run(self.run(server.pid, port, options))
+            finally:
+                server.terminate()
+                server.join()
+                connections.close_all()
+
+        self.print_results(results)
+
+    async def run(self, pid, port, options):
+        idle_rss = rss_kb(pid)
+        started = time.perf_counter()
+        clients = await asyncio.gather(*[
+            self.connect(port, self.tokens[i % len(self.tokens)])
+            for i in range(options.get('subscribers'))])
+        connect_s = time.perf_counter() - started
+        held_rss = rss_kb(pid)
+
+        loop = asyncio.get_running_loop()
+        latencies, spreads = [], []
+        for i in range(options.get('events')):
+            price = 100 + i
+            # The price change goes through the database like a real one
+            await loop.run_in_executor(None, self.reprice, price)
+            written = time.perf_counter()
+            received = await asyncio.gather(*[
+                self.receive(reader, price) for reader, _ in clients])
+            latencies.extend(t - written for t in received)
+            spreads.append(max(received) - written)
+
+        for _, writer in clients:
+            writer.close()
+        return {
+            'subscribers': len(clients),
+            'connect_s': connect_s,
+            'idle_rss_kb': idle_rss,
+            'held_rss_kb': held_rss,
+            'latency': summarize(latencies),
+            'all_delivered': summarize(spreads),
+        }
+
+    def reprice(self, price):
+        Stock.objects.filter(pk=self.stock.pk).update(
+            price=price, updated_at=timezone.now())
+        connections.close_all()
+
+    async def connect(self, port, token):
+        """ Open a subscription and wait for its current price event """
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(
+            f'GET {STREAM_PATH}?symbols={self.stock.name} HTTP/1.1\r\n'
+            f'Host: localhost\r\nAuthorization: Token {token}\r\n'
+            f'\r\n'.encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise CommandError(f'Subscription refused: {head[:40]!r}')
+        await self.receive(reader, None)
+        return reader, writer
+
+    async def receive(self, reader, price):
+        """ Read events until the price event of `price` (any if None) """
+        while True:
+            event = await reader.readuntil(b'\n\n')
+            if event.startswith(b'event: price') and (
+                    price is None or f'"price": {price}'.encode() in event):
+                return time.perf_counter()
+
+    def print_results(self, results):
+        subscribers = results['subscribers']
+        per_sub = (results['held_rss_kb'] - results['idle_rss_kb']) / \
+            subscribers
+        self.stdout.write(
+            f'{subscribers} concurrent subscribers connected in '
+            f'{results["connect_s"]:.1f}s')
+        self.stdout.write(
+            f'Server RSS {results["idle_rss_kb"] / 1024:.1f} MB idle, '
+            f'{results["held_rss_kb"] / 1024:.1f} MB holding them '
+            f'({per_sub:.1f} KB per subscriber)')
+        for name, label in (('latency', 'Delivery latency'),
+                            ('all_delivered', 'Until all received')):
+            stats = results[name]
+            self.stdout.write(
+                f'{label}: p50 {stats["p50_ms"]:.1f}ms, '
+                f'p95 {stats["p95_ms"]:.1f}ms, p99 {stats["p99_ms"]:.1f}ms '
+                f'(includes the {self.poll_ms:.0f}ms poll interval)')
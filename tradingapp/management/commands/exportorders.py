@@ -0,0 +1,71 @@
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from tradingapp.export import FORMATS, export_lines, filter_orders
+from tradingapp.models import ArchivedOrder, Order
+
+
+def parse_moment(value):
+    """ Aware datetime of an ISO datetime or date (UTC midnight) """
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            return None
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.utc)
+    return moment
+
+
+class Command(BaseCommand):
+    help = ('Export order histories, archived orders included, as CSV or '
+            'NDJSON, streamed in chunks so memory use does not grow with the '
+            'number of orders')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '--trader', help='Username of the trader. Defaults to all')
+        parser.add_argument(
+            '--output', choices=sorted(FORMATS), default='csv')
+        parser.add_argument(
+            '--stock', action='append', dest='stocks', default=[],
+            help='Name of a stock to export. Repeatable, defaults to all')
+        parser.add_argument(
+            '--start', help='ISO date or datetime (UTC), inclusive')
+        parser.add_argument(
+            '--end', help='ISO date or datetime (UTC), exclusive')
+        parser.add_argument(
+            '--chunk-size', type=int,
+            default=settings.ORDER_EXPORT_CHUNK_SIZE)
+        parser.add_argument(
+            '--file', help='Write to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        querysets = [Order.objects.all(), ArchivedOrder.objects.all()]
+        if options.get('trader'):
+            username = options.get('trader')
+            querysets = [q.filter(trader__user__username=username)
+                         for q in querysets]
+        bounds = {}
+        for name in ('start', 'end'):
+            if options.get(name):
+                bounds[name] = parse_moment(options.get(name))
+                if bounds[name] is None:
+                    raise CommandError(
+                        f'--{name} must be an ISO date or datetime')
+        querysets = [filter_orders(q, options.get('stocks'), **bounds)
+                     for q in querysets]
+
+        lines = export_lines(
+            querysets, options.get('output'), options.get('chunk_size'))
+        if not options.get('file'):
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        with open(options.get('file'), 'w', newline='') as out:
+            out.writelines(lines)
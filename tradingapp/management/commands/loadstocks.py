@@ -0,0 +1,160 @@
+import csv
+import json
+import math
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from tradingapp.models import Stock
+from tradingapp.signals import prices_updated
+
+
+class Command(BaseCommand):
+    help = ('Create or update stocks from a CSV or JSONL file of '
+            '`name,price,quantity` rows')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            'path', nargs='?', default='-',
+            help='Stock file. Reads stdin when omitted or "-"')
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl'),
+            help='File format. Guessed from the file extension, else csv')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        fmt = options.get('format')
+        if fmt is None:
+            fmt = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+        chunk_size = options.get('chunk_size')
+        self.default_quantity = Stock._meta.get_field('quantity').default
+        self.max_name_length = Stock._meta.get_field('name').max_length
+
+        try:
+            source = sys.stdin if path == '-' else open(path, newline='')
+        except OSError as e:
+            raise CommandError(e)
+
+        self.created = 0
+        self.updated = 0
+        invalid = 0
+        started = time.monotonic()
+        chunk = {}
+        rows = self.read_jsonl if fmt == 'jsonl' else self.read_csv
+
+        with source:
+            for line_no, row in rows(source):
+                try:
+                    name, price, quantity = self.clean(row)
+                except ValueError as e:
+                    invalid += 1
+                    self.stderr.write(f'Line {line_no}: {e}')
+                    continue
+                # A later row for the same name wins
+                chunk[name] = (price, quantity)
+                if len(chunk) >= chunk_size:
+                    self.upsert(chunk)
+            self.upsert(chunk)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully loaded stocks in '
+            f'{time.monotonic() - started:.2f}s: {self.created} created, '
+            f'{self.updated} updated, {invalid} invalid rows'))
+
+    def read_csv(self, source):
+        """ Yield (line number, dict) of every row. A header is optional """
+        reader = csv.reader(source)
+        fields = ('name', 'price', 'quantity')
+        for row in reader:
+            if not row:
+                continue
+            if reader.line_num == 1 and row[0].strip().lower() == 'name':
+                fields = [column.strip().lower() for column in row]
+                continue
+            yield reader.line_num, dict(zip(fields, row))
+
+    def read_jsonl(self, source):
+        for line_no, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_no, row if isinstance(row, dict) else {}
+
+    def clean(self, row):
+        """ Return (name, price, quantity) or raise ValueError """
+        name = str(row.get('name') or '').strip()
+        if not name:
+            raise ValueError('missing name')
+        if len(name) > self.max_name_length:
+            raise ValueError(
+                f'name "{name}" is longer than {self.max_name_length}')
+        try:
+            price = float(row.get('price'))
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid price "{row.get("price")}"')
+        if not math.isfinite(price) or price <= 0:
+            raise ValueError(f'invalid price {price}')
+        quantity = row.get('quantity')
+        if quantity in (None, ''):
+            quantity = self.default_quantity
+        try:
+            quantity = int(quantity)
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid quantity "{quantity}"')
+        if quantity < 0:
+            raise ValueError(f'negative quantity {quantity}')
+        return name, price, quantity
+
+    def upsert(self, chunk):
+        """
+        Insert the chunk, updating the price and quantity of names that
+        already exist. Uses a single INSERT ... ON CONFLICT statement where
+        the backend supports it, bulk_update + bulk_create otherwise.
+        """
+        if not chunk:
+            return
+        now = timezone.now()
+        with transaction.atomic():
+            existing = list(
+                Stock.objects.filter(name__in=list(chunk)).only('name'))
+            if connection.vendor in ('sqlite', 'postgresql'):
+                self.insert_on_conflict(chunk, now)
+            else:
+                for stock in existing:
+                    stock.price, stock.quantity = chunk[stock.name]
+                    stock.updated_at = now
+                Stock.objects.bulk_update(
+                    existing, ['price', 'quantity', 'updated_at'])
+                known = {stock.name for stock in existing}
+                Stock.objects.bulk_create(
+                    [Stock(name=name, price=price, quantity=quantity)
+                     for name, (price, quantity) in chunk.items()
+                     if name not in known])
+        prices_updated.send(sender=Stock, stocks=existing)
+        self.updated += len(existing)
+        self.created += len(chunk) - len(existing)
+        chunk.clear()
+
+    def insert_on_conflict(self, chunk, now):
+        qn = connection.ops.quote_name
+        columns = ('name', 'price', 'quantity', 'created_at', 'updated_at',
+                   'book_version')
+        sql = (
+            f'INSERT INTO {qn(Stock._meta.db_table)} '
+            f'({", ".join(qn(c) for c in columns)}) '
+            f'VALUES ({", ".join(["%s"] * len(columns))}) '
+            f'ON CONFLICT ({qn("name")}) DO UPDATE SET '
+            + ', '.join(f'{qn(c)} = excluded.{qn(c)}'
+                        for c in ('price', 'quantity', 'updated_at')))
+        now = connection.ops.adapt_datetimefield_value(now)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                sql, [(name, price, quantity, now, now, 0)
+                      for name, (price, quantity) in chunk.items()])
@@ -0,0 +1,178 @@
+import codecs
+import csv
+import io
+import json
+import math
+import os
+import select
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from tradingapp.models import Stock
+from tradingapp.signals import prices_updated
+
+# Yielded by the feed readers when no line came before the flush was due
+IDLE = object()
+
+
+def parse_price(value):
+    """ A tick's price as a float. Raises ValueError unless finite and > 0 """
+    price = float(value)
+    if not math.isfinite(price) or price <= 0:
+        raise ValueError(f'invalid price {price}')
+    return price
+
+
+class Command(BaseCommand):
+    help = ('Stream a CSV or JSONL price feed (file or stdin) and apply the '
+            'latest price of every symbol in batches')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            'path', nargs='?', default='-',
+            help='Feed file. Reads stdin when omitted or "-"')
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl'),
+            help='Feed format. Guessed from the file extension, else csv')
+        parser.add_argument(
+            '--window', type=float, default=1.0,
+            help='Seconds of ticks to coalesce per symbol before writing')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--report-every', type=float, default=10.0,
+            help='Seconds between progress reports')
+
+    def handle(self, *args, **options):
+        path = options.get('path')
+        fmt = options.get('format')
+        if fmt is None:
+            fmt = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+        self.batch_size = options.get('batch_size')
+        window = options.get('window')
+        report_every = options.get('report_every')
+
+        try:
+            feed = sys.stdin if path == '-' else open(path, newline='')
+        except OSError as e:
+            raise CommandError(e)
+
+        self.updated = 0
+        self.unknown = 0
+        ticks = 0
+        invalid = 0
+        pending = {}
+        started = time.monotonic()
+        flushed_at = reported_at = started
+        parse = self.parse_jsonl if fmt == 'jsonl' else self.parse_csv
+
+        def flush_due():
+            """ Seconds until the pending prices must be written """
+            if not pending:
+                return None
+            return max(0, flushed_at + window - time.monotonic())
+
+        with feed:
+            for tick in parse(self.read_lines(feed, flush_due)):
+                if tick is None:
+                    invalid += 1
+                elif tick is not IDLE:
+                    # Only the last price of a symbol within a window matters
+                    symbol, price = tick
+                    pending[symbol] = price
+                    ticks += 1
+
+                # Also reached when the feed is idle, so a quiet or `tail -f`
+                # feed still has its last window written
+                now = time.monotonic()
+                if pending and now - flushed_at >= window:
+                    self.flush(pending)
+                    flushed_at = now
+                if now - reported_at >= report_every:
+                    self.report(ticks, invalid, now - started)
+                    reported_at = now
+            self.flush(pending)
+
+        self.report(ticks, invalid, time.monotonic() - started)
+        self.stdout.write(self.style.SUCCESS('Successfully loaded price feed'))
+
+    def read_lines(self, feed, timeout):
+        """
+        Yield the lines of `feed` in chunks of what could be read at once,
+        or IDLE when nothing came within `timeout()` seconds (None waits)
+        """
+        try:
+            fd = feed.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            yield feed  # in memory, never idle
+            return
+        decoder = codecs.getincrementaldecoder(
+            getattr(feed, 'encoding', None) or 'utf-8')()
+        rest = ''
+        while True:
+            ready, _, _ = select.select([fd], [], [], timeout())
+            if not ready:
+                yield IDLE
+                continue
+            data = os.read(fd, 1 << 16)
+            if not data:
+                break
+            *lines, rest = (rest + decoder.decode(data)).split('\n')
+            yield lines
+        rest += decoder.decode(b'', final=True)
+        if rest:
+            yield [rest]
+
+    def parse_csv(self, chunks):
+        """ Yield (symbol, price) of every `symbol,price[,...]` row """
+        for chunk in chunks:
+            if chunk is IDLE:
+                yield IDLE
+                continue
+            for row in csv.reader(chunk):
+                if not row or row[0].lower() in ('symbol', 'name'):
+                    continue  # blank line or header
+                try:
+                    yield row[0].strip(), parse_price(row[1])
+                except (IndexError, ValueError):
+                    yield None
+
+    def parse_jsonl(self, chunks):
+        """ Yield (symbol, price) of every {"symbol": .., "price": ..} line """
+        for chunk in chunks:
+            if chunk is IDLE:
+                yield IDLE
+                continue
+            for line in chunk:
+                if not line.strip():
+                    continue
+                try:
+                    tick = json.loads(line)
+                    symbol = tick.get('symbol', tick.get('name'))
+                    yield str(symbol), parse_price(tick['price'])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    yield None
+
+    def flush(self, pending):
+        """ Write the coalesced prices with bulk_update and clear them """
+        symbols = list(pending)
+        now = timezone.now()
+        for i in range(0, len(symbols), self.batch_size):
+            chunk = symbols[i:i + self.batch_size]
+            stocks = list(Stock.objects.filter(name__in=chunk).only('name'))
+            for stock in stocks:
+                stock.price = pending[stock.name]
+                stock.updated_at = now
+            Stock.objects.bulk_update(stocks, ['price', 'updated_at'])
+            self.updated += len(stocks)
+            self.unknown += len(chunk) - len(stocks)
+            prices_updated.send(sender=Stock, stocks=stocks)
+        pending.clear()
+
+    def report(self, ticks, invalid, elapsed):
+        rate = ticks / elapsed if elapsed else 0
+        self.stdout.write(
+            f'{ticks} ticks ({rate:.0f} ticks/sec), {invalid} invalid, '
+            f'{self.updated} price updates, {self.unknown} unknown symbols')
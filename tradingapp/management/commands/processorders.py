@@ -0,0 +1,61 @@
+import multiprocessing
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+from tradingapp.services import fill_pending_orders
+
+
+def drain(batch_size, poll, once):
+    """
+    Fill pending orders batch by batch, polling every `poll` seconds when
+    the queue is empty. With `once`, returns as soon as the queue is
+    empty. Returns the number of orders processed.
+    """
+    processed = 0
+    while True:
+        try:
+            count = fill_pending_orders(batch_size)
+        except OperationalError as e:
+            # Database busy for longer than its timeout, try again
+            sys.stderr.write(f'Batch failed: {e}\n')
+            count = None
+        if count:
+            processed += count
+        elif once and count == 0:
+            return processed
+        else:
+            time.sleep(poll)
+
+
+class Command(BaseCommand):
+    help = ('Fill the market orders queued as pending by the order endpoint '
+            '(ORDER_QUEUE mode), in batches, with a pool of worker processes')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Orders filled per transaction')
+        parser.add_argument(
+            '--poll', type=float, default=0.5,
+            help='Seconds to wait when the queue is empty')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the queue is drained instead of polling')
+
+    def handle(self, *args, **options):
+        args = (options.get('batch_size'), options.get('poll'),
+                options.get('once'))
+        workers = options.get('workers')
+        if workers <= 1:
+            processed = drain(*args)
+        else:
+            # Children must not share the parent's database connections
+            connections.close_all()
+            with multiprocessing.Pool(workers) as pool:
+                processed = sum(pool.starmap(drain, [args] * workers))
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully processed %d orders' % processed))
@@ -0,0 +1,86 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from tradingapp.models import ArchivedOrder, Order, Stock, StockBar, Trade
+from tradingapp.rollups import aggregate
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the OHLCV bars of every stock from the order history'
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '--since',
+            help='YYYY-MM-DD. Only rebuild bars from this UTC day on')
+        parser.add_argument(
+            '--stock', action='append', dest='stocks', default=[],
+            help='Name of a stock to rebuild. Repeatable, defaults to all')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Rows per INSERT. Defaults to the backend maximum')
+
+    def handle(self, *args, **options):
+        # Market orders fill at once, limit orders trade through fills.
+        # Old market orders may have been archived. A queued market order
+        # last changed when it filled, a trade when it was made
+        market = dict(status='success', limit_price__isnull=True)
+        sources = [(Order.objects.filter(**market), 'updated_at'),
+                   (ArchivedOrder.objects.filter(**market), 'updated_at'),
+                   (Trade.objects.all(), 'created_at')]
+        bars = StockBar.objects.all()
+
+        if options.get('stocks'):
+            stock_ids = list(Stock.objects.filter(
+                name__in=options.get('stocks')).values_list('id', flat=True))
+            if len(stock_ids) != len(set(options.get('stocks'))):
+                raise CommandError('Unknown stock')
+            sources = [(q.filter(stock__in=stock_ids), filled_at)
+                       for q, filled_at in sources]
+            bars = bars.filter(stock__in=stock_ids)
+
+        if options.get('since'):
+            since = parse_date(options.get('since'))
+            if since is None:
+                raise CommandError('--since must be YYYY-MM-DD')
+            # Start on a UTC day boundary so no rebuilt bar is partial
+            since = datetime.combine(since, time.min, tzinfo=timezone.utc)
+            sources = [(q.filter(**{f'{filled_at}__gte': since}), filled_at)
+                       for q, filled_at in sources]
+            bars = bars.filter(start__gte=since)
+
+        first, *others = [
+            q.order_by().values_list(
+                'stock_id', filled_at, 'quantity', 'amount')
+            for q, filled_at in sources]
+        # The union's columns are named after the first query's
+        trades = first.union(*others, all=True).order_by(
+            'stock_id', 'updated_at').iterator(
+                chunk_size=options.get('chunk_size'))
+
+        created = 0
+        with transaction.atomic():
+            bars.delete()
+            # Orders come sorted by stock, write each stock's bars as soon
+            # as its orders are folded to bound memory
+            current, pending = None, {}
+            for trade in trades:
+                if trade[0] != current:
+                    created += self.write(pending, options)
+                    current, pending = trade[0], {}
+                aggregate([trade], pending)
+            created += self.write(pending, options)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully rebuilt %d bars' % created))
+
+    def write(self, bars, options):
+        StockBar.objects.bulk_create(
+            [StockBar(stock_id=stock_id, interval=interval, start=start, **bar)
+             for (stock_id, interval, start), bar in bars.items()],
+            batch_size=options.get('batch_size'))
+        return len(bars)
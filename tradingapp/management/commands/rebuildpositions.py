@@ -0,0 +1,60 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
+
+from tradingapp.models import Order, Position, PositionCarry
+
+
+class Command(BaseCommand):
+    help = ('Rebuild every trader position from the order history and the '
+            'totals carried forward from archived orders')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Rows per INSERT. Defaults to the backend maximum')
+
+    def handle(self, *args, **options):
+        buy = Q(order_type='buy')
+        sell = Q(order_type='sell')
+        # Shares of resting sell orders are reserved, they count as sold
+        resting_sell = sell & Q(status__in=Order.RESTING_STATUSES)
+        totals = Order.objects.filter(
+            Q(filled_quantity__gt=0) | resting_sell).order_by().values(
+                'trader', 'stock').annotate(
+                    bought_shares=Coalesce(
+                        Sum('filled_quantity', filter=buy), 0),
+                    bought_amount=Coalesce(Sum('amount', filter=buy), 0.0),
+                    sold_shares=Coalesce(
+                        Sum('filled_quantity', filter=sell), 0) + Coalesce(
+                            Sum(F('quantity') - F('filled_quantity'),
+                                filter=resting_sell), 0),
+                    sold_amount=Coalesce(Sum('amount', filter=sell), 0.0))
+
+        positions = {}
+        for row in totals:
+            key = (row.pop('trader'), row.pop('stock'))
+            positions[key] = Position(
+                trader_id=key[0], stock_id=key[1], **row)
+        for carry in PositionCarry.objects.all():
+            key = (carry.trader_id, carry.stock_id)
+            position = positions.get(key)
+            if position is None:
+                position = positions[key] = Position(
+                    trader_id=key[0], stock_id=key[1])
+            position.bought_shares += carry.bought_shares
+            position.bought_amount += carry.bought_amount
+            position.sold_shares += carry.sold_shares
+            position.sold_amount += carry.sold_amount
+
+        with transaction.atomic():
+            Position.objects.all().delete()
+            positions = Position.objects.bulk_create(
+                positions.values(), batch_size=options.get('batch_size'))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully rebuilt %d positions' % len(positions)))
+        # The new positions start without a cost basis
+        call_command('rebuildlots', stdout=self.stdout)
@@ -0,0 +1,32 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from tradingapp.stream import STREAM_PATH, StreamServer
+
+
+class Command(BaseCommand):
+    help = ('Serve the Server-Sent Events stream of stock prices and order '
+            'status changes')
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument(
+            '--poll', type=float, default=0.5,
+            help='Seconds between two polls of the database for changes')
+        parser.add_argument(
+            '--queue-size', type=int, default=1000,
+            help='Events buffered per subscriber before dropping')
+
+    def handle(self, *args, **options):
+        server = StreamServer(options.get('poll'), options.get('queue_size'))
+        self.stdout.write(
+            f'Streaming on http://{options.get("host")}:'
+            f'{options.get("port")}{STREAM_PATH}')
+        asyncio.run(self.serve(server, options))
+
+    async def serve(self, server, options):
+        listener = await server.start(options.get('host'), options.get('port'))
+        async with listener:
+            await listener.serve_forever()
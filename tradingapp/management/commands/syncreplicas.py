@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from trading.replicas import sync_replica
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database into the SQLite files standing '
+            'in for the read replicas (DATABASE_REPLICAS)')
+
+    def handle(self, *args, **options):
+        if not settings.READ_REPLICAS:
+            raise CommandError('No replicas, set DATABASE_REPLICAS')
+        for alias in ['default'] + settings.READ_REPLICAS:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'{alias} is not an SQLite database')
+        for alias in settings.READ_REPLICAS:
+            sync_replica(alias)
+            self.stdout.write(
+                f'{alias}: {connections[alias].settings_dict["NAME"]}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Synced {len(settings.READ_REPLICAS)} replicas'))
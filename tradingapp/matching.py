@@ -0,0 +1,197 @@
+"""
+In-memory limit order books with price-time priority matching.
+
+Every stock has an OrderBook holding its resting limit orders. Each side
+keeps a FIFO queue of orders per price level and a heap of its price levels,
+so the best bid / ask is read in O(1), a new price level costs O(log n) and
+matching consumes the front of the best level.
+
+The books are a cache of the resting orders stored in the database
+(Order.status in Order.RESTING_STATUSES): a book is loaded on first use and
+rebuilt from the committed rows whenever the database writes of a match
+fail. Every process has its own books. Each change to a
+stock's resting orders bumps Stock.book_version in the transaction making
+it, and a book whose version is behind is reloaded before it is matched
+against, so several processes can match the same stock.
+"""
+import heapq
+import threading
+from collections import deque
+
+from tradingapp.models import Order
+
+
+class StaleBook(Exception):
+    """ A book matched against an order that is no longer resting """
+
+
+class BookOrder:
+    """ The part of a resting limit order the matching engine needs """
+    __slots__ = ('id', 'trader_id', 'side', 'price', 'remaining')
+
+    def __init__(self, id, trader_id, side, price, remaining):
+        self.id = id
+        self.trader_id = trader_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+
+    def __repr__(self):
+        return (f'BookOrder({self.id}, {self.side} {self.remaining} '
+                f'@ {self.price})')
+
+
+class Fill:
+    """ `quantity` shares of the resting `maker` order filled at `price` """
+    __slots__ = ('maker', 'quantity', 'price')
+
+    def __init__(self, maker, quantity, price):
+        self.maker = maker
+        self.quantity = quantity
+        self.price = price
+
+
+class _Side:
+    """ Price levels of one side of a book, best price first """
+
+    def __init__(self, best_is_highest):
+        self.sign = -1 if best_is_highest else 1
+        self.levels = {}  # price -> deque of BookOrder, oldest first
+        self.prices = []  # heap of sign * price, may hold emptied levels
+
+    def best(self):
+        prices = self.prices
+        while prices and self.sign * prices[0] not in self.levels:
+            heapq.heappop(prices)  # level emptied since it was pushed
+        return self.sign * prices[0] if prices else None
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = deque()
+            heapq.heappush(self.prices, self.sign * order.price)
+        level.append(order)
+
+    def remove(self, order):
+        level = self.levels[order.price]
+        level.remove(order)
+        if not level:
+            del self.levels[order.price]
+
+    def depth(self, levels):
+        """ [(price, shares, orders)] of the best `levels` price levels """
+        best = sorted(self.levels, key=lambda p: self.sign * p)[:levels]
+        return [(price, sum(o.remaining for o in self.levels[price]),
+                 len(self.levels[price])) for price in best]
+
+
+class OrderBook:
+    """ Resting limit orders of one stock """
+
+    def __init__(self, stock_id):
+        self.stock_id = stock_id
+        self.version = None  # Stock.book_version the book reflects
+        self.bids = _Side(best_is_highest=True)
+        self.asks = _Side(best_is_highest=False)
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def add(self, order):
+        """ Rest `order` behind every order already at its price """
+        (self.bids if order.side == 'buy' else self.asks).add(order)
+        self.orders[order.id] = order
+
+    def cancel(self, order_id):
+        """ Remove a resting order. Returns it, or None if it isn't here """
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            (self.bids if order.side == 'buy' else self.asks).remove(order)
+        return order
+
+    def match(self, side, price, quantity):
+        """
+        Match an incoming `side` order of `quantity` shares limited to
+        `price` against the opposite side, best price first and oldest
+        first within a price. Filled resting orders leave the book. Returns
+        the list of Fills, the unfilled rest is left to the caller.
+        """
+        if side == 'buy':
+            book, crosses = self.asks, lambda best: best <= price
+        else:
+            book, crosses = self.bids, lambda best: best >= price
+
+        fills = []
+        while quantity:
+            best = book.best()
+            if best is None or not crosses(best):
+                break
+            level = book.levels[best]
+            while quantity and level:
+                maker = level[0]
+                filled = min(quantity, maker.remaining)
+                maker.remaining -= filled
+                quantity -= filled
+                fills.append(Fill(maker, filled, best))
+                if not maker.remaining:
+                    level.popleft()
+                    del self.orders[maker.id]
+            if not level:
+                del book.levels[best]
+        return fills
+
+    def depth(self, levels=10):
+        return {'bids': self.bids.depth(levels),
+                'asks': self.asks.depth(levels)}
+
+
+class MatchingEngine:
+    """
+    Order books of every stock, loaded lazily from the database. Callers
+    hold `lock` while they read or change a book, the database writes of a
+    change are ordered by the transactions making them.
+    """
+
+    def __init__(self):
+        self.books = {}
+        self.lock = threading.RLock()
+
+    def book(self, stock_id, version=None):
+        """
+        The stock's book, reloaded from the database unless it reflects
+        Stock.book_version `version`. Any book will do if `version` is None.
+        """
+        book = self.books.get(stock_id)
+        if book is None or (version is not None and book.version != version):
+            book = self.books[stock_id] = self.load(stock_id)
+            book.version = version
+        return book
+
+    def load(self, stock_id):
+        """ Rebuild a book from the stock's resting orders, oldest first """
+        book = OrderBook(stock_id)
+        rows = Order.objects.filter(
+            stock_id=stock_id, status__in=Order.RESTING_STATUSES).order_by(
+                'created_at', 'id').values_list(
+                    'id', 'trader_id', 'order_type', 'limit_price', 'quantity',
+                    'filled_quantity')
+        for pk, trader_id, side, price, quantity, filled in rows:
+            book.add(BookOrder(pk, trader_id, side, price, quantity - filled))
+        return book
+
+    def discard(self, stock_id):
+        """ Forget a book, it is reloaded from the database on next use """
+        self.books.pop(stock_id, None)
+
+    def clear(self):
+        self.books.clear()
+
+
+engine = MatchingEngine()
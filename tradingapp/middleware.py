@@ -0,0 +1,124 @@
+import cProfile
+import hmac
+import io
+import json
+import marshal
+import pstats
+import random
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from tradingapp.models import RequestProfile
+
+
+class ProfilingMiddleware:
+    """
+    Profile a sampled fraction of requests (PROFILING_SAMPLE_RATE) and every
+    request whose X-Profile header matches PROFILING_TOKEN.
+
+    A profiled request records cProfile stats, every SQL statement with its
+    duration and the time spent in serializers. The timings are sent back
+    in a Server-Timing header and the report is stored as a RequestProfile,
+    which can be browsed and downloaded from the admin.
+    """
+    header = 'HTTP_X_PROFILE'
+    serializer_files = ('rest_framework/serializers.py', '/serializers.py')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        queries = []
+
+        def record_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append({
+                    'sql': sql,
+                    'ms': (time.perf_counter() - started) * 1000,
+                    'db': context['connection'].alias
+                })
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(record_query))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        total_ms = (time.perf_counter() - started) * 1000
+
+        stats = pstats.Stats(profiler)
+        sql_ms = sum(q['ms'] for q in queries)
+        serializer_ms = self.serializer_time(stats)
+        response['Server-Timing'] = ', '.join([
+            f'total;dur={total_ms:.1f}',
+            f'sql;dur={sql_ms:.1f};desc="{len(queries)} queries"',
+            f'serializer;dur={serializer_ms:.1f}',
+        ])
+        self.save_report(request, response, stats, queries, total_ms,
+                         sql_ms, serializer_ms)
+        return response
+
+    def should_profile(self, request):
+        token = getattr(settings, 'PROFILING_TOKEN', None)
+        header = request.META.get(self.header)
+        if token and header and hmac.compare_digest(header, token):
+            return True
+        rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        return rate > 0 and random.random() < rate
+
+    def is_serializer(self, func):
+        return func[0].endswith(self.serializer_files)
+
+    def serializer_time(self, stats):
+        """
+        Milliseconds spent in serializers: the cumulative time of serializer
+        functions, counting only calls made from outside serializer code so
+        nested serializer calls are not counted twice.
+        """
+        total = 0
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not self.is_serializer(func):
+                continue
+            for caller, caller_stats in callers.items():
+                if not self.is_serializer(caller):
+                    total += caller_stats[3]
+        return total * 1000
+
+    def hotspots(self, stats, limit=10):
+        """ Cumulative milliseconds of the slowest app serializer methods """
+        spots = [
+            (f'{func[2]} ({func[0].rsplit("/", 2)[-2]}:{func[1]})', ct * 1000)
+            for func, (cc, nc, tt, ct, callers) in stats.stats.items()
+            if func[0].endswith('/api/serializers.py')]
+        return dict(sorted(spots, key=lambda s: -s[1])[:limit])
+
+    def save_report(self, request, response, stats, queries, total_ms,
+                    sql_ms, serializer_ms):
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(40)
+        RequestProfile.objects.create(
+            method=request.method,
+            path=request.get_full_path()[:255],
+            status_code=response.status_code,
+            duration_ms=total_ms,
+            sql_count=len(queries),
+            sql_ms=sql_ms,
+            serializer_ms=serializer_ms,
+            hotspots=json.dumps(self.hotspots(stats), indent=2),
+            queries=json.dumps(queries, indent=2),
+            summary=summary.getvalue(),
+            stats=marshal.dumps(stats.stats))
@@ -0,0 +1,52 @@
+# Generated by Django 2.2 on 2026-10-18 15:27
+
+from django.db import migrations, models
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def open_positions(apps, schema_editor):
+    """ Positions of the traders who already placed orders """
+    Order = apps.get_model('tradingapp', 'Order')
+    Position = apps.get_model('tradingapp', 'Position')
+    buy = Q(order_type='buy')
+    sell = Q(order_type='sell')
+    totals = Order.objects.filter(status='success').order_by().values(
+        'trader', 'stock').annotate(
+            bought_shares=Coalesce(Sum('quantity', filter=buy), 0),
+            bought_amount=Coalesce(Sum('amount', filter=buy), 0.0),
+            sold_shares=Coalesce(Sum('quantity', filter=sell), 0),
+            sold_amount=Coalesce(Sum('amount', filter=sell), 0.0))
+    Position.objects.bulk_create(
+        [Position(trader_id=row.pop('trader'), stock_id=row.pop('stock'),
+                  **row) for row in totals.iterator()],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0001_initial'),
+        ('tradingapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Position',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bought_shares', models.IntegerField(default=0)),
+                ('bought_amount', models.FloatField(default=0)),
+                ('sold_shares', models.IntegerField(default=0)),
+                ('sold_amount', models.FloatField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='positions', to='tradingapp.Stock')),
+                ('trader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='positions', to='profiles.Profile')),
+            ],
+            options={
+                'unique_together': {('trader', 'stock')},
+            },
+        ),
+        migrations.RunPython(open_positions, migrations.RunPython.noop),
+    ]
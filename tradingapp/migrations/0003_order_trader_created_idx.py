@@ -0,0 +1,21 @@
+# Generated by Django 2.2 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0002_position'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='order',
+            options={'ordering': ('-created_at', '-id')},
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['trader', '-created_at', '-id'], name='order_trader_created_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2 on 2026-10-18 15:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0003_order_trader_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=10)),
+                ('path', models.CharField(max_length=255)),
+                ('status_code', models.IntegerField()),
+                ('duration_ms', models.FloatField()),
+                ('sql_count', models.IntegerField()),
+                ('sql_ms', models.FloatField()),
+                ('serializer_ms', models.FloatField()),
+                ('hotspots', models.TextField(blank=True)),
+                ('queries', models.TextField(blank=True)),
+                ('summary', models.TextField(blank=True)),
+                ('stats', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2 on 2026-10-18 15:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0004_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockBar',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('start', models.DateTimeField()),
+                ('open', models.FloatField()),
+                ('high', models.FloatField()),
+                ('low', models.FloatField()),
+                ('close', models.FloatField()),
+                ('volume', models.IntegerField(default=0)),
+                ('notional', models.FloatField(default=0)),
+                ('trades', models.IntegerField(default=0)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bars', to='tradingapp.Stock')),
+            ],
+            options={
+                'ordering': ('stock', 'interval', 'start'),
+                'unique_together': {('stock', 'interval', 'start')},
+            },
+        ),
+    ]
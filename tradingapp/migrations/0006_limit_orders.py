@@ -0,0 +1,64 @@
+# Generated by Django 2.2 on 2026-10-18 15:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_market_orders(apps, schema_editor):
+    """ Every existing order is a market order, filled in full """
+    Order = apps.get_model('tradingapp', 'Order')
+    Order.objects.update(filled_quantity=models.F('quantity'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0005_stockbar'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trade',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.FloatField()),
+                ('quantity', models.IntegerField()),
+                ('amount', models.FloatField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ('created_at', 'id'),
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='filled_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='limit_price',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['stock', 'status', 'created_at', 'id'], name='order_stock_status_idx'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='buy_order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='buy_trades', to='tradingapp.Order'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='sell_order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sell_trades', to='tradingapp.Order'),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='stock',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trades', to='tradingapp.Stock'),
+        ),
+        migrations.RunPython(fill_market_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2 on 2026-10-18 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0007_order_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['trader', 'updated_at'], name='order_trader_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 2.2 on 2026-10-18 16:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_cash_ledger'),
+        ('tradingapp', '0008_order_trader_updated_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('order_type', models.CharField(choices=[('buy', 'Buy'), ('sell', 'Sell')], max_length=4)),
+                ('quantity', models.IntegerField()),
+                ('amount', models.FloatField()),
+                ('status', models.CharField(blank=True, max_length=10, null=True)),
+                ('remarks', models.TextField(blank=True, null=True)),
+                ('limit_price', models.FloatField(blank=True, null=True)),
+                ('filled_quantity', models.IntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to='tradingapp.Stock')),
+                ('trader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to='profiles.Profile')),
+            ],
+            options={
+                'ordering': ('-created_at', '-id'),
+            },
+        ),
+        migrations.CreateModel(
+            name='PositionCarry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bought_shares', models.IntegerField(default=0)),
+                ('bought_amount', models.FloatField(default=0)),
+                ('sold_shares', models.IntegerField(default=0)),
+                ('sold_amount', models.FloatField(default=0)),
+                ('orders', models.IntegerField(default=0)),
+                ('archived_until', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_carries', to='tradingapp.Stock')),
+                ('trader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='position_carries', to='profiles.Profile')),
+            ],
+            options={
+                'unique_together': {('trader', 'stock')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedorder',
+            index=models.Index(fields=['trader', '-created_at', '-id'], name='archivedorder_trader_idx'),
+        ),
+    ]
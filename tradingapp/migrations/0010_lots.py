@@ -0,0 +1,45 @@
+# Generated by Django 2.2 on 2026-10-18 16:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0002_cash_ledger'),
+        ('tradingapp', '0009_order_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='position',
+            name='cost_basis',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='realized_pnl',
+            field=models.FloatField(default=0),
+        ),
+        migrations.CreateModel(
+            name='Lot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.IntegerField()),
+                ('quantity', models.IntegerField()),
+                ('remaining', models.IntegerField()),
+                ('price', models.FloatField()),
+                ('acquired_at', models.DateTimeField()),
+                ('stock', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='tradingapp.Stock')),
+                ('trader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='profiles.Profile')),
+            ],
+            options={
+                'ordering': ('acquired_at', 'id'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='lot',
+            index=models.Index(fields=['trader', 'stock', 'remaining'], name='lot_open_idx'),
+        ),
+    ]
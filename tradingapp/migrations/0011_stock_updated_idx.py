@@ -0,0 +1,17 @@
+# Generated by Django 2.2 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0010_lots'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stock',
+            index=models.Index(fields=['updated_at'], name='stock_updated_idx'),
+        ),
+    ]
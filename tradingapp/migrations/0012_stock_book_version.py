@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0011_stock_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='book_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
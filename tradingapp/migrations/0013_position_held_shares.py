@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0012_stock_book_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='position',
+            name='held_shares',
+            field=models.IntegerField(default=0),
+        ),
+    ]
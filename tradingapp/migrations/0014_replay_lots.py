@@ -0,0 +1,135 @@
+import heapq
+from collections import deque
+from itertools import groupby
+
+from django.conf import settings
+from django.db import migrations
+
+# Rows read and written per query
+CHUNK_SIZE = 2000
+
+
+def history(apps):
+    """
+    Every fill ever made, sorted by trader, stock and time, as
+    (trader id, stock id, filled at, order id, order type, quantity, amount)
+    """
+    Order = apps.get_model('tradingapp', 'Order')
+    ArchivedOrder = apps.get_model('tradingapp', 'ArchivedOrder')
+    Trade = apps.get_model('tradingapp', 'Trade')
+    sources = [
+        model.objects.filter(
+            status='success', limit_price__isnull=True).order_by(
+                'trader_id', 'stock_id', 'updated_at', 'id').values_list(
+                    'trader_id', 'stock_id', 'updated_at', 'id',
+                    'order_type', 'quantity', 'amount').iterator(
+                        chunk_size=CHUNK_SIZE)
+        for model in (Order, ArchivedOrder)]
+    for side in ('buy', 'sell'):
+        sources.append(trade_fills(Trade, side))
+    return heapq.merge(*sources, key=lambda fill: fill[:4])
+
+
+def trade_fills(Trade, side):
+    """ The `side` fills of the limit order trades """
+    trades = Trade.objects.order_by(
+        f'{side}_order__trader_id', 'stock_id', 'created_at',
+        'id').values_list(
+            f'{side}_order__trader_id', 'stock_id', 'created_at',
+            f'{side}_order_id', 'quantity', 'amount').iterator(
+                chunk_size=CHUNK_SIZE)
+    for trader_id, stock_id, created_at, order_id, quantity, amount in trades:
+        yield (trader_id, stock_id, created_at, order_id, side, quantity,
+               amount)
+
+
+def replay(fills, method):
+    """
+    The cost basis of every position of `fills`, the way it was computed
+    when the lots were introduced. Yields ((trader id, stock id), held
+    shares, cost basis, realized P&L, lots) per position, the lots as
+    [order id, quantity, remaining, price, acquired at].
+    """
+    for key, position_fills in groupby(fills, key=lambda fill: fill[:2]):
+        lots, open_lots = [], deque()
+        shares, cost_basis, realized_pnl = 0, 0.0, 0.0
+        for *_, filled_at, order_id, order_type, quantity, amount in \
+                position_fills:
+            if order_type == 'buy':
+                lot = [order_id, quantity, quantity, amount / quantity,
+                       filled_at]
+                lots.append(lot)
+                open_lots.append(lot)
+                shares += quantity
+                cost_basis += quantity * lot[3]
+                continue
+
+            # Sells consume the oldest open lots
+            left, fifo_cost = quantity, 0.0
+            while left and open_lots:
+                lot = open_lots[0]
+                taken = min(left, lot[2])
+                lot[2] -= taken
+                fifo_cost += taken * lot[3]
+                left -= taken
+                if not lot[2]:
+                    open_lots.popleft()
+            sold = quantity - left
+            if not open_lots:
+                cost = cost_basis
+            elif method == 'fifo':
+                cost = fifo_cost
+            else:
+                cost = cost_basis * sold / shares
+            shares -= sold
+            cost_basis -= cost
+            realized_pnl += amount - cost
+        yield key, shares, cost_basis, realized_pnl, lots
+
+
+def replay_lots(apps, schema_editor):
+    """
+    Rebuild the lots and cost totals of every position from the order
+    history, positions opened before the lots existed have none
+    """
+    Lot = apps.get_model('tradingapp', 'Lot')
+    Position = apps.get_model('tradingapp', 'Position')
+    positions = {(trader_id, stock_id): pk for pk, trader_id, stock_id in
+                 Position.objects.values_list('pk', 'trader_id', 'stock_id')}
+    Position.objects.update(held_shares=0, cost_basis=0, realized_pnl=0)
+    Lot.objects.all().delete()
+
+    lots, totals = [], []
+    for (trader_id, stock_id), shares, cost_basis, realized_pnl, opened in \
+            replay(history(apps), settings.COST_BASIS_METHOD):
+        lots += [Lot(trader_id=trader_id, stock_id=stock_id,
+                     order_id=order_id, quantity=quantity,
+                     remaining=remaining, price=price,
+                     acquired_at=acquired_at)
+                 for order_id, quantity, remaining, price, acquired_at
+                 in opened]
+        if (trader_id, stock_id) in positions:
+            totals.append(Position(
+                pk=positions[trader_id, stock_id], held_shares=shares,
+                cost_basis=cost_basis, realized_pnl=realized_pnl))
+        if len(lots) >= CHUNK_SIZE:
+            Lot.objects.bulk_create(lots)
+            lots = []
+        if len(totals) >= CHUNK_SIZE:
+            Position.objects.bulk_update(
+                totals, ['held_shares', 'cost_basis', 'realized_pnl'])
+            totals = []
+    Lot.objects.bulk_create(lots)
+    Position.objects.bulk_update(
+        totals, ['held_shares', 'cost_basis', 'realized_pnl'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tradingapp', '0013_position_held_shares'),
+    ]
+
+    operations = [
+        migrations.RunPython(replay_lots, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,27 @@
 from django.db import models
+from django.utils import timezone
 from profiles.models import Profile
 
 
+class StockQuerySet(models.QuerySet):
+
+    def with_position(self, trader):
+        """
+        Annotate every stock with the trader's position totals through a
+        single LEFT JOIN. Stocks the trader never traded get None values.
+        """
+        return self.annotate(
+            trader_position=models.FilteredRelation(
+                'positions', condition=models.Q(positions__trader=trader)),
+            position_bought_shares=models.F('trader_position__bought_shares'),
+            position_bought_amount=models.F('trader_position__bought_amount'),
+            position_sold_shares=models.F('trader_position__sold_shares'),
+            position_sold_amount=models.F('trader_position__sold_amount'),
+            position_held_shares=models.F('trader_position__held_shares'),
+            position_cost_basis=models.F('trader_position__cost_basis'),
+            position_realized_pnl=models.F('trader_position__realized_pnl'))
+
+
 class Stock(models.Model):
     name = models.CharField(max_length=10, unique=True)
     price = models.FloatField()
@@ -10,9 +30,18 @@ class Stock(models.Model):
     quantity = models.IntegerField(default=100)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Bumped by every change to the stock's resting limit orders, tells the
+    # matching engine of each process whether its book is current
+    book_version = models.IntegerField(default=0)
+
+    objects = StockQuerySet.as_manager()
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            # Stocks changed since a cursor, for the stream poller
+            models.Index(fields=['updated_at'], name='stock_updated_idx'),
+        ]
 
     def __str__(self) -> str:
         return f'{self.name}: {self.price}'
@@ -27,6 +56,9 @@ class Order(models.Model):
         ('buy', 'Buy'),
         ('sell', 'Sell')
     ]
+    # Limit orders waiting in the order book for a counterparty
+    RESTING_STATUSES = ('open', 'partial')
+
     order_type = models.CharField(max_length=4, choices=ORDER_TYPE_CHOICES)
     trader = models.ForeignKey(
         Profile, on_delete=models.CASCADE, related_name='orders')
@@ -37,19 +69,45 @@ class Order(models.Model):
     status = models.CharField(
         max_length=10, blank=True, null=True, default='success')
     remarks = models.TextField(blank=True, null=True)
+    # Limit orders only, market orders fill at once against the inventory
+    limit_price = models.FloatField(blank=True, null=True)
+    # Shares filled so far. `amount` is the value of the filled shares
+    filled_quantity = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
-        ordering = ('-created_at',)
+        ordering = ('-created_at', '-id')
+        indexes = [
+            # Serves the trader's order list and its keyset pagination
+            models.Index(fields=['trader', '-created_at', '-id'],
+                         name='order_trader_created_idx'),
+            # Resting limit orders loaded to rebuild an order book
+            models.Index(fields=['stock', 'status', 'created_at', 'id'],
+                         name='order_stock_status_idx'),
+            # Recently changed orders, polled by the SSE stream
+            models.Index(fields=['updated_at'], name='order_updated_idx'),
+            # Version of a trader's order list, see OrderAPIViewSet
+            models.Index(fields=['trader', 'updated_at'],
+                         name='order_trader_updated_idx'),
+        ]
 
     def __str__(self) -> str:
         return f'{self.trader.user.username}: {self.stock} - {self.order_type}'
 
     @property
     def price_per_share(self):
+        if self.limit_price is not None:
+            # Average fill price, the limit price until something filled
+            if not self.filled_quantity:
+                return self.limit_price
+            return self.amount / self.filled_quantity
         return self.amount / self.quantity
 
+    @property
+    def remaining_quantity(self):
+        return self.quantity - self.filled_quantity
+
     @property
     def current_order_amount(self):
         return self.stock.price * self.quantity
@@ -59,3 +117,213 @@ class Order(models.Model):
         if self.order_type == 'sell':
             return None
         return self.stock.price * self.quantity - self.amount
+
+
+class Position(models.Model):
+    """
+    Running totals of a trader's orders on a single stock. Kept up to date
+    whenever an order is placed so reads never have to aggregate the trader's
+    order history.
+
+    `held_shares` are the shares still owned, which counts those a resting
+    limit sell reserved (in `sold_shares`) until it fills. `cost_basis` is
+    what they cost and `realized_pnl` the gain of the shares sold, by the
+    COST_BASIS_METHOD (tradingapp.costbasis).
+    """
+    trader = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='positions')
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='positions')
+    bought_shares = models.IntegerField(default=0)
+    bought_amount = models.FloatField(default=0)
+    sold_shares = models.IntegerField(default=0)
+    sold_amount = models.FloatField(default=0)
+    held_shares = models.IntegerField(default=0)
+    cost_basis = models.FloatField(default=0)
+    realized_pnl = models.FloatField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('trader', 'stock')
+
+    def __str__(self) -> str:
+        return f'{self.trader_id}: {self.stock_id} - {self.net_shares}'
+
+    @property
+    def net_shares(self):
+        return self.bought_shares - self.sold_shares
+
+    @property
+    def net_invested(self):
+        return self.bought_amount - self.sold_amount
+
+
+class Lot(models.Model):
+    """
+    Shares of a stock bought by one fill and how many of them the trader
+    still holds. Sells consume the oldest open lots first.
+    """
+    trader = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='lots')
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='lots')
+    # The buy order, which may have been archived since
+    order_id = models.IntegerField()
+    quantity = models.IntegerField()
+    remaining = models.IntegerField()
+    price = models.FloatField()
+    acquired_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ('acquired_at', 'id')
+        indexes = [
+            models.Index(fields=['trader', 'stock', 'remaining'],
+                         name='lot_open_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return (f'{self.trader_id}: {self.stock_id} - '
+                f'{self.remaining}/{self.quantity} @ {self.price}')
+
+
+class ArchivedOrder(models.Model):
+    """
+    An order moved out of the Order table by tradingapp.archive once it
+    was final and older than the archive horizon. Keeps the order's id and
+    columns, so it is served like one by the order endpoints.
+    """
+    id = models.IntegerField(primary_key=True)
+    order_type = models.CharField(
+        max_length=4, choices=Order.ORDER_TYPE_CHOICES)
+    trader = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='archived_orders')
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='archived_orders')
+    quantity = models.IntegerField()
+    amount = models.FloatField()
+    status = models.CharField(max_length=10, blank=True, null=True)
+    remarks = models.TextField(blank=True, null=True)
+    limit_price = models.FloatField(blank=True, null=True)
+    filled_quantity = models.IntegerField()
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-created_at', '-id')
+        indexes = [
+            models.Index(fields=['trader', '-created_at', '-id'],
+                         name='archivedorder_trader_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.trader_id}: {self.stock_id} - {self.order_type}'
+
+
+class PositionCarry(models.Model):
+    """
+    Totals of a trader's archived orders on a single stock, carried forward
+    so positions can still be rebuilt from the Order table plus these.
+    """
+    trader = models.ForeignKey(
+        Profile, on_delete=models.CASCADE, related_name='position_carries')
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='position_carries')
+    bought_shares = models.IntegerField(default=0)
+    bought_amount = models.FloatField(default=0)
+    sold_shares = models.IntegerField(default=0)
+    sold_amount = models.FloatField(default=0)
+    # Orders archived, filled or not, and the newest of them
+    orders = models.IntegerField(default=0)
+    archived_until = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('trader', 'stock')
+
+    def __str__(self) -> str:
+        return f'{self.trader_id}: {self.stock_id} - {self.orders} orders'
+
+
+class Trade(models.Model):
+    """
+    A fill between a buy and a sell limit order, at the price of the order
+    that was resting in the book
+    """
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='trades')
+    buy_order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, related_name='buy_trades')
+    sell_order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, related_name='sell_trades')
+    price = models.FloatField()
+    quantity = models.IntegerField()
+    amount = models.FloatField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('created_at', 'id')
+
+    def __str__(self) -> str:
+        return f'{self.stock_id}: {self.quantity} @ {self.price}'
+
+
+class StockBar(models.Model):
+    """
+    Open / high / low / close, shares traded and notional of a stock's
+    orders within one time bucket. Maintained by tradingapp.rollups as
+    orders are filled, so price history never has to scan the orders.
+    """
+    INTERVAL_CHOICES = [
+        ('1m', '1 minute'),
+        ('1h', '1 hour'),
+        ('1d', '1 day')
+    ]
+    stock = models.ForeignKey(
+        Stock, on_delete=models.CASCADE, related_name='bars')
+    interval = models.CharField(max_length=2, choices=INTERVAL_CHOICES)
+    # UTC start of the bucket
+    start = models.DateTimeField()
+    open = models.FloatField()
+    high = models.FloatField()
+    low = models.FloatField()
+    close = models.FloatField()
+    volume = models.IntegerField(default=0)
+    notional = models.FloatField(default=0)
+    trades = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('stock', 'interval', 'start')
+        # Also serves the history range scans
+        unique_together = ('stock', 'interval', 'start')
+
+    def __str__(self) -> str:
+        return f'{self.stock_id} {self.interval} {self.start}'
+
+
+class RequestProfile(models.Model):
+    """
+    Report of one request profiled by tradingapp.middleware.ProfilingMiddleware
+    """
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=255)
+    status_code = models.IntegerField()
+    duration_ms = models.FloatField()
+    sql_count = models.IntegerField()
+    sql_ms = models.FloatField()
+    serializer_ms = models.FloatField()
+    # Cumulative time of the app's serializer methods, JSON
+    hotspots = models.TextField(blank=True)
+    # Every SQL statement with its duration, JSON
+    queries = models.TextField(blank=True)
+    # Top functions by cumulative time, as printed by pstats
+    summary = models.TextField(blank=True)
+    # Raw cProfile stats, readable with pstats.Stats(<downloaded file>)
+    stats = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('-created_at',)
+
+    def __str__(self) -> str:
+        return f'{self.method} {self.path} ({self.duration_ms:.0f} ms)'
@@ -0,0 +1,95 @@
+"""
+Incrementally maintained OHLCV bars of every stock over 1 minute, 1 hour
+and 1 day buckets (tradingapp.models.StockBar).
+
+Buckets are aligned on UTC epoch multiples of their length, so every 1m bar
+falls in exactly one 1h bar and every 1h bar in exactly one 1d bar.
+"""
+import operator
+from datetime import datetime
+from functools import reduce
+
+from django.db.models import Q
+from django.utils import timezone
+
+from tradingapp.bulk import update_many
+from tradingapp.models import StockBar
+
+# Bucket length of every interval, in seconds
+INTERVALS = {'1m': 60, '1h': 60 * 60, '1d': 24 * 60 * 60}
+
+
+def bucket_start(when, interval):
+    """ UTC start of the `interval` bucket containing `when` """
+    seconds = INTERVALS[interval]
+    return datetime.fromtimestamp(
+        int(when.timestamp()) // seconds * seconds, tz=timezone.utc)
+
+
+def aggregate(trades, bars=None):
+    """
+    Fold (stock id, created at, quantity, amount) trades, in the order they
+    happened, into {(stock id, interval, bucket start): bar fields}. Pass
+    `bars` to keep folding into an earlier result.
+    """
+    bars = {} if bars is None else bars
+    for stock_id, created_at, quantity, amount in trades:
+        price = amount / quantity
+        for interval in INTERVALS:
+            key = (stock_id, interval, bucket_start(created_at, interval))
+            bar = bars.get(key)
+            if bar is None:
+                bars[key] = {
+                    'open': price, 'high': price, 'low': price,
+                    'close': price, 'volume': quantity, 'notional': amount,
+                    'trades': 1}
+                continue
+            bar['high'] = max(bar['high'], price)
+            bar['low'] = min(bar['low'], price)
+            bar['close'] = price
+            bar['volume'] += quantity
+            bar['notional'] += amount
+            bar['trades'] += 1
+    return bars
+
+
+def record_orders(orders, filled_at=None):
+    """
+    Fold newly filled orders into their stocks' bars, at `filled_at` or
+    else at their creation time. Run it in the transaction that fills the
+    orders, after their stock rows were written: no other transaction can
+    touch these stocks' bars until it ends, so the bars are read, merged
+    and written back without further locking.
+    """
+    bars = aggregate(
+        (o.stock_id, filled_at or o.created_at, o.quantity, o.amount)
+        for o in orders)
+    if not bars:
+        return
+    starts = {interval: set() for interval in INTERVALS}
+    for _, interval, start in bars:
+        starts[interval].add(start)
+    existing = StockBar.objects.filter(
+        reduce(operator.or_, (Q(interval=interval, start__in=values)
+                              for interval, values in starts.items())),
+        stock__in={stock_id for stock_id, _, _ in bars})
+    existing = {(b.stock_id, b.interval, b.start): b for b in existing}
+
+    created = []
+    for key, bar in bars.items():
+        saved = existing.get(key)
+        if saved is None:
+            stock_id, interval, start = key
+            created.append(StockBar(
+                stock_id=stock_id, interval=interval, start=start, **bar))
+            continue
+        saved.high = max(saved.high, bar['high'])
+        saved.low = min(saved.low, bar['low'])
+        saved.close = bar['close']
+        saved.volume += bar['volume']
+        saved.notional += bar['notional']
+        saved.trades += bar['trades']
+    StockBar.objects.bulk_create(created)
+    update_many(
+        [b for k, b in existing.items() if k in bars],
+        ['high', 'low', 'close', 'volume', 'notional', 'trades'])
@@ -0,0 +1,590 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from profiles.models import CashEntry, Profile
+from tradingapp.bulk import update_many
+from tradingapp.costbasis import order_fills, record_fills
+from tradingapp.matching import BookOrder, StaleBook, engine
+from tradingapp.models import Order, Position, Stock, Trade
+from tradingapp.rollups import record_orders
+from tradingapp.signals import positions_updated, prices_updated
+from tradingapp.sqlite import writer_lane
+
+
+def place_order(trader, stock, order_type, quantity):
+    """
+    Fill a buy or sell order against the stock inventory and return the
+    saved Order.
+
+    Everything runs in one transaction and every balance, inventory and
+    position change is a conditional UPDATE, so parallel workers can never
+    oversell a stock, overdraw a balance or sell shares twice. The first
+    statement is always a write: it locks the stock row before the price is
+    read, which also keeps SQLite from failing with a lock upgrade deadlock.
+    With SQLITE_WRITER_LANE the transaction first waits for its turn on the
+    writer lane, like every other order write.
+
+    Raises django.core.exceptions.ValidationError when the order can't be
+    filled. Nothing is written in that case.
+    """
+    quantity = int(quantity)
+    now = timezone.now()
+    stocks = Stock.objects.filter(pk=stock.pk)
+    profiles = Profile.objects.filter(pk=trader.pk)
+
+    with writer_lane(), transaction.atomic():
+        if order_type == 'buy':
+            # Take the shares out of the inventory
+            if not stocks.filter(quantity__gte=quantity).update(
+                    quantity=F('quantity') - quantity, updated_at=now):
+                raise ValidationError(
+                    f'Not enough stock! Available: {_quantity_of(stock)}')
+        else:
+            # Return the shares to the inventory
+            stocks.update(quantity=F('quantity') + quantity, updated_at=now)
+
+        price = stocks.select_for_update().values_list(
+            'price', flat=True).get()
+        amount = quantity * price
+
+        if order_type == 'buy':
+            if not profiles.filter(balance__gte=amount).update(
+                    balance=F('balance') - amount, updated_at=now):
+                raise ValidationError('Not enough balance')
+            position, _ = Position.objects.get_or_create(
+                trader=trader, stock=stock)
+            Position.objects.filter(pk=position.pk).update(
+                bought_shares=F('bought_shares') + quantity,
+                bought_amount=F('bought_amount') + amount,
+                updated_at=now)
+        else:
+            # Only shares that were bought and not yet sold can be sold
+            if not Position.objects.filter(
+                    trader=trader, stock=stock,
+                    bought_shares__gte=F('sold_shares') + quantity).update(
+                        sold_shares=F('sold_shares') + quantity,
+                        sold_amount=F('sold_amount') + amount,
+                        updated_at=now):
+                raise ValidationError(
+                    f'Not enough stocks to sell. Available {stock.name} '
+                    f'shares: {_shares_of(trader, stock)}')
+            profiles.update(balance=F('balance') + amount, updated_at=now)
+
+        order = Order.objects.create(
+            trader=trader, stock=stock, order_type=order_type,
+            quantity=quantity, filled_quantity=quantity, amount=amount)
+        _cash_entry(order).save()
+        record_orders([order])
+        record_fills(order_fills([order]))
+        return order
+
+
+def place_orders(trader, items, atomic=True):
+    """
+    Place many orders for one trader in a single transaction.
+
+    `items` is a list of dicts with `stock` (int id or name), `order_type`
+    and `quantity`. All referenced stocks are resolved with one IN query,
+    the trader, stock and position rows are locked once, and every item is
+    checked against the running balance, inventory and position left by
+    the items before it. The orders are then written with bulk_create and the
+    balance, inventory and positions with one bulk UPDATE each, and the
+    stock bars with one UPDATE per touched bucket.
+
+    Returns a list with one entry per item, either the saved Order or a list
+    of error messages. When `atomic` is true a single invalid item rejects
+    the whole batch with a ValidationError whose message_dict maps the index
+    of every invalid item to its errors.
+    """
+    results = [None] * len(items)
+    by_pk, by_name = _resolve_stocks(items)
+    now = timezone.now()
+
+    with writer_lane(), transaction.atomic():
+        # Write first so the trader row (and the SQLite database) is locked
+        # before anything is read
+        Profile.objects.filter(pk=trader.pk).update(updated_at=now)
+        balance = Profile.objects.select_for_update().values_list(
+            'balance', flat=True).get(pk=trader.pk)
+        locked = Stock.objects.select_for_update().filter(
+            pk__in=list(by_pk)).order_by('pk')
+        locked = {stock.pk: stock for stock in locked}
+        positions = Position.objects.select_for_update().filter(
+            trader=trader, stock__in=list(locked))
+        positions = {(p.trader_id, p.stock_id): p for p in positions}
+        held = {p.stock_id: p.net_shares for p in positions.values()}
+
+        for i, item in enumerate(items):
+            ref = item.get('stock')
+            stock = by_pk.get(ref) if isinstance(ref, int) else \
+                by_name.get(str(ref))
+            if stock is None:
+                results[i] = ['Stock not found.']
+                continue
+            stock = locked[stock.pk]
+            quantity = int(item.get('quantity'))
+            amount = quantity * stock.price
+            if item.get('order_type') == 'buy':
+                if quantity > stock.quantity:
+                    results[i] = [
+                        f'Not enough stock! Available: {stock.quantity}']
+                    continue
+                if amount > balance:
+                    results[i] = ['Not enough balance']
+                    continue
+                stock.quantity -= quantity
+                balance -= amount
+                held[stock.pk] = held.get(stock.pk, 0) + quantity
+            else:
+                if quantity > held.get(stock.pk, 0):
+                    results[i] = [
+                        f'Not enough stocks to sell. Available {stock.name} '
+                        f'shares: {held.get(stock.pk, 0)}']
+                    continue
+                stock.quantity += quantity
+                balance += amount
+                held[stock.pk] -= quantity
+            results[i] = Order(
+                trader=trader, stock=stock, order_type=item.get('order_type'),
+                quantity=quantity, filled_quantity=quantity, amount=amount)
+
+        if atomic and any(not isinstance(r, Order) for r in results):
+            raise ValidationError({
+                str(i): r for i, r in enumerate(results)
+                if not isinstance(r, Order)})
+
+        orders = [r for r in results if isinstance(r, Order)]
+        if not orders:
+            return results
+        _bulk_create_orders(trader, orders)
+        CashEntry.objects.bulk_create([_cash_entry(o) for o in orders])
+        record_orders(orders)
+
+        touched = {o.stock_id: o.stock for o in orders}
+        for stock in touched.values():
+            stock.updated_at = now
+        update_many(touched.values(), ['quantity', 'updated_at'])
+        Profile.objects.filter(pk=trader.pk).update(balance=balance)
+
+        _fold_into_positions(positions, orders, now)
+        record_fills(order_fills(orders))
+        positions_updated.send(sender=Order, traders=[trader.pk])
+
+    return results
+
+
+def place_limit_order(trader, stock, order_type, quantity, limit_price):
+    """
+    Submit a limit order to the stock's order book and return the saved
+    Order.
+
+    The order first takes what it is entitled to out of the trader's
+    account: a buy reserves `quantity * limit_price` from the balance, a
+    sell reserves the shares by counting them as sold in the position. It
+    then matches against the resting orders of the other side, best price
+    and oldest order first, at the resting order's price. Every fill is
+    saved as a Trade and settled between both traders. Whatever isn't
+    filled rests in the book with status 'open' or 'partial'.
+
+    Every process matches on its own copy of the book. The match is written
+    only if every resting order it fills is still resting in the database,
+    otherwise it is rolled back and made again on a book reloaded from the
+    committed rows, up to LIMIT_ORDER_ATTEMPTS times.
+
+    Raises django.core.exceptions.ValidationError when the reservation
+    fails or the book stayed stale. Nothing is written in that case.
+    """
+    quantity = int(quantity)
+    limit_price = float(limit_price)
+    for _ in range(settings.LIMIT_ORDER_ATTEMPTS):
+        try:
+            return _place_limit_order(
+                trader, stock, order_type, quantity, limit_price)
+        except StaleBook:
+            continue
+    raise ValidationError('The order book keeps changing, try again')
+
+
+def _place_limit_order(trader, stock, order_type, quantity, limit_price):
+    now = timezone.now()
+    with writer_lane(), transaction.atomic():
+        # Write first to serialize every order of the stock
+        Stock.objects.filter(pk=stock.pk).update(
+            updated_at=now, book_version=F('book_version') + 1)
+        now = timezone.now()  # in commit order, like the fills
+        version = _book_version(stock.pk)
+        if order_type == 'buy':
+            reserved = quantity * limit_price
+            if not Profile.objects.filter(
+                    pk=trader.pk, balance__gte=reserved).update(
+                        balance=F('balance') - reserved, updated_at=now):
+                raise ValidationError('Not enough balance')
+        elif not Position.objects.filter(
+                trader=trader, stock=stock,
+                bought_shares__gte=F('sold_shares') + quantity).update(
+                    sold_shares=F('sold_shares') + quantity,
+                    updated_at=now):
+            raise ValidationError(
+                f'Not enough stocks to sell. Available {stock.name} '
+                f'shares: {_shares_of(trader, stock)}')
+
+        order = Order.objects.create(
+            trader=trader, stock=stock, order_type=order_type,
+            quantity=quantity, amount=0, limit_price=limit_price,
+            status='open')
+        if order_type == 'buy':
+            CashEntry.objects.create(
+                profile=trader, kind='order', amount=-reserved,
+                reference=f'order:{order.pk}', remarks='reserved',
+                created_at=order.created_at)
+
+        with engine.lock:
+            book = _book_to_change(stock.pk, version)
+            # A book reloaded in this transaction already holds the order
+            book.cancel(order.pk)
+            fills = book.match(order_type, limit_price, quantity)
+            remaining = quantity - sum(fill.quantity for fill in fills)
+            if remaining:
+                book.add(BookOrder(
+                    order.pk, trader.pk, order_type, limit_price, remaining))
+        if fills:
+            _settle(order, fills, now)
+    return order
+
+
+def cancel_limit_order(order):
+    """
+    Take the unfilled rest of a resting limit order off the book and give
+    back what it reserved. Returns the order.
+
+    Raises django.core.exceptions.ValidationError when the order isn't
+    resting in the book.
+    """
+    now = timezone.now()
+    with writer_lane(), transaction.atomic():
+        if not Order.objects.filter(
+                pk=order.pk, status__in=Order.RESTING_STATUSES).update(
+                    status='cancelled', updated_at=now):
+            raise ValidationError('Only open orders can be cancelled')
+        order.refresh_from_db()
+        remaining = order.remaining_quantity
+        if order.order_type == 'buy':
+            refund = remaining * order.limit_price
+            Profile.objects.filter(pk=order.trader_id).update(
+                balance=F('balance') + refund, updated_at=now)
+            CashEntry.objects.create(
+                profile_id=order.trader_id, kind='order', amount=refund,
+                reference=f'order:{order.pk}', remarks='cancelled',
+                created_at=now)
+        else:
+            Position.objects.filter(
+                trader_id=order.trader_id, stock_id=order.stock_id).update(
+                    sold_shares=F('sold_shares') - remaining, updated_at=now)
+        Stock.objects.filter(pk=order.stock_id).update(
+            book_version=F('book_version') + 1)
+        version = _book_version(order.stock_id)
+        with engine.lock:
+            _book_to_change(order.stock_id, version).cancel(order.pk)
+        positions_updated.send(sender=Order, traders=[order.trader_id])
+    return order
+
+
+def _book_to_change(stock_id, version):
+    """
+    The stock's book as of the transaction's Stock.book_version `version`,
+    for the caller to change while it holds engine.lock. The book is only
+    tagged with `version` once the transaction commits: until then, and
+    for good if it rolls back, the next order of the stock reloads it from
+    the committed rows. So engine.lock is held around the in-memory
+    changes only, never across the database writes.
+    """
+    book = engine.book(stock_id, version - 1)
+    book.version = None
+
+    def committed():
+        with engine.lock:
+            book.version = version
+    transaction.on_commit(committed)
+    return book
+
+
+def _book_version(stock_id):
+    """ Stock.book_version, read past the stock cache """
+    return Stock.objects.values_list('book_version', flat=True).get(
+        pk=stock_id)
+
+
+def _settle(order, fills, now):
+    """
+    Write the fills of the incoming limit `order`: the trades, both
+    orders' fill progress, the cash, positions and lots of both traders,
+    the bars and the stock's last price.
+    """
+    trades, traders, lot_fills = [], {order.trader_id}, []
+    for fill in fills:
+        maker = fill.maker
+        amount = fill.quantity * fill.price
+        buy, sell = (order.pk, maker.id) if order.order_type == 'buy' \
+            else (maker.id, order.pk)
+        buyer, seller = (order.trader_id, maker.trader_id) \
+            if order.order_type == 'buy' else \
+            (maker.trader_id, order.trader_id)
+        traders.add(maker.trader_id)
+        trades.append(Trade(
+            stock_id=order.stock_id, buy_order_id=buy, sell_order_id=sell,
+            price=fill.price, quantity=fill.quantity, amount=amount,
+            created_at=now))
+        lot_fills += [
+            (buyer, order.stock_id, now, buy, 'buy', fill.quantity, amount),
+            (seller, order.stock_id, now, sell, 'sell', fill.quantity,
+             amount)]
+
+        # Only fills what is still resting in the database
+        if not Order.objects.filter(
+                pk=maker.id, status__in=Order.RESTING_STATUSES,
+                quantity__gte=F('filled_quantity') + fill.quantity).update(
+                    filled_quantity=F('filled_quantity') + fill.quantity,
+                    amount=F('amount') + amount,
+                    status='partial' if maker.remaining else 'success',
+                    updated_at=now):
+            raise StaleBook(f'Order {maker.id} is no longer resting')
+        order.filled_quantity += fill.quantity
+        order.amount += amount
+
+        # The buyer reserved cash at its limit price, the seller its shares
+        if buy == order.pk and order.limit_price > fill.price:
+            refund = (order.limit_price - fill.price) * fill.quantity
+            Profile.objects.filter(pk=buyer).update(
+                balance=F('balance') + refund, updated_at=now)
+            CashEntry.objects.create(
+                profile_id=buyer, kind='order', amount=refund,
+                reference=f'order:{buy}', remarks='price improvement',
+                created_at=now)
+        Profile.objects.filter(pk=seller).update(
+            balance=F('balance') + amount, updated_at=now)
+        CashEntry.objects.create(
+            profile_id=seller, kind='order', amount=amount,
+            reference=f'order:{sell}', created_at=now)
+
+        position, _ = Position.objects.get_or_create(
+            trader_id=buyer, stock_id=order.stock_id)
+        Position.objects.filter(pk=position.pk).update(
+            bought_shares=F('bought_shares') + fill.quantity,
+            bought_amount=F('bought_amount') + amount,
+            updated_at=now)
+        Position.objects.filter(
+            trader_id=seller, stock_id=order.stock_id).update(
+                sold_amount=F('sold_amount') + amount, updated_at=now)
+
+    order.status = 'partial' if order.remaining_quantity else 'success'
+    order.save(update_fields=[
+        'filled_quantity', 'amount', 'status', 'updated_at'])
+    Trade.objects.bulk_create(trades)
+    record_orders(trades)
+    record_fills(lot_fills)
+
+    stocks = Stock.objects.filter(pk=order.stock_id)
+    stocks.update(price=fills[-1].price, updated_at=now)
+    prices_updated.send(sender=Stock, stocks=list(stocks))
+    positions_updated.send(sender=Order, traders=traders)
+
+
+def fill_pending_orders(batch_size=500):
+    """
+    Fill up to `batch_size` queued ('pending') market orders, oldest first,
+    in one transaction. Returns the number of orders processed.
+
+    The ids of the oldest pending orders are read first. The transaction
+    then claims those of them still pending with an UPDATE of exactly these
+    ids, its first statement, and reloads only these ids. An order another
+    worker claimed meanwhile is no longer pending once that worker commits
+    (row locks make the UPDATE wait for it), so it is never processed
+    twice. 'processing' is only seen inside the claiming transaction: a
+    worker dying mid-batch rolls back and leaves its orders pending. When
+    every id was claimed by another worker the next pending ids are read.
+
+    The traders, stocks and positions involved are then locked and read
+    once. Each order is checked against the running state left by the
+    orders before it and becomes 'success' or 'rejected' with the reason in
+    `remarks`. Everything is written back with bulk statements.
+    """
+    while True:
+        ids = list(Order.objects.filter(status='pending').order_by(
+            'id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return 0
+        processed = _fill_claimed_orders(ids)
+        if processed:
+            return processed
+
+
+def _fill_claimed_orders(ids):
+    """ Claim and fill the orders of `ids` still pending, see above """
+    now = timezone.now()
+    with writer_lane(), transaction.atomic():
+        if not Order.objects.filter(pk__in=ids, status='pending').update(
+                status='processing', updated_at=now):
+            return 0
+        # Stamp the fills once the database is locked, so their times
+        # follow the commit order (tradingapp.costbasis replays by time)
+        now = timezone.now()
+        orders = list(Order.objects.filter(
+            pk__in=ids, status='processing').order_by('id'))
+
+        balances = dict(Profile.objects.select_for_update().filter(
+            pk__in={o.trader_id for o in orders}).values_list(
+                'id', 'balance'))
+        stocks = Stock.objects.select_for_update().filter(
+            pk__in={o.stock_id for o in orders}).order_by('pk')
+        stocks = {stock.pk: stock for stock in stocks}
+        keys = {(o.trader_id, o.stock_id) for o in orders}
+        positions = Position.objects.select_for_update().filter(
+            trader__in=list(balances), stock__in=list(stocks))
+        positions = {(p.trader_id, p.stock_id): p for p in positions
+                     if (p.trader_id, p.stock_id) in keys}
+        held = {key: p.net_shares for key, p in positions.items()}
+
+        filled = []
+        for order in orders:
+            stock = order.stock = stocks[order.stock_id]
+            key = (order.trader_id, order.stock_id)
+            amount = order.quantity * stock.price
+            order.updated_at = now
+            order.status = 'rejected'
+            if order.order_type == 'buy':
+                if order.quantity > stock.quantity:
+                    order.remarks = \
+                        f'Not enough stock! Available: {stock.quantity}'
+                    continue
+                if amount > balances[order.trader_id]:
+                    order.remarks = 'Not enough balance'
+                    continue
+                stock.quantity -= order.quantity
+                balances[order.trader_id] -= amount
+                held[key] = held.get(key, 0) + order.quantity
+            else:
+                if order.quantity > held.get(key, 0):
+                    order.remarks = (
+                        f'Not enough stocks to sell. Available {stock.name} '
+                        f'shares: {held.get(key, 0)}')
+                    continue
+                stock.quantity += order.quantity
+                balances[order.trader_id] += amount
+                held[key] -= order.quantity
+            order.status = 'success'
+            order.amount = amount
+            order.filled_quantity = order.quantity
+            filled.append(order)
+
+        # One UPDATE per filled stock and per rejection reason, much
+        # cheaper than bulk_update's per row CASE expressions
+        outcomes = defaultdict(list)
+        for order in orders:
+            outcomes[order.stock_id if order.status == 'success'
+                     else order.remarks].append(order.pk)
+        for outcome, ids in outcomes.items():
+            if isinstance(outcome, int):
+                Order.objects.filter(pk__in=ids).update(
+                    status='success', remarks=None,
+                    amount=F('quantity') * stocks[outcome].price,
+                    filled_quantity=F('quantity'), updated_at=now)
+            else:
+                Order.objects.filter(pk__in=ids).update(
+                    status='rejected', remarks=outcome, updated_at=now)
+        if filled:
+            # Queued orders are booked when they fill, not when they came in
+            CashEntry.objects.bulk_create(
+                [_cash_entry(o, now) for o in filled])
+            record_orders(filled, now)
+            touched = {o.stock_id: o.stock for o in filled}
+            for stock in touched.values():
+                stock.updated_at = now
+            update_many(touched.values(), ['quantity', 'updated_at'])
+            update_many(
+                [Profile(pk=pk, balance=balance, updated_at=now)
+                 for pk, balance in balances.items()],
+                ['balance', 'updated_at'])
+            _fold_into_positions(positions, filled, now)
+            record_fills(order_fills(filled))
+            positions_updated.send(
+                sender=Order, traders={o.trader_id for o in filled})
+    return len(orders)
+
+
+def _fold_into_positions(positions, orders, now):
+    """
+    Add filled market orders to `positions`, a dict of the already saved
+    positions by (trader id, stock id), then save them with one bulk INSERT
+    and one bulk UPDATE
+    """
+    for order in orders:
+        key = (order.trader_id, order.stock_id)
+        position = positions.get(key)
+        if position is None:
+            position = positions[key] = Position(
+                trader_id=order.trader_id, stock_id=order.stock_id)
+        if order.order_type == 'buy':
+            position.bought_shares += order.quantity
+            position.bought_amount += order.amount
+        else:
+            position.sold_shares += order.quantity
+            position.sold_amount += order.amount
+        position.updated_at = now
+    Position.objects.bulk_create(
+        [p for p in positions.values() if p.pk is None])
+    update_many(
+        [p for p in positions.values() if p.pk is not None],
+        ['bought_shares', 'bought_amount', 'sold_shares', 'sold_amount',
+         'updated_at'])
+
+
+def _resolve_stocks(items):
+    """
+    Fetch every stock referenced by `items` with one query. Like the order
+    endpoint, an int `stock` is an id and anything else a name, so a stock
+    named "12" never stands for the stock with id 12. Returns
+    (stocks by id, stocks by name).
+    """
+    refs = [item.get('stock') for item in items]
+    ids = {ref for ref in refs if isinstance(ref, int)}
+    names = {str(ref) for ref in refs if not isinstance(ref, int)}
+    by_pk, by_name = {}, {}
+    for stock in Stock.objects.filter(Q(pk__in=ids) | Q(name__in=names)):
+        by_pk[stock.pk] = stock
+        by_name[stock.name] = stock
+    return by_pk, by_name
+
+
+def _bulk_create_orders(trader, orders):
+    Order.objects.bulk_create(orders)
+    if orders[0].pk is None:
+        # The backend can't return the inserted ids (SQLite). The database
+        # is write locked by this transaction, so the newest rows of the
+        # trader are exactly the ones just inserted, in the same order.
+        ids = list(Order.objects.filter(trader=trader).order_by(
+            '-pk').values_list('pk', flat=True)[:len(orders)])
+        for order, pk in zip(orders, reversed(ids)):
+            order.pk = pk
+
+
+def _cash_entry(order, filled_at=None):
+    """ Ledger entry of the cash moved by an order filled at `filled_at` """
+    return CashEntry(
+        profile_id=order.trader_id, kind='order',
+        amount=-order.amount if order.order_type == 'buy' else order.amount,
+        reference=f'order:{order.pk}',
+        created_at=filled_at or order.created_at)
+
+
+def _quantity_of(stock):
+    return Stock.objects.values_list('quantity', flat=True).get(pk=stock.pk)
+
+
+def _shares_of(trader, stock):
+    position = Position.objects.filter(trader=trader, stock=stock).first()
+    return position.net_shares if position is not None else 0
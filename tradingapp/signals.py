@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from rest_framework.authtoken.models import Token
+
+from tradingapp.cache import stock_cache, stock_list_cache, token_cache
+from tradingapp.models import Order, Stock
+from tradingapp.sqlite import apply_pragmas
+
+# Sent after stock prices were changed in bulk (bulk_update skips post_save)
+prices_updated = Signal(providing_args=['stocks'])
+
+# Sent after orders changed stock inventories and the positions of
+# `traders` (profile ids) through update() / bulk_create, which skip
+# post_save
+positions_updated = Signal(providing_args=['traders'])
+
+
+@receiver(post_save, sender=Stock)
+@receiver(post_delete, sender=Stock)
+def invalidate_stock_cache(sender, instance, **kwargs):
+    """ Drop the cached copy of a changed or deleted stock """
+    invalidate_repriced_stocks(sender, [instance])
+
+
+@receiver(prices_updated, sender=Stock)
+def invalidate_repriced_stocks(sender, stocks, **kwargs):
+    """
+    Drop the cached copies of repriced stocks once the change is
+    committed, like the stock lists
+    """
+    # Read now, a deleted stock has lost its pk by then
+    keys = [(stock.pk, stock.name) for stock in stocks]
+
+    def invalidate():
+        for pk, name in keys:
+            stock_cache.invalidate(pk, name)
+        stock_list_cache.invalidate_market()
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Order)
+def invalidate_trader_stock_list(sender, instance, created, **kwargs):
+    """ A new order moves its stock's inventory and the trader's position """
+    if created:
+        invalidate_stock_lists(sender, [instance.trader_id])
+
+
+@receiver(positions_updated)
+def invalidate_stock_lists(sender, traders, **kwargs):
+    """
+    Drop the stock list tiers once the orders are committed: dropped any
+    earlier, a concurrent request could reload them from the rows before
+    the commit and keep those until they expire
+    """
+    def invalidate():
+        stock_list_cache.invalidate_market()
+        stock_list_cache.invalidate_traders(traders)
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    """ Logging out deletes the token: stop authenticating it at once """
+    token_cache.delete(instance.key)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    """ Drop the cached copy of a changed (e.g. deactivated) user """
+    for key in Token.objects.filter(user=instance).values_list(
+            'key', flat=True):
+        token_cache.delete(key)
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    """ Production pragmas of SQLite connections, see tradingapp.sqlite """
+    apply_pragmas(connection)
@@ -0,0 +1,69 @@
+"""
+Production mode of the SQLite backend (SQLITE_PRODUCTION in settings).
+
+Every new SQLite connection runs the SQLITE_PRAGMAS: WAL journaling lets
+readers go on while a transaction writes, `synchronous = NORMAL` is safe
+with WAL and syncs far less, and the page cache and memory mapping keep
+hot pages out of the read path.
+
+SQLite allows one writer at a time. Writers that race for the lock either
+wait in the busy handler or, when a reader tries to become a writer, fail
+with "database is locked". The writer lane queues the order writes of
+every thread and every process using the database file on an exclusive
+file lock instead, so each transaction finds the write lock free.
+"""
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+_lane = threading.RLock()
+_held = threading.local()
+_lock_files = {}  # (pid, database file) -> open lock file
+
+
+def apply_pragmas(connection):
+    """ Run the SQLITE_PRAGMAS on a new SQLite connection """
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def _lock_file(path):
+    # flock locks belong to the open file, which a forked child would
+    # share with its parent: open it once per process
+    key = (os.getpid(), path)
+    if key not in _lock_files:
+        _lock_files[key] = open(f'{path}.writer-lock', 'a')
+    return _lock_files[key]
+
+
+@contextmanager
+def writer_lane(using='default'):
+    """
+    Run the block alone among the writer_lane blocks of every thread and
+    process writing to the same SQLite file. Does nothing unless
+    SQLITE_WRITER_LANE is set. Reentrant.
+    """
+    path = connections[using].settings_dict['NAME']
+    if not settings.SQLITE_WRITER_LANE or \
+            connections[using].vendor != 'sqlite' or ':memory:' in path \
+            or path.startswith('file:'):
+        yield
+        return
+    with _lane:
+        depth = getattr(_held, 'depth', 0)
+        if not depth:
+            fcntl.flock(_lock_file(path), fcntl.LOCK_EX)
+        _held.depth = depth + 1
+        try:
+            yield
+        finally:
+            _held.depth = depth
+            if not depth:
+                fcntl.flock(_lock_file(path), fcntl.LOCK_UN)
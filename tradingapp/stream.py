@@ -0,0 +1,354 @@
+"""
+Server-Sent Events stream of stock prices and of the trader's own order
+status changes, served by one asyncio process (`manage.py streamserver`).
+
+A single poller reads what changed in the database since its last pass and
+hands every change to the Broker, which formats each event once and puts it
+on the queue of every interested subscriber. An idle connection costs one
+coroutine waiting on its queue, so a process holds thousands of them.
+
+Clients connect with
+
+    GET /tradingapp/api/stream/?symbols=MCHP,ADI
+    Authorization: Token <key>     (or ?token=<key>, for EventSource)
+
+and receive `price` events for the symbols they asked for (the current
+prices first) and `order` events for their own orders. Every poller pass
+also checks the tokens of the open streams: a stream is closed once its
+token is deleted (logout) or its user deactivated, in any process.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import chain
+from urllib.parse import parse_qs, urlsplit
+
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from tradingapp.api.serializers import _datetime_field
+from tradingapp.cache import LRUCache
+from tradingapp.models import Order, Stock
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/tradingapp/api/stream/'
+
+# Token keys and trader ids checked per query by the poller, well under
+# SQLite's limit on query parameters
+CHUNK_SIZE = 500
+
+
+def format_event(event, data):
+    """ Wire format of one SSE event """
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+class Subscriber:
+    """ One connected client: what it listens to and its pending events """
+
+    def __init__(self, trader_id, symbols, maxsize=1000, token=None):
+        self.trader_id = trader_id
+        self.symbols = symbols
+        self.token = token
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+
+    def send(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # Too slow a reader, it misses events rather than stalling
+            # every other subscriber
+            self.dropped += 1
+
+    def close(self):
+        """ End the stream, the connection is closed once it wakes up """
+        self.closed = True
+        self.send(b'')
+
+
+class Broker:
+    """ Fan out of price and order events to the interested subscribers """
+
+    def __init__(self):
+        self.by_symbol = defaultdict(set)
+        self.by_trader = defaultdict(set)
+        self.by_token = defaultdict(set)
+        self.prices = {}  # symbol -> last price event payload
+        self.published = 0
+
+    def __len__(self):
+        return sum(len(subs) for subs in self.by_trader.values())
+
+    def subscribe(self, subscriber):
+        self.by_trader[subscriber.trader_id].add(subscriber)
+        if subscriber.token is not None:
+            self.by_token[subscriber.token].add(subscriber)
+        for symbol in subscriber.symbols:
+            self.by_symbol[symbol].add(subscriber)
+            if symbol in self.prices:
+                subscriber.send(self.prices[symbol])
+
+    def unsubscribe(self, subscriber):
+        self._discard(self.by_trader, subscriber.trader_id, subscriber)
+        self._discard(self.by_token, subscriber.token, subscriber)
+        for symbol in subscriber.symbols:
+            self._discard(self.by_symbol, symbol, subscriber)
+
+    def _discard(self, index, key, subscriber):
+        subscribers = index.get(key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del index[key]
+
+    def traders(self):
+        return list(self.by_trader)
+
+    def tokens(self):
+        return set(self.by_token)
+
+    def revoke(self, tokens):
+        """ Close the streams opened with any of `tokens` """
+        for token in tokens:
+            for subscriber in self.by_token.get(token, ()):
+                subscriber.close()
+
+    def publish_price(self, symbol, price, updated_at):
+        payload = format_event('price', {
+            'stock': symbol, 'price': price,
+            'updated_at': _datetime_field.to_representation(updated_at)})
+        self.prices[symbol] = payload
+        self._publish(self.by_symbol.get(symbol, ()), payload)
+
+    def publish_order(self, trader_id, order):
+        self._publish(self.by_trader.get(trader_id, ()),
+                      format_event('order', order))
+
+    def broadcast(self, payload):
+        """ Send `payload` to every subscriber """
+        for subscribers in self.by_trader.values():
+            for subscriber in subscribers:
+                subscriber.send(payload)
+
+    def _publish(self, subscribers, payload):
+        for subscriber in subscribers:
+            subscriber.send(payload)
+        self.published += 1
+
+
+class ChangePoller:
+    """
+    Find the stock prices and orders whose `updated_at` moved since the
+    previous pass. Each pass looks `lookback` further back than the last
+    one so rows committed late by a long transaction are not missed;
+    changes already reported are recognised and skipped.
+    """
+
+    def __init__(self, lookback=timedelta(seconds=5)):
+        self.lookback = lookback
+        self.since = None
+        self.prices = {}  # symbol -> last price reported
+        self.seen_orders = {}  # order id -> updated_at reported
+
+    def poll(self, traders):
+        """
+        One pass. Returns the changed (symbol, price, updated_at) and the
+        changed orders of `traders` as (trader id, event data). Blocking,
+        runs in the database thread.
+        """
+        now = timezone.now()
+        prices, orders = [], []
+
+        # Unordered, so the changed stocks are found through the
+        # updated_at index rather than by scanning them in name order
+        stocks = Stock.objects.order_by().values_list(
+            'name', 'price', 'updated_at')
+        if self.since is not None:
+            stocks = stocks.filter(updated_at__gte=self.since)
+        for name, price, updated_at in stocks:
+            if self.prices.get(name) != price:
+                self.prices[name] = price
+                prices.append((name, price, updated_at))
+
+        if self.since is not None and traders:
+            traders = list(traders)
+            rows = chain.from_iterable(
+                Order.objects.filter(
+                    updated_at__gte=self.since,
+                    trader__in=traders[i:i + CHUNK_SIZE]).values_list(
+                        'id', 'trader_id', 'stock__name', 'order_type',
+                        'status', 'remarks', 'quantity', 'filled_quantity',
+                        'amount', 'updated_at')
+                for i in range(0, len(traders), CHUNK_SIZE))
+            for (pk, trader_id, stock, order_type, status, remarks, quantity,
+                    filled, amount, updated_at) in rows:
+                if self.seen_orders.get(pk) == updated_at:
+                    continue
+                self.seen_orders[pk] = updated_at
+                orders.append((trader_id, {
+                    'id': pk, 'stock': stock, 'order_type': order_type,
+                    'status': status, 'remarks': remarks,
+                    'quantity': quantity, 'filled_quantity': filled,
+                    'amount': amount,
+                    'updated_at': _datetime_field.to_representation(
+                        updated_at)}))
+
+        self.since = now - self.lookback
+        self.seen_orders = {pk: updated_at for pk, updated_at in
+                            self.seen_orders.items()
+                            if updated_at >= self.since}
+        return prices, orders
+
+
+class StreamServer:
+    """ The SSE endpoint, its poller and the Broker they share """
+
+    keepalive = 15
+
+    def __init__(self, poll_interval=0.5, queue_size=1000):
+        self.broker = Broker()
+        self.poller = ChangePoller()
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        # Django's ORM is synchronous: every query runs in this one thread,
+        # asyncio queues are only touched from the event loop
+        self.db = ThreadPoolExecutor(1, thread_name_prefix='stream-db')
+        self.tokens = LRUCache(maxsize=10000, ttl=60)  # key -> trader id
+
+    async def db_call(self, func, *args):
+        def call():
+            close_old_connections()
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.db, call)
+
+    async def run_poller(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:  # keep streaming, retry next pass
+                logger.exception('Stream poll failed')
+            await asyncio.sleep(self.poll_interval)
+
+    async def run_keepalive(self):
+        """ Comment lines that keep idle connections open through proxies """
+        while True:
+            await asyncio.sleep(self.keepalive)
+            self.broker.broadcast(b': keepalive\n\n')
+
+    async def poll(self):
+        """
+        One poller pass, published to the subscribers. Streams and cached
+        keys whose token stopped authenticating are dropped first.
+        """
+        keys = self.broker.tokens() | set(self.tokens.keys())
+        (prices, orders), revoked = await self.db_call(
+            self.poll_changes, self.broker.traders(), keys)
+        for key in revoked:
+            self.tokens.delete(key)
+        self.broker.revoke(revoked)
+        for symbol, price, updated_at in prices:
+            self.broker.publish_price(symbol, price, updated_at)
+        for trader_id, order in orders:
+            self.broker.publish_order(trader_id, order)
+
+    def poll_changes(self, traders, keys):
+        """
+        The poller's pass, and which of the token `keys` no longer
+        authenticate. Blocking
+        """
+        keys = list(keys)
+        valid = set()
+        for i in range(0, len(keys), CHUNK_SIZE):
+            valid.update(Token.objects.filter(
+                key__in=keys[i:i + CHUNK_SIZE],
+                user__is_active=True).values_list('key', flat=True))
+        return self.poller.poll(traders), set(keys) - valid
+
+    def trader_of(self, key):
+        """ Profile id of a token key, or None. Blocking """
+        return Token.objects.filter(key=key, user__is_active=True).values_list(
+            'user__profile', flat=True).first()
+
+    async def authenticate(self, key):
+        if not key:
+            return None
+        trader_id = self.tokens.get(key)
+        if trader_id is None:
+            trader_id = await self.db_call(self.trader_of, key)
+            if trader_id is not None:
+                self.tokens.set(key, trader_id)
+        return trader_id
+
+    async def handle(self, reader, writer):
+        try:
+            await self.serve_client(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            pass
+        except asyncio.CancelledError:
+            pass  # server shutting down
+        finally:
+            writer.close()
+
+    async def serve_client(self, reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = (request_line.split(' ') + ['', ''])[:3]
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if method != 'GET' or url.path != STREAM_PATH:
+            return await self.respond(writer, '404 Not Found')
+        key = query.get('token', [''])[0]
+        authorization = headers.get('authorization', '')
+        if authorization.startswith('Token '):
+            key = authorization[len('Token '):]
+        trader_id = await self.authenticate(key)
+        if trader_id is None:
+            return await self.respond(writer, '401 Unauthorized')
+
+        symbols = {s for value in query.get('symbols', [])
+                   for s in value.split(',') if s}
+        subscriber = Subscriber(trader_id, symbols, self.queue_size, key)
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\n'
+                     b'Connection: keep-alive\r\n'
+                     b'X-Accel-Buffering: no\r\n\r\n'
+                     b'retry: 3000\n\n')
+        self.broker.subscribe(subscriber)
+        queue = subscriber.queue
+        try:
+            while True:
+                payloads = [await queue.get()]
+                while not queue.empty():
+                    payloads.append(queue.get_nowait())
+                if subscriber.closed:
+                    break
+                writer.writelines(payloads)
+                await writer.drain()
+        finally:
+            self.broker.unsubscribe(subscriber)
+
+    async def respond(self, writer, status):
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Length: 0\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+
+    async def start(self, host, port, backlog=4096):
+        """ Listen and start polling. Returns the asyncio server """
+        self.tasks = [asyncio.ensure_future(self.run_poller()),
+                      asyncio.ensure_future(self.run_keepalive())]
+        return await asyncio.start_server(
+            self.handle, host, port, backlog=backlog)
@@ -1,12 +1,58 @@
+import asyncio
+import csv
+import importlib
+import json
+import marshal
+import os
+import random
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest import mock
+
+from django.apps import apps
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Q, Sum
+from django.test import (
+    SimpleTestCase, TransactionTestCase, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from rest_framework.reverse import reverse
 from rest_framework.status import HTTP_201_CREATED
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 
-from tradingapp.models import Stock
+from trading.replicas import sync_replica
+from tradingapp.api.serializers import OrderSerializer, StockSerializer
+from tradingapp.api.views import load_invested, load_market_rows
+from tradingapp.bench import seed, summarize
+from tradingapp.cache import (
+    StockCache, stock_cache, stock_list_cache, token_cache)
+from tradingapp.export import EXPORT_FIELDS, export_lines
+from tradingapp.matching import (
+    BookOrder, MatchingEngine, OrderBook, StaleBook, engine)
+from tradingapp.models import (
+    ArchivedOrder, Lot, Order, Position, PositionCarry, RequestProfile, Stock,
+    StockBar, Trade)
+from tradingapp.rollups import INTERVALS, bucket_start
+from tradingapp.stream import (
+    STREAM_PATH, Broker, ChangePoller, StreamServer, Subscriber)
+from tradingapp.services import (
+    fill_pending_orders, place_limit_order, place_order, place_orders)
+from tradingapp.signals import prices_updated
+from tradingapp.sqlite import writer_lane
 
 USERA = {'username': 'test_user_a', 'password': 'test1234'}
 USERB = {'username': 'test_user_b', 'password': 'test1234'}
@@ -40,6 +86,10 @@ class TradingAppEndpointTestCase(APITestCase):
         """
         Create test stock objects
         """
+        stock_cache.clear()
+        stock_list_cache.clear()
+        token_cache.clear()
+        engine.clear()
         TEST_STOCK_OBJ_A = Stock.objects.create(**TEST_STOCK_A)
         TEST_STOCK_OBJ_B = Stock.objects.create(**TEST_STOCK_B)
         self.TEST_STOCK_A = TEST_STOCK_OBJ_A.name
@@ -58,6 +108,15 @@ class TradingAppEndpointTestCase(APITestCase):
     def logout_user(self):
         self.client.logout()
 
+    def run_commit_hooks(self):
+        """
+        Run the transaction.on_commit callbacks queued so far, the test's
+        transaction is never committed
+        """
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
     def place_order(self, stock, quantity, order_type, trader):
         stock = Stock.objects.get(name=stock)
         balance_before_order = trader.balance
@@ -70,6 +129,7 @@ class TradingAppEndpointTestCase(APITestCase):
             'quantity': quantity
         }
         resp = self.client.post(endpoint, data)
+        self.run_commit_hooks()
 
         trader.refresh_from_db()
         stock.refresh_from_db()
@@ -296,6 +356,117 @@ class OrderEndpointTestCase(TradingAppEndpointTestCase):
         self.assertEqual(balance_before_order, balance_after_order)
         self.assertEqual(quantity_before_order, quantity_after_order)
 
+    def test_orders_recorded_in_ledger(self):
+        """
+        Ensure every filled order, single or batched, appends one cash entry
+        with the signed amount, and rejected orders append none
+        """
+        trader = self.login_user(username=USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 20, 'buy', trader)
+        self.place_order(self.TEST_STOCK_A, 5, 'sell', trader)
+        self.place_order(self.TEST_STOCK_A, 50, 'sell', trader)
+        self.client.post(reverse('order-batch'), {'orders': [
+            {'stock': self.TEST_STOCK_B, 'order_type': 'buy', 'quantity': 3},
+        ]}, format='json')
+
+        entries = trader.cash_entries.filter(kind='order')
+        price_a = TEST_STOCK_A.get('price')
+        price_b = TEST_STOCK_B.get('price')
+        self.assertEqual(
+            [round(e.amount, 2) for e in entries],
+            [round(-20 * price_a, 2), round(5 * price_a, 2),
+             round(-3 * price_b, 2)])
+        self.assertEqual(
+            sorted(e.reference for e in entries),
+            sorted(f'order:{pk}' for pk in trader.orders.values_list(
+                'pk', flat=True)))
+
+
+class OrderReadPathTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def test_same_output_as_serializer(self):
+        """
+        Ensure the list and detail endpoints render orders exactly like
+        OrderSerializer, with a constant number of queries
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock_a = Stock.objects.get(name=self.TEST_STOCK_A)
+        stock_b = Stock.objects.get(name=self.TEST_STOCK_B)
+        place_order(trader, stock_a, 'buy', 3)
+        place_order(trader, stock_b, 'buy', 2)
+        place_order(trader, stock_a, 'sell', 1)
+        endpoint = reverse(self.endpoint_order_list)
+        self.client.get(endpoint)  # Cache the token
+
+        with CaptureQueriesContext(connection) as few:
+            resp = self.client.get(endpoint)
+        expected = json.loads(json.dumps(
+            OrderSerializer(trader.orders.all(), many=True).data))
+        self.assertEqual(resp.json(), expected)
+
+        for _ in range(10):
+            place_order(trader, stock_b, 'buy', 1)
+        with CaptureQueriesContext(connection) as many:
+            self.client.get(endpoint)
+        self.assertEqual(len(many), len(few))
+
+        order = trader.orders.last()
+        resp = self.client.get(
+            reverse(self.endpoint_order_detail, kwargs={'pk': order.pk}))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json(),
+                         json.loads(json.dumps(OrderSerializer(order).data)))
+
+    def test_retrieve_other_traders_order(self):
+        trader = self.login_user(USERA.get('username')).profile
+        order = place_order(
+            trader, Stock.objects.get(name=self.TEST_STOCK_A), 'buy', 1)
+        self.login_user(USERB.get('username'))
+        resp = self.client.get(
+            reverse(self.endpoint_order_detail, kwargs={'pk': order.pk}))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class OrderPaginationTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def test_keyset_pagination(self):
+        """
+        Ensure walking the pages returns every order exactly once, newest
+        first, and that pagination is only applied when asked for
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        for _ in range(7):
+            place_order(trader, stock, 'buy', 1)
+        endpoint = reverse(self.endpoint_order_list)
+
+        resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        expected = [o['id'] for o in resp.json()]
+        self.assertEqual(len(expected), 7)
+
+        ids = []
+        url = endpoint + '?page_size=3'
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            page = resp.json()
+            self.assertLessEqual(len(page['results']), 3)
+            ids += [o['id'] for o in page['results']]
+            url = page['next']
+        self.assertEqual(ids, expected)
+
+        resp = self.client.get(endpoint, {'cursor': 'garbage'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
 
 class StockEndpointTestCase(TradingAppEndpointTestCase):
 
@@ -334,6 +505,29 @@ class StockEndpointTestCase(TradingAppEndpointTestCase):
         resp = self.client.get(endpoint)
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_stock_list_query_count(self):
+        """
+        Ensure the number of queries needed to list stocks does not depend
+        on the number of stocks
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', trader)
+        endpoint = reverse(self.endpoint_stock_list)
+
+        with CaptureQueriesContext(connection) as few:
+            resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        for i in range(20):
+            Stock.objects.create(name=f'TEST_{i}', price=1.5 + i)
+            self.place_order(f'TEST_{i}', 1, 'buy', trader)
+
+        with CaptureQueriesContext(connection) as many:
+            resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 22)
+        self.assertEqual(len(many), len(few))
+
     def test_stock_retrive_invested_field(self):
         """
         Ensure "invested" field on the response data is null if the
@@ -426,3 +620,1803 @@ class StockEndpointTestCase(TradingAppEndpointTestCase):
         self.assertEqual(net_invested,
                          stock_price * (buy_quantity - sell_quantity))
         self.assertEqual(net_shares, (buy_quantity - sell_quantity))
+
+
+class PositionTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def test_position_follows_orders(self):
+        """
+        Ensure every placed order is folded into the trader's position
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 30, 'buy', trader)
+        self.place_order(self.TEST_STOCK_A, 12, 'sell', trader)
+        # Rejected order must not touch the position
+        self.place_order(self.TEST_STOCK_A, 50, 'sell', trader)
+
+        position = trader.positions.get(stock__name=self.TEST_STOCK_A)
+        price = TEST_STOCK_A.get('price')
+        self.assertEqual(position.bought_shares, 30)
+        self.assertEqual(position.bought_amount, 30 * price)
+        self.assertEqual(position.sold_shares, 12)
+        self.assertEqual(position.sold_amount, 12 * price)
+        self.assertEqual(position.net_shares, 18)
+
+    def test_rebuild_positions(self):
+        """
+        Ensure rebuildpositions command restores positions from orders
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 30, 'buy', trader)
+        self.place_order(self.TEST_STOCK_B, 10, 'buy', trader)
+        self.place_order(self.TEST_STOCK_A, 5, 'sell', trader)
+        expected = list(Position.objects.order_by('stock__name').values(
+            'trader', 'stock', 'bought_shares', 'bought_amount',
+            'sold_shares', 'sold_amount'))
+
+        Position.objects.all().delete()
+        call_command('rebuildpositions', stdout=StringIO())
+
+        rebuilt = list(Position.objects.order_by('stock__name').values(
+            'trader', 'stock', 'bought_shares', 'bought_amount',
+            'sold_shares', 'sold_amount'))
+        self.assertEqual(rebuilt, expected)
+
+
+class PortfolioEndpointTestCase(TradingAppEndpointTestCase):
+
+    endpoint_portfolio = 'portfolio'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def test_portfolio(self):
+        """
+        Ensure holdings are valued at the current price and the number of
+        queries doesn't grow with the number of orders
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock_a = Stock.objects.get(name=self.TEST_STOCK_A)
+        stock_b = Stock.objects.get(name=self.TEST_STOCK_B)
+        place_order(trader, stock_a, 'buy', 10)
+        place_order(trader, stock_b, 'buy', 4)
+        place_order(trader, stock_b, 'sell', 4)
+        endpoint = reverse(self.endpoint_portfolio)
+        self.client.get(endpoint)  # Cache the token
+
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(endpoint)
+
+        stock_a.price = 12.0
+        stock_a.save()
+        for _ in range(10):
+            place_order(trader, stock_a, 'buy', 1)
+        with CaptureQueriesContext(connection) as many:
+            resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(many), len(few))
+
+        data = resp.json()
+        # Stock B was sold off entirely
+        self.assertEqual(len(data['holdings']), 1)
+        holding = data['holdings'][0]
+        cost_basis = 10 * TEST_STOCK_A['price'] + 10 * 12.0
+        self.assertEqual(holding['stock'], self.TEST_STOCK_A)
+        self.assertEqual(holding['shares'], 20)
+        self.assertAlmostEqual(holding['cost_basis'], cost_basis)
+        self.assertAlmostEqual(holding['market_value'], 20 * 12.0)
+        self.assertAlmostEqual(holding['unrealized_gain'],
+                               20 * 12.0 - cost_basis)
+        trader.refresh_from_db()
+        self.assertAlmostEqual(data['balance'], trader.balance)
+        self.assertAlmostEqual(data['net_worth'], trader.balance + 240)
+
+
+class BatchOrderTestCase(TradingAppEndpointTestCase):
+
+    endpoint_order_batch = 'order-batch'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def test_atomic_batch(self):
+        """
+        Ensure every order of a valid batch is placed and later orders see
+        the effect of earlier ones
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        data = {'orders': [
+            {'stock': self.TEST_STOCK_A, 'order_type': 'buy', 'quantity': 10},
+            {'stock': self.TEST_STOCK_B, 'order_type': 'buy', 'quantity': 5},
+            {'stock': self.TEST_STOCK_A, 'order_type': 'sell', 'quantity': 4},
+        ]}
+        resp = self.client.post(
+            reverse(self.endpoint_order_batch), data, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([o['order_type'] for o in resp.json()],
+                         ['buy', 'buy', 'sell'])
+        self.assertEqual(len({o['id'] for o in resp.json()}), 3)
+
+        price_a = TEST_STOCK_A.get('price')
+        price_b = TEST_STOCK_B.get('price')
+        trader.refresh_from_db()
+        self.assertAlmostEqual(
+            trader.balance, 1000 - 6 * price_a - 5 * price_b)
+        stock_a = Stock.objects.get(name=self.TEST_STOCK_A)
+        self.assertEqual(stock_a.quantity, TEST_STOCK_A['quantity'] - 6)
+        self.assertEqual(
+            trader.positions.get(stock=stock_a).net_shares, 6)
+
+    def test_atomic_batch_rejected(self):
+        """
+        Ensure one invalid order rejects the whole batch
+        """
+        trader = self.login_user(USERB.get('username')).profile
+        data = [
+            {'stock': self.TEST_STOCK_A, 'order_type': 'buy', 'quantity': 10},
+            {'stock': self.TEST_STOCK_B, 'order_type': 'sell', 'quantity': 1},
+        ]
+        resp = self.client.post(
+            reverse(self.endpoint_order_batch), data, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = resp.json().get('orders')
+        self.assertEqual(errors[0], {})
+        self.assertIn('non_field_errors', errors[1])
+
+        trader.refresh_from_db()
+        self.assertEqual(trader.balance, 500)
+        self.assertFalse(trader.orders.exists())
+        self.assertFalse(trader.positions.exists())
+
+    def test_per_item_batch(self):
+        """
+        Ensure valid orders are placed when atomic is turned off
+        """
+        trader = self.login_user(USERB.get('username')).profile
+        data = {'atomic': False, 'orders': [
+            {'stock': self.TEST_STOCK_A, 'order_type': 'buy', 'quantity': 10},
+            {'stock': 'UNKNOWN', 'order_type': 'buy', 'quantity': 1},
+            {'stock': self.TEST_STOCK_B, 'order_type': 'sell', 'quantity': 1},
+        ]}
+        resp = self.client.post(
+            reverse(self.endpoint_order_batch), data, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.json()
+        self.assertIn('order', results[0])
+        self.assertIn('errors', results[1])
+        self.assertIn('errors', results[2])
+        self.assertEqual(trader.orders.count(), 1)
+
+    def test_stock_ids_and_names(self):
+        """
+        Ensure numbers resolve stocks by id and strings by name, even a
+        name that is another stock's id
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock_a = Stock.objects.get(name=self.TEST_STOCK_A)
+        digits = Stock.objects.create(
+            name=str(stock_a.pk), price=1.0, quantity=10)
+        data = [
+            {'stock': stock_a.pk, 'order_type': 'buy', 'quantity': 1},
+            {'stock': str(stock_a.pk), 'order_type': 'buy', 'quantity': 2},
+            {'stock': True, 'order_type': 'buy', 'quantity': 1},
+        ]
+        resp = self.client.post(
+            reverse(self.endpoint_order_batch), data, format='json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('stock', resp.json()['orders'][2])
+
+        resp = self.client.post(
+            reverse(self.endpoint_order_batch), data[:2], format='json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([o['stock'] for o in resp.json()],
+                         [stock_a.name, digits.name])
+        self.assertEqual(trader.positions.get(stock=digits).net_shares, 2)
+
+
+class OrderQueueTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    @override_settings(ORDER_QUEUE=True)
+    def test_queued_orders(self):
+        """
+        Ensure orders are accepted as pending and later filled or rejected
+        in order, each seeing the effect of the ones before it
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        queued = [
+            self.place_order(self.TEST_STOCK_A, 10, 'buy', trader),
+            self.place_order(self.TEST_STOCK_A, 15, 'sell', trader),
+            self.place_order(self.TEST_STOCK_A, 4, 'sell', trader),
+            self.place_order(self.TEST_STOCK_B, 200, 'buy', trader),
+        ]
+        for d in queued:
+            self.assertEqual(d['resp'].status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(d['resp'].json()['status'], 'pending')
+            # Nothing is filled yet, nor priced
+            self.assertEqual(d['resp'].json()['amount'], 0)
+            self.assertEqual(d['balance_after_order'], 1000)
+        resp = self.client.post(reverse(self.endpoint_order_list), {
+            'stock': self.TEST_STOCK_A, 'order_type': 'hold', 'quantity': 1})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        call_command('processorders', once=True, batch_size=3,
+                     stdout=StringIO())
+        orders = [Order.objects.get(pk=d['resp'].json()['id'])
+                  for d in queued]
+        self.assertEqual([o.status for o in orders],
+                         ['success', 'rejected', 'success', 'rejected'])
+        self.assertEqual(orders[1].remarks,
+                         'Not enough stocks to sell. Available '
+                         f'{self.TEST_STOCK_A} shares: 10')
+        self.assertEqual(orders[3].remarks, 'Not enough stock! Available: 70')
+
+        price = TEST_STOCK_A.get('price')
+        self.assertEqual([o.amount for o in orders],
+                         [10 * price, 0, 4 * price, 0])
+        trader.refresh_from_db()
+        self.assertAlmostEqual(trader.balance, 1000 - 6 * price)
+        self.assertEqual(trader.positions.get().net_shares, 6)
+        self.assertEqual(Stock.objects.get(name=self.TEST_STOCK_A).quantity,
+                         TEST_STOCK_A['quantity'] - 6)
+        self.assertEqual(trader.cash_entries.filter(kind='order').count(), 2)
+
+    def test_claims_only_its_batch(self):
+        """
+        Ensure a worker fills only the pending orders it claimed, not
+        orders left 'processing' by another one
+        """
+        trader = User.objects.get(username=USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        other, mine = [Order.objects.create(
+            trader=trader, stock=stock, order_type='buy', quantity=1,
+            amount=0, status=status) for status in ('processing', 'pending')]
+
+        self.assertEqual(fill_pending_orders(), 1)
+        other.refresh_from_db()
+        mine.refresh_from_db()
+        self.assertEqual((other.status, mine.status),
+                         ('processing', 'success'))
+        self.assertEqual(fill_pending_orders(), 0)
+
+    def test_booked_when_filled(self):
+        """
+        Ensure an order queued across a bar boundary is booked in the
+        ledger and the bars at the time it filled
+        """
+        trader = User.objects.get(username=USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        queued_at = timezone.now() - timedelta(minutes=2)
+        order = Order.objects.create(
+            trader=trader, stock=stock, order_type='buy', quantity=4,
+            amount=0, status='pending')
+        Order.objects.filter(pk=order.pk).update(created_at=queued_at)
+        fill_pending_orders()
+        order.refresh_from_db()
+        self.assertNotEqual(bucket_start(queued_at, '1m'),
+                            bucket_start(order.updated_at, '1m'))
+
+        entry = trader.cash_entries.get(kind='order')
+        self.assertEqual(entry.created_at, order.updated_at)
+        before = order.updated_at - timedelta(microseconds=1)
+        self.assertAlmostEqual(
+            trader.balance_as_of(before) - order.amount,
+            trader.balance_as_of(order.updated_at))
+        bars = StockBar.objects.filter(interval='1m')
+        self.assertEqual(list(bars.values_list('start', flat=True)),
+                         [bucket_start(order.updated_at, '1m')])
+        # Rebuilt from the history at the same time
+        call_command('rebuildbars', stdout=StringIO())
+        self.assertEqual(list(bars.values_list('start', flat=True)),
+                         [bucket_start(order.updated_at, '1m')])
+
+
+class StockCacheTestCase(TradingAppEndpointTestCase):
+
+    def test_lookup_by_pk_and_name(self):
+        """
+        Ensure a stock fetched once is served from the cache by pk and name
+        """
+        cache = StockCache(maxsize=10)
+        stock = cache.get(name=self.TEST_STOCK_A)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get(pk=stock.pk).name, self.TEST_STOCK_A)
+            self.assertEqual(cache.get(name=self.TEST_STOCK_A).pk, stock.pk)
+        self.assertEqual(cache.stats().get('hits'), 2)
+        self.assertEqual(cache.stats().get('misses'), 1)
+        with self.assertRaises(Stock.DoesNotExist):
+            cache.get(name='UNKNOWN')
+
+    def test_invalidate_on_save_and_delete(self):
+        """
+        Ensure saving or deleting a stock drops it from the shared cache
+        """
+        stock = stock_cache.get(name=self.TEST_STOCK_B)
+        stock = Stock.objects.get(pk=stock.pk)
+        stock.name = 'RENAMED'
+        stock.save()
+        # Dropped once committed only
+        self.assertEqual(
+            stock_cache.get(pk=stock.pk).name, self.TEST_STOCK_B)
+        self.run_commit_hooks()
+        self.assertEqual(stock_cache.get(pk=stock.pk).name, 'RENAMED')
+        with self.assertRaises(Stock.DoesNotExist):
+            stock_cache.get(name=self.TEST_STOCK_B)
+
+        stock.delete()
+        self.run_commit_hooks()
+        with self.assertRaises(Stock.DoesNotExist):
+            stock_cache.get(name='RENAMED')
+
+    def test_cache_is_bounded(self):
+        cache = StockCache(maxsize=2)
+        cache.get(name=self.TEST_STOCK_A)
+        cache.get(name=self.TEST_STOCK_B)
+        self.assertEqual(cache.stats().get('size'), 2)
+
+    def assertStockList(self, trader, rows):
+        """ Ensure cached `rows` are what the serializer would produce """
+        request = APIRequestFactory().get('/')
+        request.user = trader.user
+        expected = StockSerializer(
+            Stock.objects.with_position(trader), many=True,
+            context={'request': request}).data
+        self.assertEqual(rows, json.loads(json.dumps(expected)))
+
+    def test_stock_list_tiers(self):
+        """
+        Ensure the stock list is assembled from the shared market rows and
+        each trader's overlay without a query once both are cached, and
+        that stock saves and orders drop the tiers they changed
+        """
+        endpoint = reverse(self.endpoint_stock_list)
+        trader_a = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', trader_a)
+        rows = self.client.get(endpoint).json()
+        self.assertStockList(trader_a, rows)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(endpoint).json(), rows)
+
+        # Another trader shares the market rows, not the overlay
+        trader_b = self.login_user(USERB.get('username')).profile
+        # Token lookup and overlay
+        with self.assertNumQueries(2):
+            rows = self.client.get(endpoint).json()
+        self.assertStockList(trader_b, rows)
+
+        self.place_order(self.TEST_STOCK_B, 5, 'buy', trader_b)
+        self.assertStockList(trader_b, self.client.get(endpoint).json())
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        stock.price = 42.0
+        stock.save()
+        self.run_commit_hooks()
+        self.assertStockList(trader_b, self.client.get(endpoint).json())
+
+        # Batched orders are bulk created, without post_save
+        self.client.post(reverse('order-batch'), {'orders': [
+            {'stock': self.TEST_STOCK_A, 'order_type': 'buy',
+             'quantity': 1}]}, format='json')
+        self.run_commit_hooks()
+        self.assertStockList(trader_b, self.client.get(endpoint).json())
+        self.login_user(USERA.get('username'))
+        self.assertStockList(trader_a, self.client.get(endpoint).json())
+
+
+class StockListCommitTestCase(TransactionTestCase):
+
+    def setUp(self) -> None:
+        stock_list_cache.clear()
+        user = User.objects.create(username='lister')
+        user.profile.balance = 100
+        user.profile.save()
+        self.trader = user.profile
+        self.stock = Stock.objects.create(name='LISTED', price=2.0,
+                                          quantity=50)
+
+    def read_list(self):
+        """ (market rows, overlay) as a request on another connection """
+        lists = []
+
+        def read():
+            try:
+                _, rows = stock_list_cache.market(load_market_rows)
+                _, invested = stock_list_cache.overlay(
+                    self.trader.pk, lambda: load_invested(self.trader))
+                lists.append((rows, invested))
+            finally:
+                connections.close_all()
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join()
+        return lists[0]
+
+    def test_read_inside_uncommitted_order(self):
+        """
+        Ensure a list reloaded while an order is uncommitted is dropped
+        when the order commits
+        """
+        self.read_list()
+        with transaction.atomic():
+            place_order(self.trader, self.stock, 'buy', 5)
+            rows, invested = self.read_list()
+            self.assertEqual(rows[0]['quantity'], 50)
+            self.assertEqual(invested, {})
+
+        rows, invested = self.read_list()
+        self.assertEqual(rows[0]['quantity'], 45)
+        self.assertEqual(invested[self.stock.pk]['net_shares'], 5)
+
+
+class TokenCacheTestCase(TradingAppEndpointTestCase):
+
+    def test_cached_identity(self):
+        """
+        Ensure a cached token costs no query, including the trader's
+        profile, and stops authenticating once logged out
+        """
+        user = self.login_user(USERA.get('username'))
+        endpoint = reverse('profile', kwargs={'pk': user.profile.pk})
+        self.client.get(endpoint)
+        # Only the profile being shown, joined with its user
+        with self.assertNumQueries(1):
+            resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        resp = self.client.post('/rest-auth/logout/')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_invalidate_on_token_delete_and_user_change(self):
+        endpoint = reverse(self.endpoint_stock_list)
+        user = self.login_user(USERA.get('username'))
+        self.assertEqual(self.client.get(endpoint).status_code,
+                         status.HTTP_200_OK)
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get(endpoint).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+        user.is_active = True
+        user.save()
+        self.assertEqual(self.client.get(endpoint).status_code,
+                         status.HTTP_200_OK)
+        Token.objects.filter(user=user).get().delete()
+        self.assertEqual(self.client.get(endpoint).status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+
+class OrderExportTestCase(TradingAppEndpointTestCase):
+
+    endpoint_order_export = 'order-export'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def export(self, **params):
+        resp = self.client.get(reverse(self.endpoint_order_export), params)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.streaming)
+        return b''.join(resp.streaming_content).decode()
+
+    def test_export_endpoint(self):
+        """
+        Ensure the trader's orders are streamed oldest first, as served by
+        the order endpoints, and filtered by stock and date range
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', trader)
+        self.place_order(self.TEST_STOCK_B, 5, 'buy', trader)
+        self.place_order(self.TEST_STOCK_A, 4, 'sell', trader)
+        self.place_order(
+            self.TEST_STOCK_A, 1, 'buy',
+            self.login_user(USERB.get('username')).profile)
+        self.login_user(USERA.get('username'))
+        served = self.client.get(reverse(self.endpoint_order_list)).json()
+
+        rows = list(csv.DictReader(StringIO(self.export())))
+        self.assertEqual([int(r['id']) for r in rows],
+                         [o['id'] for o in reversed(served)])
+        self.assertEqual(rows[0]['stock'], self.TEST_STOCK_A)
+        self.assertEqual(rows[0]['limit_price'], '')
+
+        orders = [json.loads(line) for line in self.export(
+            output='ndjson', stock=self.TEST_STOCK_A).splitlines()]
+        expected = [o for o in reversed(served)
+                    if o['stock'] == self.TEST_STOCK_A]
+        self.assertEqual(orders, [{f: o[f] for f in EXPORT_FIELDS}
+                                  for o in expected])
+
+        second = Order.objects.get(pk=orders[1]['id']).created_at
+        self.assertEqual(
+            len(self.export(output='ndjson', start=second).splitlines()), 1)
+        self.assertEqual(
+            len(self.export(output='ndjson', end=second).splitlines()), 2)
+
+        resp = self.client.get(reverse(self.endpoint_order_export),
+                               {'output': 'xml'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command(self):
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', trader)
+        self.place_order(self.TEST_STOCK_B, 5, 'buy', trader)
+        out = StringIO()
+        call_command('exportorders', trader=USERA.get('username'),
+                     output='ndjson', chunk_size=1, stdout=out)
+        self.assertEqual(out.getvalue(), self.export(output='ndjson'))
+        with self.assertRaises(CommandError):
+            call_command('exportorders', start='yesterday', stdout=out)
+
+    def test_memory_does_not_grow(self):
+        """
+        Ensure the peak memory of an export doesn't grow with its size
+        """
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        trader = User.objects.get(username=USERA.get('username')).profile
+        Order.objects.bulk_create([
+            Order(trader=trader, stock=stock, order_type='buy', quantity=1,
+                  filled_quantity=1, amount=10) for _ in range(5000)])
+
+        def peak(count):
+            orders = Order.objects.filter(
+                pk__in=Order.objects.order_by('pk')[:count])
+            tracemalloc.start()
+            for _ in export_lines([orders], 'csv', chunk_size=100):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+
+        self.assertLess(peak(5000), peak(500) * 2)
+
+
+class OrderArchiveTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def positions(self):
+        return list(Position.objects.order_by('trader', 'stock').values_list(
+            'trader', 'stock', 'bought_shares', 'bought_amount',
+            'sold_shares', 'sold_amount'))
+
+    def test_archive_old_orders(self):
+        """
+        Ensure only old final orders are archived, their totals carried
+        forward, and that positions, bars, order details and exports come
+        out the same as before
+        """
+        trader_a = self.login_user(USERA.get('username')).profile
+        trader_b = User.objects.get(username=USERB.get('username')).profile
+        stock_a = Stock.objects.get(name=self.TEST_STOCK_A)
+        stock_b = Stock.objects.get(name=self.TEST_STOCK_B)
+        old = [place_order(trader_a, stock_a, 'buy', 10),
+               place_order(trader_a, stock_a, 'sell', 4),
+               place_order(trader_a, stock_b, 'buy', 5),
+               Order.objects.create(
+                   trader=trader_a, stock=stock_b, order_type='buy',
+                   quantity=1, amount=0, status='rejected')]
+        place_order(trader_b, stock_a, 'buy', 5)
+        kept = [place_limit_order(trader_b, stock_a, 'sell', 2, 11.0),
+                place_limit_order(trader_a, stock_a, 'buy', 2, 11.0),
+                place_limit_order(trader_a, stock_b, 'buy', 1, 1.0)]
+        Order.objects.update(created_at=timezone.now() - timedelta(days=100))
+        kept.append(place_order(trader_a, stock_b, 'buy', 1))
+
+        detail = reverse(self.endpoint_order_detail, kwargs={'pk': old[1].pk})
+        served = self.client.get(detail).json()
+        export = self.client.get(reverse('order-export'))
+        export = b''.join(export.streaming_content)
+        positions = self.positions()
+        call_command('rebuildbars', stdout=StringIO())
+        bars = list(StockBar.objects.values_list(
+            'stock', 'interval', 'start', 'volume', 'notional', 'trades'))
+
+        out = StringIO()
+        call_command('archiveorders', batch_size=2, stdout=out)
+        self.assertIn('Archived 5 orders', out.getvalue())
+        self.assertEqual(set(Order.objects.values_list('pk', flat=True)),
+                         {o.pk for o in kept})
+        self.assertEqual(ArchivedOrder.objects.count(), 5)
+        carry = PositionCarry.objects.get(trader=trader_a, stock=stock_a)
+        self.assertEqual(
+            (carry.bought_shares, carry.sold_shares, carry.orders),
+            (10, 4, 2))
+        self.assertEqual(PositionCarry.objects.get(
+            trader=trader_a, stock=stock_b).orders, 2)
+
+        # Old orders are still served, by id and in exports, not listed
+        self.assertEqual(self.client.get(detail).json(), served)
+        self.assertNotIn(old[1].pk, [o['id'] for o in self.client.get(
+            reverse(self.endpoint_order_list)).json()])
+        resp = self.client.get(reverse('order-export'))
+        self.assertEqual(b''.join(resp.streaming_content), export)
+
+        self.assertEqual(self.positions(), positions)
+        call_command('rebuildpositions', stdout=StringIO())
+        self.assertEqual(self.positions(), positions)
+        call_command('rebuildbars', stdout=StringIO())
+        self.assertEqual(list(StockBar.objects.values_list(
+            'stock', 'interval', 'start', 'volume', 'notional', 'trades')),
+            bars)
+
+        call_command('archiveorders', stdout=out)
+        self.assertEqual(ArchivedOrder.objects.count(), 5)
+
+
+class CostBasisTestCase(TradingAppEndpointTestCase):
+
+    endpoint_portfolio = 'portfolio'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def trade(self):
+        """ Buy 10 shares at 9.5 and 10 at 12, sell 15 at 11 """
+        trader = self.login_user(USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        place_order(trader, stock, 'buy', 10)
+        Stock.objects.filter(pk=stock.pk).update(price=12.0)
+        second = place_order(trader, stock, 'buy', 10)
+        Stock.objects.filter(pk=stock.pk).update(price=11.0)
+        stock_cache.clear()
+        resp = self.place_order(self.TEST_STOCK_A, 15, 'sell', trader)['resp']
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return trader, stock, second
+
+    def verify(self):
+        out = StringIO()
+        call_command('rebuildlots', verify=True, stdout=out)
+        return out.getvalue()
+
+    def test_fifo(self):
+        trader, stock, second = self.trade()
+        position = trader.positions.get()
+        self.assertAlmostEqual(position.cost_basis, 5 * 12.0)
+        self.assertAlmostEqual(position.realized_pnl,
+                               15 * 11.0 - (10 * 9.5 + 5 * 12.0))
+        self.assertEqual(
+            list(trader.lots.filter(remaining__gt=0).values_list(
+                'order_id', 'remaining')), [(second.pk, 5)])
+
+        invested = self.client.get(reverse(
+            self.endpoint_stock_detail, kwargs={'pk': stock.pk})).json()[
+                'invested']
+        self.assertAlmostEqual(invested['cost_basis'], 60.0)
+        self.assertAlmostEqual(invested['realized_pnl'], 10.0)
+        data = self.client.get(reverse(self.endpoint_portfolio)).json()
+        self.assertAlmostEqual(data['holdings'][0]['unrealized_gain'],
+                               5 * 11.0 - 60.0)
+        self.assertAlmostEqual(data['totals']['realized_pnl'], 10.0)
+
+        self.assertIn('All 1 positions match', self.verify())
+        Position.objects.update(realized_pnl=0)
+        with self.assertRaises(CommandError):
+            self.verify()
+        call_command('rebuildlots', stdout=StringIO())
+        self.assertIn('All 1 positions match', self.verify())
+        self.assertAlmostEqual(trader.positions.get().realized_pnl, 10.0)
+
+    @override_settings(COST_BASIS_METHOD='average')
+    def test_average_cost(self):
+        trader, _, _ = self.trade()
+        position = trader.positions.get()
+        average = (10 * 9.5 + 10 * 12.0) / 20
+        self.assertAlmostEqual(position.cost_basis, 5 * average)
+        self.assertAlmostEqual(position.realized_pnl,
+                               15 * 11.0 - 15 * average)
+        self.assertIn('All 1 positions match', self.verify())
+
+        place_order(trader, Stock.objects.get(pk=position.stock_id),
+                    'sell', 5)
+        position.refresh_from_db()
+        self.assertEqual(position.cost_basis, 0)
+        self.assertAlmostEqual(position.realized_pnl,
+                               20 * 11.0 - 20 * average)
+
+    def test_every_fill_path(self):
+        """
+        Ensure batch, queued and limit order fills keep the lots in step
+        with the history
+        """
+        buyer = User.objects.get(username=USERA.get('username')).profile
+        seller = User.objects.get(username=USERB.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        place_orders(seller, [
+            {'stock': stock.name, 'order_type': 'buy', 'quantity': 20},
+            {'stock': stock.name, 'order_type': 'sell', 'quantity': 5}])
+        Order.objects.create(
+            trader=seller, stock=stock, order_type='sell', quantity=3,
+            amount=0, status='pending')
+        fill_pending_orders()
+        Stock.objects.filter(pk=stock.pk).update(price=10.0)
+        place_limit_order(seller, stock, 'sell', 8, 10.0)
+        place_limit_order(buyer, stock, 'buy', 6, 10.5)
+        place_order(buyer, stock, 'sell', 2)
+
+        self.assertEqual(
+            sum(Lot.objects.filter(trader=seller).values_list(
+                'remaining', flat=True)), 20 - 5 - 3 - 6)
+        self.assertAlmostEqual(
+            buyer.positions.get().realized_pnl, 2 * 10.0 - 2 * 10.0)
+        self.assertIn('All 2 positions match', self.verify())
+
+    def test_resting_sell_still_held(self):
+        """
+        Ensure the shares a resting limit sell reserved are valued with the
+        holdings until the sell fills
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        Stock.objects.filter(pk=stock.pk).update(price=10.0)
+        stock_cache.clear()
+        place_order(trader, stock, 'buy', 10)
+        place_limit_order(trader, stock, 'sell', 5, 12.0)
+
+        data = self.client.get(reverse(self.endpoint_portfolio)).json()
+        self.assertEqual(
+            {k: data['holdings'][0][k] for k in (
+                'shares', 'cost_basis', 'market_value', 'unrealized_gain')},
+            {'shares': 10, 'cost_basis': 100.0, 'market_value': 100.0,
+             'unrealized_gain': 0.0})
+        self.assertAlmostEqual(data['net_worth'], 1000.0)
+        invested = self.client.get(reverse(
+            self.endpoint_stock_detail, kwargs={'pk': stock.pk})).json()[
+                'invested']
+        self.assertEqual((invested['net_shares'], invested['held_shares']),
+                         (5, 10))
+
+        buyer = User.objects.get(username=USERB.get('username')).profile
+        place_limit_order(buyer, stock, 'buy', 5, 12.0)
+        data = self.client.get(reverse(self.endpoint_portfolio)).json()
+        self.assertEqual(
+            (data['holdings'][0]['shares'], data['holdings'][0]['cost_basis']),
+            (5, 50.0))
+        self.assertAlmostEqual(data['net_worth'], 900 + 60 + 5 * 12.0)
+        self.assertIn('All 2 positions match', self.verify())
+
+    def test_lots_replayed_by_migration(self):
+        """
+        Ensure positions opened before the lots existed get theirs from
+        the order history when migrating
+        """
+        trader, stock, second = self.trade()
+        expected = trader.positions.values(
+            'held_shares', 'cost_basis', 'realized_pnl').get()
+        lot_columns = ('order_id', 'quantity', 'remaining', 'price')
+        lots = list(Lot.objects.order_by('id').values_list(*lot_columns))
+        Lot.objects.all().delete()
+        Position.objects.update(held_shares=0, cost_basis=0, realized_pnl=0)
+        with self.assertRaises(CommandError):
+            self.verify()
+
+        migration = importlib.import_module(
+            'tradingapp.migrations.0014_replay_lots')
+        # Written in more than one chunk
+        with mock.patch.object(migration, 'CHUNK_SIZE', 1):
+            migration.replay_lots(apps, None)
+        self.assertEqual(trader.positions.values(
+            'held_shares', 'cost_basis', 'realized_pnl').get(), expected)
+        self.assertEqual(
+            list(Lot.objects.order_by('id').values_list(*lot_columns)), lots)
+        self.assertIn('All 1 positions match', self.verify())
+
+
+class UpgradeMigrationTestCase(TransactionTestCase):
+    baseline = [('tradingapp', '0001_initial'), ('profiles', '0001_initial')]
+
+    def migrate(self, targets):
+        """ Migrate to `targets` and return the apps of that state """
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self) -> None:
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_positions_from_existing_orders(self):
+        """
+        Ensure a database with orders from before the positions existed
+        gets a position and lots per (trader, stock) when migrating
+        """
+        old_apps = self.migrate(self.baseline)
+        user = old_apps.get_model('auth', 'User').objects.create(
+            username='holder')
+        trader = old_apps.get_model('profiles', 'Profile').objects.create(
+            user=user, balance=1000)
+        Stock = old_apps.get_model('tradingapp', 'Stock')
+        stock = Stock.objects.create(name='OLD', price=10.0)
+        other = Stock.objects.create(name='OTHER', price=5.0)
+        Order = old_apps.get_model('tradingapp', 'Order')
+        for stock_obj, order_type, quantity, amount in [
+                (stock, 'buy', 10, 100.0), (stock, 'sell', 4, 48.0),
+                (other, 'buy', 2, 10.0)]:
+            Order.objects.create(trader=trader, stock=stock_obj,
+                                 order_type=order_type, quantity=quantity,
+                                 amount=amount)
+
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        self.assertEqual(
+            list(Position.objects.filter(trader_id=trader.pk).order_by(
+                'stock__name').values_list(
+                    'stock__name', 'bought_shares', 'bought_amount',
+                    'sold_shares', 'sold_amount', 'held_shares')),
+            [('OLD', 10, 100.0, 4, 48.0, 6), ('OTHER', 2, 10.0, 0, 0.0, 2)])
+        self.assertEqual(
+            list(Lot.objects.filter(stock_id=stock.pk).values_list(
+                'quantity', 'remaining')), [(10, 6)])
+
+
+class LoadTicksCommandTestCase(TradingAppEndpointTestCase):
+
+    def test_load_csv_ticks(self):
+        """
+        Ensure the last tick of every symbol wins and bad rows are skipped
+        """
+        feed = NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with feed:
+            feed.write('symbol,price\n')
+            feed.write(f'{self.TEST_STOCK_A},10.5\n')
+            feed.write(f'{self.TEST_STOCK_B},3.25\n')
+            feed.write(f'{self.TEST_STOCK_A},11.0\n')
+            feed.write('UNKNOWN,1.0\n')
+            feed.write(f'{self.TEST_STOCK_B},not-a-price\n')
+            feed.write(f'{self.TEST_STOCK_B},inf\n')
+        self.addCleanup(os.remove, feed.name)
+
+        out = StringIO()
+        call_command('loadticks', feed.name, window=60, stdout=out)
+        self.assertIn('4 ticks', out.getvalue())
+        self.assertIn('2 invalid', out.getvalue())
+        self.assertIn('1 unknown symbols', out.getvalue())
+        self.assertEqual(
+            Stock.objects.get(name=self.TEST_STOCK_A).price, 11.0)
+        self.assertEqual(
+            Stock.objects.get(name=self.TEST_STOCK_B).price, 3.25)
+
+    def test_load_jsonl_ticks(self):
+        feed = NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        with feed:
+            feed.write(json.dumps(
+                {'symbol': self.TEST_STOCK_A, 'price': 8.0}) + '\n')
+            feed.write('{"symbol": broken\n')
+        self.addCleanup(os.remove, feed.name)
+
+        stock_cache.get(name=self.TEST_STOCK_A)
+        call_command('loadticks', feed.name, stdout=StringIO())
+        self.run_commit_hooks()
+        self.assertEqual(stock_cache.get(name=self.TEST_STOCK_A).price, 8.0)
+
+    def test_bad_prices_skipped(self):
+        """
+        Ensure non-finite, zero and negative prices are counted invalid and
+        never written
+        """
+        feed = NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        with feed:
+            for price in ('NaN', 'Infinity', '-Infinity', '0', '-2.5'):
+                feed.write(
+                    f'{{"symbol": "{self.TEST_STOCK_A}", "price": {price}}}\n')
+            feed.write(json.dumps({'symbol': self.TEST_STOCK_B,
+                                   'price': 'nan'}) + '\n')
+        self.addCleanup(os.remove, feed.name)
+
+        out = StringIO()
+        call_command('loadticks', feed.name, stdout=out)
+        self.assertIn('6 invalid', out.getvalue())
+        self.assertIn('0 price updates', out.getvalue())
+        self.assertEqual(Stock.objects.get(name=self.TEST_STOCK_A).price,
+                         TEST_STOCK_A.get('price'))
+
+    def test_idle_feed_flushed(self):
+        """
+        Ensure the last window of a feed that goes quiet is written without
+        waiting for another tick or the end of the feed
+        """
+        read_end, write_end = os.pipe()
+        flushed, closed = [], []
+
+        def on_flush(sender, stocks, **kwargs):
+            flushed.append((time.monotonic(), [s.price for s in stocks]))
+
+        def feed():
+            with os.fdopen(write_end, 'w') as pipe:
+                pipe.write(f'{self.TEST_STOCK_A},12.5\n')
+                pipe.flush()
+                time.sleep(1)
+                closed.append(time.monotonic())
+
+        prices_updated.connect(on_flush)
+        self.addCleanup(prices_updated.disconnect, on_flush)
+        writer = threading.Thread(target=feed)
+        writer.start()
+        with os.fdopen(read_end) as stdin, mock.patch('sys.stdin', stdin):
+            call_command('loadticks', window=0.05, stdout=StringIO())
+        writer.join()
+        self.assertEqual(flushed[0][1], [12.5])
+        self.assertLess(flushed[0][0], closed[0])
+
+
+class LoadStocksCommandTestCase(TradingAppEndpointTestCase):
+
+    def test_load_stocks(self):
+        """
+        Ensure new stocks are created, known ones updated and invalid rows
+        reported without stopping the load
+        """
+        Stock.objects.create(name='OLD', price=1.0, quantity=5)
+        source = NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with source:
+            source.write('name,price,quantity\n')
+            source.write('OLD,12.5,80\n')
+            source.write('NEW_A,3.5,10\n')
+            source.write('NEW_B,4\n')
+            source.write('NEW_C,free,10\n')
+            source.write('A_VERY_LONG_NAME,1,1\n')
+            source.write('NEW_D,nan,10\n')
+            source.write('NEW_E,inf,10\n')
+            source.write('NEW_F,0,10\n')
+        self.addCleanup(os.remove, source.name)
+
+        out, err = StringIO(), StringIO()
+        call_command('loadstocks', source.name, chunk_size=2,
+                     stdout=out, stderr=err)
+        self.assertIn('2 created, 1 updated, 5 invalid rows', out.getvalue())
+        for line in (5, 6, 7, 8, 9):
+            self.assertIn(f'Line {line}', err.getvalue())
+        self.assertIn('invalid price 0.0', err.getvalue())
+
+        stock = Stock.objects.get(name='OLD')
+        self.assertEqual((stock.price, stock.quantity), (12.5, 80))
+        self.assertEqual(Stock.objects.get(name='NEW_B').quantity, 100)
+        self.assertFalse(Stock.objects.filter(
+            name__in=['NEW_C', 'NEW_F']).exists())
+
+
+class OrderBookTestCase(SimpleTestCase):
+
+    def test_price_time_priority(self):
+        """
+        Ensure incoming orders fill against the best price first, the
+        oldest order first within a price, and at the resting price
+        """
+        book = OrderBook(1)
+        book.add(BookOrder(1, 10, 'sell', 10.5, 5))
+        book.add(BookOrder(2, 10, 'sell', 10.0, 5))
+        book.add(BookOrder(3, 11, 'sell', 10.0, 5))
+        book.add(BookOrder(4, 12, 'buy', 9.0, 5))
+        self.assertEqual((book.best_bid(), book.best_ask()), (9.0, 10.0))
+
+        fills = book.match('buy', 10.5, 12)
+        self.assertEqual(
+            [(f.maker.id, f.quantity, f.price) for f in fills],
+            [(2, 5, 10.0), (3, 5, 10.0), (1, 2, 10.5)])
+        self.assertEqual(book.best_ask(), 10.5)
+        self.assertEqual(book.orders[1].remaining, 3)
+
+        # Doesn't cross: nothing fills
+        self.assertEqual(book.match('sell', 9.5, 5), [])
+        self.assertEqual(book.cancel(1).id, 1)
+        self.assertIsNone(book.cancel(1))
+        self.assertIsNone(book.best_ask())
+        self.assertEqual(book.depth(), {
+            'bids': [(9.0, 5, 1)], 'asks': []})
+
+
+class LimitOrderTestCase(TradingAppEndpointTestCase):
+
+    endpoint_order_cancel = 'order-cancel'
+    endpoint_stock_book = 'stock-book'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def limit_order(self, order_type, quantity, limit_price):
+        return self.client.post(reverse(self.endpoint_order_list), {
+            'stock': self.TEST_STOCK_A, 'order_type': order_type,
+            'quantity': quantity, 'limit_price': limit_price})
+
+    def test_limit_orders_match(self):
+        """
+        Ensure crossing limit orders trade at the resting price, settle
+        both traders and leave the unfilled rest in the book
+        """
+        seller = self.login_user(USERB.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 20, 'buy', seller)
+        resp = self.limit_order('sell', 10, 10.0)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.json()['status'], 'open')
+        # The shares on offer can't be sold twice
+        self.assertEqual(seller.positions.get().net_shares, 10)
+        resp = self.limit_order('sell', 11, 12.0)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        buyer = self.login_user(USERA.get('username')).profile
+        resp = self.limit_order('buy', 15, 10.5)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        order = resp.json()
+        self.assertEqual(
+            (order['status'], order['filled_quantity'], order['amount'],
+             order['price_per_share']), ('partial', 10, 100.0, 10.0))
+
+        trade = Trade.objects.get()
+        self.assertEqual((trade.price, trade.quantity), (10.0, 10))
+        buyer.refresh_from_db()
+        seller.refresh_from_db()
+        # 15 reserved at 10.5, 10 of them filled at 10.0
+        self.assertAlmostEqual(buyer.balance, 1000 - 15 * 10.5 + 10 * 0.5)
+        self.assertAlmostEqual(seller.balance, 500 - 20 * 9.5 + 100)
+        self.assertEqual(buyer.positions.get().bought_shares, 10)
+        self.assertEqual(seller.positions.get().sold_amount, 100)
+        self.assertEqual(
+            Stock.objects.get(name=self.TEST_STOCK_A).price, 10.0)
+
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        resp = self.client.get(reverse(
+            self.endpoint_stock_book, kwargs={'pk': stock.pk}))
+        self.assertEqual(resp.json()['bids'], [[10.5, 5, 1]])
+        self.assertIsNone(resp.json()['best_ask'])
+
+        resp = self.client.post(reverse(
+            self.endpoint_order_cancel, kwargs={'pk': order['id']}))
+        self.assertEqual(resp.json()['status'], 'cancelled')
+        buyer.refresh_from_db()
+        self.assertAlmostEqual(buyer.balance, 1000 - 100)
+        resp = self.client.post(reverse(
+            self.endpoint_order_cancel, kwargs={'pk': order['id']}))
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Positions can be rebuilt from the orders
+        expected = list(Position.objects.order_by('trader').values())
+        call_command('rebuildpositions', stdout=StringIO())
+        self.assertEqual(
+            [dict(p, id=None, updated_at=None) for p in
+             Position.objects.order_by('trader').values()],
+            [dict(p, id=None, updated_at=None) for p in expected])
+
+    def test_book_rebuilt_from_database(self):
+        """
+        Ensure resting orders survive a restart of the matching engine
+        """
+        self.login_user(USERA.get('username'))
+        first = self.limit_order('buy', 5, 9.0).json()
+        second = self.limit_order('buy', 5, 9.0).json()
+        engine.clear()
+
+        book = engine.book(Stock.objects.get(name=self.TEST_STOCK_A).pk)
+        self.assertEqual(book.best_bid(), 9.0)
+        self.assertEqual([o.id for o in book.bids.levels[9.0]],
+                         [first['id'], second['id']])
+
+    def engines_fill(self, trust_version):
+        """
+        A sell resting in two processes' books is bought through the first,
+        then through the second, whose book still holds it
+        """
+        first, second = MatchingEngine(), MatchingEngine()
+        seller = self.login_user(USERB.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', seller)
+        buyer = self.login_user(USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        with mock.patch('tradingapp.services.engine', first):
+            sell = place_limit_order(seller, stock, 'sell', 10, 10.0)
+        version = Stock.objects.get(pk=stock.pk).book_version
+        self.assertEqual(second.book(stock.pk, version).best_ask(), 10.0)
+
+        with mock.patch('tradingapp.services.engine', first):
+            self.assertEqual(
+                place_limit_order(buyer, stock, 'buy', 10, 10.5).status,
+                'success')
+        if trust_version:
+            # As if the version had not moved: only the database can tell
+            second.books[stock.pk].version = \
+                Stock.objects.get(pk=stock.pk).book_version
+        with mock.patch('tradingapp.services.engine', second):
+            order = place_limit_order(buyer, stock, 'buy', 10, 10.5)
+
+        self.assertEqual((order.status, order.filled_quantity), ('open', 0))
+        sell.refresh_from_db()
+        self.assertEqual((sell.status, sell.filled_quantity), ('success', 10))
+        self.assertEqual(Trade.objects.count(), 1)
+        seller.refresh_from_db()
+        buyer.refresh_from_db()
+        self.assertAlmostEqual(seller.balance, 500 - 10 * 9.5 + 100)
+        self.assertAlmostEqual(buyer.balance, 1000 - 100 - 10 * 10.5)
+        self.assertIsNone(second.book(stock.pk).best_ask())
+        self.assertEqual(second.book(stock.pk).best_bid(), 10.5)
+
+    def test_engines_share_database(self):
+        """
+        Ensure a process reloads its book after another one changed it
+        """
+        self.engines_fill(trust_version=False)
+
+    def test_stale_book_rolled_back(self):
+        """
+        Ensure a resting order already filled in the database is never
+        filled again, even from a book that looks current
+        """
+        self.engines_fill(trust_version=True)
+
+    def test_stale_book_retries_bounded(self):
+        """
+        Ensure an order whose book stays stale is given up after
+        LIMIT_ORDER_ATTEMPTS matches, with nothing written
+        """
+        seller = self.login_user(USERB.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', seller)
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        place_limit_order(seller, stock, 'sell', 10, 10.0)
+        buyer = self.login_user(USERA.get('username')).profile
+
+        with mock.patch('tradingapp.services._settle',
+                        side_effect=StaleBook) as settle:
+            with self.assertRaises(ValidationError):
+                place_limit_order(buyer, stock, 'buy', 10, 10.5)
+        self.assertEqual(settle.call_count, settings.LIMIT_ORDER_ATTEMPTS)
+        buyer.refresh_from_db()
+        self.assertEqual(buyer.balance, 1000)
+        self.assertFalse(buyer.orders.exists())
+
+
+class StockBarTestCase(TradingAppEndpointTestCase):
+
+    endpoint_stock_history = 'stock-history'
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def bars(self, interval):
+        return list(StockBar.objects.filter(interval=interval).values(
+            'stock', 'start', 'open', 'high', 'low', 'close', 'volume',
+            'notional', 'trades'))
+
+    def test_bars_follow_orders(self):
+        """
+        Ensure every filled order, single or batched, is folded into the
+        bars of every interval and rejected orders are not
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 10, 'buy', trader)
+        Stock.objects.filter(name=self.TEST_STOCK_A).update(price=12.0)
+        stock_cache.clear()
+        self.place_order(self.TEST_STOCK_A, 4, 'sell', trader)
+        self.place_order(self.TEST_STOCK_A, 500, 'buy', trader)
+        Stock.objects.filter(name=self.TEST_STOCK_A).update(price=11.0)
+        self.client.post(reverse('order-batch'), {'orders': [
+            {'stock': self.TEST_STOCK_A, 'order_type': 'buy', 'quantity': 2},
+        ]}, format='json')
+
+        price = TEST_STOCK_A.get('price')
+        for interval in INTERVALS:
+            bars = self.bars(interval)
+            self.assertEqual(bars[0]['open'], price)
+            self.assertEqual(bars[-1]['close'], 11.0)
+            self.assertEqual(max(b['high'] for b in bars), 12.0)
+            self.assertEqual(min(b['low'] for b in bars), price)
+            self.assertEqual(sum(b['volume'] for b in bars), 16)
+            self.assertEqual(sum(b['trades'] for b in bars), 3)
+            self.assertAlmostEqual(sum(b['notional'] for b in bars),
+                                   10 * price + 4 * 12.0 + 2 * 11.0)
+
+    def test_rebuild_bars(self):
+        """
+        Ensure rebuildbars restores the incrementally maintained bars and
+        --since leaves older days alone
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 30, 'buy', trader)
+        self.place_order(self.TEST_STOCK_B, 10, 'buy', trader)
+        self.place_order(self.TEST_STOCK_A, 5, 'sell', trader)
+        expected = {i: self.bars(i) for i in INTERVALS}
+
+        StockBar.objects.all().delete()
+        call_command('rebuildbars', stdout=StringIO())
+        self.assertEqual({i: self.bars(i) for i in INTERVALS}, expected)
+
+        day = bucket_start(timezone.now(), '1d')
+        StockBar.objects.create(
+            stock=Stock.objects.get(name=self.TEST_STOCK_B), interval='1d',
+            start=day - timedelta(days=3), open=1, high=1, low=1, close=1)
+        StockBar.objects.filter(start__gte=day).update(volume=0)
+        call_command('rebuildbars', since=day.date().isoformat(),
+                     stock=[self.TEST_STOCK_A, self.TEST_STOCK_B],
+                     stdout=StringIO())
+        self.assertTrue(StockBar.objects.filter(
+            start=day - timedelta(days=3)).exists())
+        self.assertEqual(self.bars('1h'), expected['1h'])
+
+    def test_history_endpoint(self):
+        self.login_user(USERA.get('username'))
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        start = bucket_start(timezone.now(), '1d')
+        StockBar.objects.bulk_create([
+            StockBar(stock=stock, interval='1h', start=start + timedelta(
+                hours=h), open=h, high=h + 1, low=h, close=h + 1, volume=h,
+                notional=h * h, trades=1)
+            for h in range(5)])
+        endpoint = reverse(self.endpoint_stock_history,
+                           kwargs={'pk': stock.pk})
+
+        # Token lookup and the bars, the stock comes from the cache
+        stock_cache.get(pk=stock.pk)
+        with self.assertNumQueries(2):
+            resp = self.client.get(endpoint, {
+                'interval': '1h',
+                'start': (start + timedelta(hours=1)).isoformat(),
+                'end': (start + timedelta(hours=3)).isoformat()})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.json()['stock'], self.TEST_STOCK_A)
+        self.assertEqual([b['open'] for b in resp.json()['bars']], [1, 2])
+        self.assertEqual(set(resp.json()['bars'][0]), {
+            'start', 'open', 'high', 'low', 'close', 'volume', 'notional',
+            'trades'})
+
+        # Latest bars first trimmed, then returned oldest first
+        resp = self.client.get(endpoint, {'limit': 2})
+        self.assertEqual([b['open'] for b in resp.json()['bars']], [3, 4])
+        resp = self.client.get(endpoint, {'interval': '1d'})
+        self.assertEqual(resp.json()['bars'], [])
+
+        resp = self.client.get(endpoint, {'interval': '5m'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get(reverse(
+            self.endpoint_stock_history, kwargs={'pk': stock.pk + 100}))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BenchHelpersTestCase(TransactionTestCase):
+
+    def test_seed(self):
+        tokens = seed(traders=3, stocks=4, orders=60)
+        self.assertEqual(len(tokens), 3)
+        self.assertEqual(Stock.objects.count(), 4)
+        self.assertEqual(Order.objects.count(), 60)
+        self.assertEqual(
+            Position.objects.aggregate(n=Sum('bought_shares'))['n'],
+            Order.objects.filter(order_type='buy').aggregate(
+                n=Sum('quantity'))['n'])
+
+    def test_percentiles(self):
+        samples = [i / 1000 for i in range(1, 101)]
+        stats = summarize(samples)
+        self.assertAlmostEqual(stats['p50_ms'], 50)
+        self.assertAlmostEqual(stats['p95_ms'], 95)
+        self.assertAlmostEqual(stats['p99_ms'], 99)
+
+
+class ConditionalGetTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    def assertNotModified(self, endpoint, etag, queries=1):
+        # The version queries only
+        with self.assertNumQueries(queries):
+            resp = self.client.get(endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp['ETag'], etag)
+
+    def test_stock_etags(self):
+        """
+        Ensure stock validators change with the stock and with the
+        trader's position on it, and match answers 304 without the
+        position aggregates or serialization
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        detail = reverse(self.endpoint_stock_detail, kwargs={'pk': stock.pk})
+        listing = reverse(self.endpoint_stock_list)
+        etags = {}
+        for endpoint, queries in ((detail, 1), (listing, 0)):
+            resp = self.client.get(endpoint)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertIn('Authorization', resp['Vary'])
+            etags[endpoint] = resp['ETag']
+            self.assertNotModified(endpoint, etags[endpoint], queries)
+
+        self.place_order(self.TEST_STOCK_A, 5, 'buy', trader)
+        for endpoint in (detail, listing):
+            resp = self.client.get(
+                endpoint, HTTP_IF_NONE_MATCH=etags[endpoint])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(resp['ETag'], etags[endpoint])
+            etags[endpoint] = resp['ETag']
+
+        Stock.objects.filter(pk=stock.pk).update(
+            price=10.0, updated_at=timezone.now())
+        resp = self.client.get(detail, HTTP_IF_NONE_MATCH=etags[detail])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        # Another trader gets its own validators
+        self.login_user(USERB.get('username'))
+        resp = self.client.get(listing, HTTP_IF_NONE_MATCH=etags[listing])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_order_etags(self):
+        trader = self.login_user(USERA.get('username')).profile
+        self.place_order(self.TEST_STOCK_A, 5, 'buy', trader)
+        order = trader.orders.get()
+        detail = reverse(self.endpoint_order_detail, kwargs={'pk': order.pk})
+        listing = reverse(self.endpoint_order_list)
+        etags = {e: self.client.get(e)['ETag'] for e in (detail, listing)}
+        for endpoint, etag in etags.items():
+            self.assertNotModified(endpoint, etag)
+        self.assertNotEqual(
+            self.client.get(listing, {'page_size': 1})['ETag'],
+            etags[listing])
+
+        self.place_order(self.TEST_STOCK_B, 5, 'buy', trader)
+        resp = self.client.get(listing, HTTP_IF_NONE_MATCH=etags[listing])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.json()), 2)
+        self.assertNotModified(detail, etags[detail])
+
+        Order.objects.filter(pk=order.pk).update(
+            remarks='checked', updated_at=timezone.now())
+        resp = self.client.get(detail, HTTP_IF_NONE_MATCH=etags[detail])
+        self.assertEqual(resp.json()['remarks'], 'checked')
+
+    def test_bad_pk(self):
+        """ Ensure a pk that is not an integer is still answered with 404 """
+        self.login_user(USERA.get('username'))
+        for name in (self.endpoint_stock_detail, self.endpoint_order_detail):
+            endpoint = reverse(name, kwargs={'pk': 'abc'})
+            resp = self.client.get(endpoint, HTTP_IF_NONE_MATCH='"abc"')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class StreamTestCase(TradingAppEndpointTestCase):
+
+    def test_broker_fan_out(self):
+        """
+        Ensure price events reach the symbol's subscribers, order events
+        the trader's, and new subscribers get the current prices first
+        """
+        broker = Broker()
+        a = Subscriber(1, {'A'})
+        b = Subscriber(2, {'A', 'B'})
+        broker.subscribe(a)
+        broker.subscribe(b)
+        broker.publish_price('B', 2.0, timezone.now())
+        broker.publish_order(1, {'id': 7, 'status': 'success'})
+        self.assertEqual(a.queue.qsize(), 1)
+        self.assertTrue(a.queue.get_nowait().startswith(b'event: order'))
+        self.assertIn(b'"price": 2.0', b.queue.get_nowait())
+
+        late = Subscriber(3, {'B'})
+        broker.subscribe(late)
+        self.assertIn(b'"stock": "B"', late.queue.get_nowait())
+        broker.unsubscribe(late)
+        broker.unsubscribe(b)
+        self.assertEqual(broker.traders(), [1])
+        self.assertNotIn('B', broker.by_symbol)
+
+        slow = Subscriber(4, {'A'}, maxsize=1)
+        broker.subscribe(slow)
+        broker.publish_price('A', 1.0, timezone.now())
+        broker.publish_price('A', 1.5, timezone.now())
+        self.assertEqual(slow.dropped, 1)
+
+    def test_change_poller(self):
+        """
+        Ensure only changed prices and changed orders of the subscribed
+        traders are reported, each change once
+        """
+        trader = self.login_user(USERA.get('username')).profile
+        poller = ChangePoller()
+        prices, orders = poller.poll([trader.pk])
+        self.assertEqual({p[0] for p in prices},
+                         {self.TEST_STOCK_A, self.TEST_STOCK_B})
+        self.assertEqual(orders, [])
+
+        self.place_order(self.TEST_STOCK_A, 5, 'buy', trader)
+        Stock.objects.filter(name=self.TEST_STOCK_B).update(
+            price=6.0, updated_at=timezone.now())
+        prices, orders = poller.poll([trader.pk])
+        self.assertEqual([p[:2] for p in prices], [(self.TEST_STOCK_B, 6.0)])
+        self.assertEqual(
+            [(t, o['status'], o['stock']) for t, o in orders],
+            [(trader.pk, 'success', self.TEST_STOCK_A)])
+        self.assertEqual(poller.poll([trader.pk]), ([], []))
+        self.logout_user()
+
+        # Changed stocks are found through the updated_at index
+        with CaptureQueriesContext(connection) as polled:
+            poller.poll([trader.pk])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'EXPLAIN QUERY PLAN ' + polled.captured_queries[0]['sql'])
+            self.assertIn('stock_updated_idx', str(cursor.fetchall()))
+
+    def test_change_poller_chunks_traders(self):
+        """
+        Ensure the orders of more subscribed traders than fit in one query
+        are all reported
+        """
+        traders = [User.objects.get(**user).profile for user in (
+            {'username': USERA.get('username')},
+            {'username': USERB.get('username')})]
+        stock = Stock.objects.get(name=self.TEST_STOCK_A)
+        poller = ChangePoller()
+        poller.poll([])
+        for trader in traders:
+            place_order(trader, stock, 'buy', 1)
+
+        with mock.patch('tradingapp.stream.CHUNK_SIZE', 1), \
+                CaptureQueriesContext(connection) as polled:
+            _, orders = poller.poll([trader.pk for trader in traders])
+        self.assertEqual(sorted(t for t, _ in orders),
+                         sorted(trader.pk for trader in traders))
+        self.assertEqual(
+            sum('"tradingapp_order"' in query['sql']
+                for query in polled.captured_queries), 2)
+
+
+class StreamServerTestCase(TransactionTestCase):
+
+    def setUp(self) -> None:
+        user = User.objects.create(username='streamer')
+        self.token = Token.objects.create(user=user).key
+        Stock.objects.create(name='LIVE', price=3.5, quantity=10)
+
+    async def request(self, port, path, token=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        auth = f'Authorization: Token {token}\r\n' if token else ''
+        writer.write(f'GET {path} HTTP/1.1\r\n{auth}\r\n'.encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        return reader, writer, head
+
+    async def serve(self, scenario):
+        """ Run `scenario(port)` against a started StreamServer """
+        server = StreamServer(poll_interval=0.01)
+        listener = await server.start('127.0.0.1', 0)
+        try:
+            await scenario(listener.sockets[0].getsockname()[1])
+        finally:
+            for task in server.tasks:
+                task.cancel()
+            listener.close()
+            await listener.wait_closed()
+            server.db.submit(connections.close_all).result()
+            server.db.shutdown()
+
+    async def stream(self, port):
+        _, writer, head = await self.request(port, '/elsewhere/')
+        writer.close()
+        self.assertTrue(head.startswith(b'HTTP/1.1 404'))
+        _, writer, head = await self.request(port, STREAM_PATH, 'bad')
+        writer.close()
+        self.assertTrue(head.startswith(b'HTTP/1.1 401'))
+
+        reader, writer, head = await self.request(
+            port, STREAM_PATH + '?symbols=LIVE', self.token)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+        self.assertIn(b'text/event-stream', head)
+        await reader.readuntil(b'\n\n')  # retry
+        event = await asyncio.wait_for(reader.readuntil(b'\n\n'), 5)
+        writer.close()
+        self.assertTrue(event.startswith(b'event: price'))
+        self.assertIn(b'"price": 3.5', event)
+
+    async def revoke(self, port):
+        reader, writer, head = await self.request(
+            port, STREAM_PATH + '?symbols=LIVE', self.token)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200'))
+        await reader.readuntil(b'\n\n')  # retry
+        await asyncio.wait_for(reader.readuntil(b'\n\n'), 5)
+
+        # Deleted elsewhere, as a logout served by another process does
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.logout)
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        writer.close()
+        _, writer, head = await self.request(port, STREAM_PATH, self.token)
+        writer.close()
+        self.assertTrue(head.startswith(b'HTTP/1.1 401'))
+
+    def logout(self):
+        try:
+            Token.objects.filter(key=self.token).delete()
+        finally:
+            connections.close_all()
+
+    def test_stream(self):
+        asyncio.run(self.serve(self.stream))
+
+    def test_stream_closed_on_logout(self):
+        """
+        Ensure an open stream ends and its token is refused once the token
+        is deleted, though the server has it cached
+        """
+        asyncio.run(self.serve(self.revoke))
+
+
+class ProfilingMiddlewareTestCase(TradingAppEndpointTestCase):
+
+    def tearDown(self) -> None:
+        self.logout_user()
+        super().tearDown()
+
+    @override_settings(PROFILING_TOKEN='secret', PROFILING_SAMPLE_RATE=0)
+    def test_profile_on_header(self):
+        """
+        Ensure only requests carrying the profiling token are profiled and
+        that their report is stored
+        """
+        self.login_user(USERA.get('username'))
+        # The stock list is served from stock_list_cache, the detail still
+        # goes through the serializer
+        endpoint = reverse(self.endpoint_stock_detail, kwargs={
+            'pk': Stock.objects.get(name=self.TEST_STOCK_A).pk})
+
+        resp = self.client.get(endpoint)
+        self.assertNotIn('Server-Timing', resp)
+        resp = self.client.get(endpoint, HTTP_X_PROFILE='wrong')
+        self.assertNotIn('Server-Timing', resp)
+        self.assertFalse(RequestProfile.objects.exists())
+
+        resp = self.client.get(endpoint, HTTP_X_PROFILE='secret')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('sql;dur=', resp['Server-Timing'])
+        self.assertIn('serializer;dur=', resp['Server-Timing'])
+
+        report = RequestProfile.objects.get()
+        self.assertEqual(report.path, endpoint)
+        self.assertGreater(report.sql_count, 0)
+        self.assertEqual(len(json.loads(report.queries)), report.sql_count)
+        self.assertIn('get_invested', report.hotspots)
+        self.assertIsInstance(marshal.loads(bytes(report.stats)), dict)
+
+        # Report can be downloaded from the admin
+        admin = User.objects.create_superuser('admin', '', 'admin1234')
+        self.client.force_login(admin)
+        resp = self.client.get(reverse(
+            'admin:tradingapp_requestprofile_download', args=(report.pk,)))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.content, bytes(report.stats))
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_profile_sampled(self):
+        self.login_user(USERA.get('username'))
+        resp = self.client.get(reverse(self.endpoint_stock_list))
+        self.assertIn('Server-Timing', resp)
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Read from an SQLite file standing in for a replica, which only catches
+    up with the primary when synced
+    """
+
+    databases = {'default', 'replica'}
+    client_class = APIClient
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.replica_file = NamedTemporaryFile(suffix='.sqlite3')
+        connections.databases['replica'] = dict(
+            connections.databases['default'], NAME=cls.replica_file.name,
+            TEST={'NAME': cls.replica_file.name})
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections.databases['replica']
+        cls.replica_file.close()
+
+    def setUp(self) -> None:
+        for cached in (cache, stock_cache, stock_list_cache, token_cache):
+            cached.clear()
+        self.stock = Stock.objects.create(name='REPL', price=10.0)
+        self.tokens = [
+            Token.objects.create(user=User.objects.create(
+                username=f'replica_{i}')).key for i in range(2)]
+        sync_replica('replica')
+
+    def get(self, endpoint, token):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+        return self.client.get(endpoint)
+
+    @override_settings(READ_REPLICAS=['replica'])
+    def test_read_your_writes(self):
+        detail = reverse('stock-detail', kwargs={'pk': self.stock.pk})
+        orders = reverse('order-list')
+        Stock.objects.filter(pk=self.stock.pk).update(price=20.0)
+
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.assertEqual(self.get(detail, self.tokens[0]).json()[
+                'price'], 10.0)
+        self.assertTrue(replica.captured_queries)
+
+        resp = self.client.post(orders, {
+            'stock': 'REPL', 'order_type': 'buy', 'quantity': 2})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # The writer reads from the primary, the other trader doesn't
+        self.assertEqual(self.get(detail, self.tokens[0]).json()['price'],
+                         20.0)
+        self.assertEqual(len(self.get(orders, self.tokens[0]).json()), 1)
+        self.assertEqual(self.get(detail, self.tokens[1]).json()['price'],
+                         10.0)
+
+        cache.clear()  # The sticky window is over
+        self.assertEqual(self.get(orders, self.tokens[0]).json(), [])
+        call_command('syncreplicas', stdout=StringIO())
+        self.assertEqual(len(self.get(orders, self.tokens[0]).json()), 1)
+
+
+class SQLiteProductionTestCase(TransactionTestCase):
+
+    @override_settings(SQLITE_PRAGMAS=settings.SQLITE_PRODUCTION_PRAGMAS)
+    def test_pragmas(self):
+        with NamedTemporaryFile(suffix='.sqlite3') as db_file:
+            db = DatabaseWrapper(dict(
+                connection.settings_dict, NAME=db_file.name), 'pragmas')
+            try:
+                with db.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+                    cursor.execute('PRAGMA synchronous')
+                    self.assertEqual(cursor.fetchone()[0], 1)  # normal
+                    cursor.execute('PRAGMA busy_timeout')
+                    self.assertEqual(cursor.fetchone()[0], 20000)
+            finally:
+                db.close()
+
+    @override_settings(SQLITE_WRITER_LANE=True)
+    def test_writer_lane(self):
+        """ One thread at a time in the lane, which is reentrant """
+        inside, most = [0], [0]
+
+        def write():
+            for _ in range(20):
+                with writer_lane():
+                    with writer_lane():
+                        inside[0] += 1
+                        most[0] = max(most[0], inside[0])
+                        time.sleep(0.001)
+                        inside[0] -= 1
+            connections.close_all()
+
+        workers = [threading.Thread(target=write) for _ in range(4)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual(most[0], 1)
+
+
+class ConcurrentOrderTestCase(TransactionTestCase):
+    """
+    Hammer the order placement path from several threads at once, each
+    with its own database connection, and make sure no update is lost.
+    """
+
+    threads = 8
+    orders_per_thread = 250
+    traders = 4
+    initial_balance = 2000.0
+    initial_quantity = 400
+
+    def setUp(self) -> None:
+        self.stock = Stock.objects.create(
+            name='STRESS', price=2.5, quantity=self.initial_quantity)
+        self.profiles = []
+        for i in range(self.traders):
+            user = User.objects.create(username=f'stress_{i}')
+            user.profile.balance = self.initial_balance
+            user.profile.save()
+            self.profiles.append(user.profile)
+
+    def worker(self, seed, results):
+        rng = random.Random(seed)
+        try:
+            for _ in range(self.orders_per_thread):
+                trader = rng.choice(self.profiles)
+                order_type = rng.choice(('buy', 'buy', 'sell'))
+                try:
+                    place_order(trader, self.stock, order_type,
+                                rng.randint(1, 15))
+                    results.append(True)
+                except ValidationError:
+                    results.append(False)
+        finally:
+            connections.close_all()
+
+    def test_concurrent_orders(self):
+        results = []
+        workers = [threading.Thread(target=self.worker, args=(i, results))
+                   for i in range(self.threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+
+        self.assertEqual(len(results), self.threads * self.orders_per_thread)
+        self.assertEqual(Order.objects.count(), results.count(True))
+        self.assert_consistent(Order.objects.all())
+
+    @override_settings(SQLITE_WRITER_LANE=True,
+                       SQLITE_PRAGMAS=settings.SQLITE_PRODUCTION_PRAGMAS)
+    def test_concurrent_orders_production_mode(self):
+        connections.close_all()  # reconnect with the pragmas
+        self.test_concurrent_orders()
+
+    def test_queued_orders_worker_pool(self):
+        """
+        Queue pending orders and drain them with several worker processes
+        """
+        rng = random.Random(0)
+        Order.objects.bulk_create([
+            Order(trader=rng.choice(self.profiles), stock=self.stock,
+                  order_type=rng.choice(('buy', 'buy', 'sell')),
+                  quantity=quantity, amount=quantity * self.stock.price,
+                  status='pending')
+            for quantity in (rng.randint(1, 15) for _ in range(1000))])
+
+        out = StringIO()
+        call_command('processorders', workers=4, batch_size=50, once=True,
+                     stdout=out)
+        self.assertIn('processed 1000 orders', out.getvalue())
+        self.assertFalse(Order.objects.exclude(
+            status__in=('success', 'rejected')).exists())
+        self.assertFalse(Order.objects.filter(
+            status='rejected', remarks__isnull=True).exists())
+        self.assert_consistent(Order.objects.filter(status='success'))
+
+    def assert_consistent(self, filled):
+        """
+        Ensure the stock, balances and positions add up to the `filled`
+        orders and never went negative
+        """
+        buy = Q(order_type='buy')
+        sell = Q(order_type='sell')
+        totals = filled.aggregate(
+            bought=Sum('quantity', filter=buy),
+            sold=Sum('quantity', filter=sell))
+        self.stock.refresh_from_db()
+        self.assertGreaterEqual(self.stock.quantity, 0)
+        self.assertEqual(self.stock.quantity,
+                         self.initial_quantity - totals['bought'] +
+                         (totals['sold'] or 0))
+
+        for profile in self.profiles:
+            profile.refresh_from_db()
+            orders = filled.filter(trader=profile).aggregate(
+                bought_shares=Sum('quantity', filter=buy),
+                bought_amount=Sum('amount', filter=buy),
+                sold_shares=Sum('quantity', filter=sell),
+                sold_amount=Sum('amount', filter=sell))
+            orders = {k: v or 0 for k, v in orders.items()}
+            self.assertGreaterEqual(profile.balance, 0)
+            self.assertAlmostEqual(
+                profile.balance,
+                self.initial_balance - orders['bought_amount'] +
+                orders['sold_amount'])
+
+            position = profile.positions.get(stock=self.stock)
+            self.assertGreaterEqual(position.net_shares, 0)
+            self.assertEqual(position.bought_shares, orders['bought_shares'])
+            self.assertEqual(position.sold_shares, orders['sold_shares'])
+
+        # The lots consumed concurrently agree with the order history
+        call_command('rebuildlots', verify=True, stdout=StringIO())